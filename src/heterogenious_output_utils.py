@@ -2,7 +2,8 @@
 # ({activ1} {unit_num1})x{num_out1} ({activ} {unit_num2})x{num_out2}
 import re
 import dynet
-from lib.mnnl import FFSequencePredictor, Layer
+from collections import OrderedDict
+from lib.mnnl import FFSequencePredictor, Layer, FusedLayers
 from lib.mmappers import ACTIVATION_MAP
 parse_exp = re.compile(r'(\(([a-z]*) ([0-9]*)\)x([0-9]*))')
 
@@ -21,6 +22,18 @@ def query_to_dynet_builder(query):
     return output_generator
 
 
+def fuse_output_layers(output_predictors, head_ids):
+    """
+    group the given heads by shape; each group is evaluated at once as FusedLayers
+    """
+    groups = OrderedDict()
+    for head_id in head_ids:
+        layer = output_predictors[head_id].network_builder
+        key = (layer.mlp, layer.mlp_activation if layer.mlp else None, layer.act, layer.W.shape())
+        groups.setdefault(key, []).append(head_id)
+    return [FusedLayers([output_predictors[head_id].network_builder for head_id in ids], ids) for ids in groups.values()]
+
+
 def get_layer_params(query):
     output_list = parse_exp.findall(query)
     layers = []
@@ -32,5 +45,17 @@ def get_layer_params(query):
             layers.append((mlp_activation, mlp,))
     return layers
 
+def layers_to_query(layers):
+    """
+    the query of a list of (activation, unit_num) layers as returned by get_layer_params
+    """
+    parts = []
+    for layer in layers:
+        if parts and parts[-1][0] == layer:
+            parts[-1][1] += 1
+        else:
+            parts.append([layer, 1])
+    return " ".join("(%s %s)x%d" % (mlp_activation, mlp, times) for (mlp_activation, mlp), times in parts)
+
 def get_output_number(query):
     return sum([int(output_type[3]) for output_type in parse_exp.findall(query)])
\ No newline at end of file
@@ -0,0 +1,91 @@
+"""
+single-file binary bundle: a header, json metadata and contiguous tensors
+
+layout: magic (8 bytes), format version (uint32), metadata length (uint64), metadata (utf-8 json),
+then the tensors, each starting at a multiple of ALIGNMENT bytes; the metadata lists name, dtype,
+shape and offset of every tensor, the tensors are memory-mapped on load
+"""
+import json
+import os
+import struct
+from collections import OrderedDict
+
+import numpy as np
+
+from lib.mcorpus import encode_strings, decode_strings
+
+BUNDLE_MAGIC = b"QMTLBNDL"
+BUNDLE_VERSION = 1
+ALIGNMENT = 64
+
+_PREAMBLE = struct.Struct("<8sIQ")
+
+
+def _aligned(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def _json_default(value):
+    if isinstance(value, np.generic): # numpy scalars in the settings
+        return value.item()
+    raise TypeError("{!r} is not json serializable".format(value))
+
+
+def save_bundle(path, meta, tensors):
+    """
+    write meta (json serializable) and tensors (name -> numpy array) to path; the file is written
+    next to path and renamed into place when complete
+    """
+    tensors = OrderedDict((name, np.ascontiguousarray(values)) for name, values in tensors.items())
+    index = []
+    offset = 0
+    for name, values in tensors.items():
+        index.append({"name": name, "dtype": values.dtype.str, "shape": list(values.shape), "offset": offset})
+        offset = _aligned(offset + values.nbytes)
+    header = json.dumps({"meta": meta, "tensors": index}, ensure_ascii=False, default=_json_default).encode("utf-8")
+    data_start = _aligned(_PREAMBLE.size + len(header))
+
+    tmp_path = path + ".tmp{}".format(os.getpid())
+    with open(tmp_path, "wb") as f:
+        f.write(_PREAMBLE.pack(BUNDLE_MAGIC, BUNDLE_VERSION, len(header)))
+        f.write(header)
+        for entry, values in zip(index, tensors.values()):
+            f.seek(data_start + entry["offset"])
+            f.write(values.tobytes())
+        f.truncate(data_start + offset)
+    os.replace(tmp_path, path)
+
+
+def load_bundle(path):
+    """
+    returns (meta, tensors): the tensors are read-only views into the memory-mapped file
+    """
+    with open(path, "rb") as f:
+        magic, version, header_length = _PREAMBLE.unpack(f.read(_PREAMBLE.size))
+        if magic != BUNDLE_MAGIC:
+            raise ValueError("{} is not a model bundle".format(path))
+        if version != BUNDLE_VERSION:
+            raise ValueError("{}: unsupported bundle version {} (expected {})".format(path, version, BUNDLE_VERSION))
+        header = json.loads(f.read(header_length).decode("utf-8"))
+    data_start = _aligned(_PREAMBLE.size + header_length)
+    data = np.memmap(path, dtype=np.uint8, mode="r")
+    tensors = OrderedDict()
+    for entry in header["tensors"]:
+        dtype = np.dtype(entry["dtype"])
+        start = data_start + entry["offset"]
+        count = int(np.prod(entry["shape"], dtype=np.int64))
+        tensors[entry["name"]] = data[start:start + count * dtype.itemsize].view(dtype).reshape(entry["shape"])
+    return header["meta"], tensors
+
+
+def encode_vocabulary(mapping):
+    """
+    string -> index mapping as arrays: (utf-8 strings, their offsets, their indices)
+    """
+    strings = list(mapping)
+    data, offsets = encode_strings(strings)
+    return data, offsets, np.array([mapping[s] for s in strings], dtype=np.int64)
+
+
+def decode_vocabulary(data, offsets, indices):
+    return dict(zip(decode_strings(data, offsets), indices.tolist()))
@@ -0,0 +1,99 @@
+"""
+checkpointing during training: model bundles are written by a background thread from snapshots
+(settings and copies of the parameters), so training goes on while the files are written;
+a checkpoint also holds the state needed to resume training (counters, random number generators)
+"""
+import copy
+import random
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from lib.mbundle import save_bundle
+
+
+class CheckpointWriter(object):
+    """
+    writes model bundles in a background thread: submit() copies the metadata and returns at once,
+    a newer submission for a path replaces one that is not written yet; bundles are renamed into place
+    when complete, so a killed run leaves the last complete checkpoint behind
+    """
+    def __init__(self):
+        self.pending = OrderedDict() # path -> (meta, tensors)
+        self.writing = False
+        self.closed = False
+        self.error = None
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, path, meta, tensors):
+        """ write meta and tensors to path in the background; the arrays must not be changed afterwards """
+        meta = copy.deepcopy(meta)
+        with self.condition:
+            self._raise_error()
+            self.pending.pop(path, None)
+            self.pending[path] = (meta, tensors)
+            self.condition.notify_all()
+
+    def wait(self):
+        """ block until everything submitted is written """
+        with self.condition:
+            while self.pending or self.writing:
+                self.condition.wait()
+            self._raise_error()
+
+    def close(self):
+        self.wait()
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.thread.join()
+
+    def _raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError("writing a checkpoint failed") from error
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.pending and not self.closed:
+                    self.condition.wait()
+                if not self.pending:
+                    return
+                path, (meta, tensors) = self.pending.popitem(last=False)
+                self.writing = True
+            error = None
+            try:
+                start = time.time()
+                save_bundle(path, meta, tensors)
+                print("written: {} ({:.2f} seconds)".format(path, time.time() - start), file=sys.stderr, flush=True)
+            except Exception as e:
+                error = e
+            with self.condition:
+                self.writing = False
+                if error is not None:
+                    self.error = error
+                self.condition.notify_all()
+
+
+def get_rng_state():
+    """
+    state of python's and numpy's random number generators as (json serializable part, arrays)
+    """
+    version, internal_state, gauss_next = random.getstate()
+    name, keys, position, has_gauss, cached_gaussian = np.random.get_state()
+    meta = {"python": [version, gauss_next],
+            "numpy": [name, int(position), int(has_gauss), float(cached_gaussian)]}
+    return meta, {"rng.python": np.array(internal_state, dtype=np.int64), "rng.numpy": np.array(keys, dtype=np.uint32)}
+
+
+def set_rng_state(meta, tensors):
+    version, gauss_next = meta["python"]
+    random.setstate((version, tuple(int(value) for value in tensors["rng.python"]), gauss_next))
+    name, position, has_gauss, cached_gaussian = meta["numpy"]
+    np.random.set_state((name, np.array(tensors["rng.numpy"], dtype=np.uint32), position, has_gauss, cached_gaussian))
@@ -0,0 +1,223 @@
+"""
+array-backed corpus container and its on-disk cache
+
+a cached corpus is a folder with the buffers of an IndexedCorpus (.npy, memory-mapped on load)
+and a meta.json for the mappings
+"""
+import hashlib
+import json
+import os
+import shutil
+import sys
+from array import array
+
+import numpy as np
+
+from lib.mio import file_digest
+
+CORPUS_CACHE_VERSION = 2
+
+
+def mapping_digest(*mappings):
+    """
+    sha1 of (json serializable) index mappings, e.g. w2i, c2i, task2tag2idx
+    """
+    digest = hashlib.sha1()
+    for mapping in mappings:
+        digest.update(json.dumps(mapping, ensure_ascii=False).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def corpus_cache_path(cache_dir, file_names, *key_parts):
+    """
+    folder of the cached corpus; the key covers the content of the files, the cache version and key_parts
+    """
+    digest = hashlib.sha1(str(CORPUS_CACHE_VERSION).encode('utf-8'))
+    for file_name in file_names:
+        digest.update(file_digest(file_name).encode('utf-8'))
+    digest.update(json.dumps(key_parts).encode('utf-8'))
+    return os.path.join(cache_dir, "{}.{}".format(os.path.basename(file_names[0]), digest.hexdigest()[:16]))
+
+
+def encode_strings(strings):
+    """
+    list of strings -> (utf-8 bytes as uint8 array, int64 offsets)
+    """
+    encoded = [s.encode('utf-8') for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(e) for e in encoded], out=offsets[1:])
+    return np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets
+
+
+def decode_strings(data, offsets):
+    blob = data.tobytes()
+    return [blob[start:end].decode('utf-8') for start, end in zip(offsets[:-1].tolist(), offsets[1:].tolist())]
+
+
+class IndexedCorpus(object):
+    """
+    indexed sentences stored in contiguous numpy buffers:
+    words and tags (one entry per token, unknown tags are -1) split by sent_offsets,
+    token_types pointing into a char table with one entry per word type (chars, char_offsets)
+    that is shared by all tokens of the type
+
+    corpus[i] returns (word_indices, word_char_indices) and corpus.tags[i] the tag indices of sentence i,
+    as views into the buffers
+    """
+    def __init__(self, words, tags, sent_offsets, token_types, chars, char_offsets):
+        self.words = words
+        self.tags_flat = tags
+        self.sent_offsets = sent_offsets
+        self.token_types = token_types
+        self.chars = chars
+        self.char_offsets = char_offsets
+        self.has_chars = len(chars) > 0
+        self.tags = _TagView(self)
+
+    def __len__(self):
+        return len(self.sent_offsets) - 1
+
+    def __getitem__(self, i):
+        start, end = self.sent_offsets[i], self.sent_offsets[i + 1]
+        return self.words[start:end], self.char_indices(start, end)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def char_indices(self, start, end):
+        """
+        char indices of the tokens [start, end)
+        """
+        if not self.has_chars:
+            return []
+        char_offsets = self.char_offsets
+        return [self.chars[char_offsets[t]:char_offsets[t + 1]] for t in self.token_types[start:end]]
+
+    def num_tokens(self):
+        return len(self.words)
+
+    def sentence_lengths(self):
+        return np.diff(self.sent_offsets)
+
+    def subset(self, indices):
+        """
+        corpus with the given sentences (in that order); the char table is shared
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        starts, ends = self.sent_offsets[indices], self.sent_offsets[indices + 1]
+        sent_offsets = np.zeros(len(indices) + 1, dtype=np.int64)
+        np.cumsum(ends - starts, out=sent_offsets[1:])
+        if len(indices):
+            token_ids = np.concatenate([np.arange(start, end) for start, end in zip(starts, ends)])
+        else:
+            token_ids = np.zeros(0, dtype=np.int64)
+        return IndexedCorpus(self.words[token_ids], self.tags_flat[token_ids], sent_offsets,
+                             self.token_types[token_ids], self.chars, self.char_offsets)
+
+    def arrays(self):
+        return {"words": self.words, "tags": self.tags_flat, "sent_offsets": self.sent_offsets,
+                "token_types": self.token_types, "chars": self.chars, "char_offsets": self.char_offsets}
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        return cls(arrays["words"], arrays["tags"], arrays["sent_offsets"],
+                   arrays["token_types"], arrays["chars"], arrays["char_offsets"])
+
+    def nbytes(self):
+        return sum(buffer.nbytes for buffer in self.arrays().values())
+
+
+class _TagView(object):
+    """ tag indices of the sentences of a corpus """
+    def __init__(self, corpus):
+        self.corpus = corpus
+
+    def __len__(self):
+        return len(self.corpus)
+
+    def __getitem__(self, i):
+        sent_offsets = self.corpus.sent_offsets
+        return self.corpus.tags_flat[sent_offsets[i]:sent_offsets[i + 1]]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+class IndexedCorpusBuilder(object):
+    """
+    collects indexed sentences into typed buffers and builds an IndexedCorpus;
+    char_indices_of (word -> list of char indices) is called once per word type, None disables char features
+    """
+    def __init__(self, char_indices_of=None):
+        self.char_indices_of = char_indices_of
+        self.type2id = {}
+        self.words = array('i')
+        self.tags = array('i')
+        self.token_types = array('i')
+        self.sent_lengths = array('q')
+        self.chars = array('i')
+        self.char_lengths = array('q')
+
+    def add(self, words, word_indices, tag_indices):
+        for word in words:
+            type_id = self.type2id.get(word)
+            if type_id is None:
+                type_id = self.type2id[word] = len(self.type2id)
+                if self.char_indices_of:
+                    chars_of_word = self.char_indices_of(word)
+                    self.chars.extend(chars_of_word)
+                    self.char_lengths.append(len(chars_of_word))
+            self.token_types.append(type_id)
+        self.words.extend(word_indices)
+        self.tags.extend([-1 if t is None else t for t in tag_indices])
+        self.sent_lengths.append(len(word_indices))
+
+    def types(self):
+        """ word types in order of their ids """
+        return list(self.type2id)
+
+    def build(self):
+        sent_offsets = np.zeros(len(self.sent_lengths) + 1, dtype=np.int64)
+        np.cumsum(np.asarray(self.sent_lengths, dtype=np.int64), out=sent_offsets[1:])
+        char_offsets = np.zeros(len(self.char_lengths) + 1, dtype=np.int64)
+        np.cumsum(np.asarray(self.char_lengths, dtype=np.int64), out=char_offsets[1:])
+        return IndexedCorpus(np.array(self.words, dtype=np.int32), np.array(self.tags, dtype=np.int32), sent_offsets,
+                             np.array(self.token_types, dtype=np.int32), np.array(self.chars, dtype=np.int32),
+                             char_offsets)
+
+
+def save_corpus_cache(path, arrays, meta):
+    """
+    write arrays and meta to the cache folder; the folder is renamed into place when complete
+    """
+    tmp_path = path + ".tmp{}".format(os.getpid())
+    os.makedirs(tmp_path)
+    for name, buffer in arrays.items():
+        np.save(os.path.join(tmp_path, name + ".npy"), buffer)
+    with open(os.path.join(tmp_path, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump(dict(meta, version=CORPUS_CACHE_VERSION), f, ensure_ascii=False)
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        # another run stored the same corpus in the meantime
+        shutil.rmtree(tmp_path, ignore_errors=True)
+    print("stored corpus cache: {}".format(path), file=sys.stderr)
+
+
+def load_corpus_cache(path):
+    """
+    memory-map the arrays of a cached corpus; returns (arrays, meta) or None if not cached
+    """
+    meta_file = os.path.join(path, "meta.json")
+    if not os.path.exists(meta_file):
+        return None
+    with open(meta_file, encoding="utf-8") as f:
+        meta = json.load(f)
+    if meta.get("version") != CORPUS_CACHE_VERSION:
+        return None
+    arrays = {name[:-len(".npy")]: np.load(os.path.join(path, name), mmap_mode="r")
+              for name in os.listdir(path) if name.endswith(".npy")}
+    print("loaded corpus cache: {}".format(path), file=sys.stderr)
+    return arrays, meta
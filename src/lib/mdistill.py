@@ -0,0 +1,69 @@
+"""
+knowledge distillation: the soft targets of a teacher (the averaged tag distributions of its heads
+at a temperature) for every token of a training file, stored as a memory-mapped model bundle
+"""
+import hashlib
+import os
+
+import numpy as np
+
+from lib.mbundle import save_bundle, load_bundle
+from lib.mio import file_digest
+
+
+def soft_targets_cache_path(cache_dir, train_file, teacher_file, temperature, head=None):
+    """
+    the key covers the content of the training file and of the teacher model, the temperature and the head(s)
+    """
+    key = hashlib.sha1("{}|{}|{}|{}".format(file_digest(train_file), file_digest(teacher_file),
+                                            temperature, head).encode("utf-8")).hexdigest()[:16]
+    return os.path.join(cache_dir, "{}.soft-targets.{}.qmtl".format(os.path.basename(train_file), key))
+
+
+class SoftTargets(object):
+    """
+    (tokens x teacher tags) distributions, sentence i spans the rows sent_offsets[i]:sent_offsets[i + 1];
+    use_tags(tag2idx) maps the columns to a student's tag indices, select(sentence_ids) maps the student's
+    sentence indices to the sentences of the file
+    """
+    def __init__(self, tags, targets, sent_offsets):
+        self.tags = tags
+        self.targets = targets
+        self.sent_offsets = np.asarray(sent_offsets)
+        self.columns = np.arange(len(tags))
+        self.sentence_ids = np.arange(len(self.sent_offsets) - 1)
+
+    def __len__(self):
+        return len(self.sentence_ids)
+
+    def save(self, path):
+        save_bundle(path, {"tags": self.tags}, {"targets": self.targets, "sent_offsets": self.sent_offsets})
+
+    @classmethod
+    def load(cls, path):
+        meta, tensors = load_bundle(path)
+        return cls(meta["tags"], tensors["targets"], tensors["sent_offsets"])
+
+    def use_tags(self, tag2idx):
+        """ columns in the order of tag2idx; tags the teacher does not know get no probability mass """
+        teacher_columns = {tag: i for i, tag in enumerate(self.tags)}
+        self.columns = np.array([teacher_columns.get(tag, -1) for tag in sorted(tag2idx, key=tag2idx.get)])
+        return self
+
+    def select(self, sentence_ids):
+        """ the soft targets of the given sentences of the file (a view, the arrays are shared) """
+        selected = SoftTargets(self.tags, self.targets, self.sent_offsets)
+        selected.columns = self.columns
+        selected.sentence_ids = self.sentence_ids[np.asarray(sentence_ids, dtype=np.int64)]
+        return selected
+
+    def batch(self, batch):
+        """
+        (tags x tokens) targets of a batch of sentences (of the same length), token t of sentence b in
+        column b * sent_len + t; renormalized over the tags in use
+        """
+        rows = np.concatenate([self.targets[self.sent_offsets[i]:self.sent_offsets[i + 1]]
+                               for i in self.sentence_ids[batch]])
+        targets = np.where(self.columns >= 0, rows[:, np.maximum(self.columns, 0)], 0.0).astype(np.float32)
+        targets /= np.maximum(targets.sum(axis=1, keepdims=True), np.float32(1e-12))
+        return targets.T
@@ -0,0 +1,103 @@
+"""
+ensemble mode helpers: the members are trained and tested in parallel processes,
+their test distributions are dumped to disk and summed into a memory-mapped buffer afterwards
+"""
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+DYNET_DEFAULT_MEM = 512 # MB, what DyNet allocates without --dynet-mem
+
+
+def member_concurrency(jobs, mem_budget, member_mem, member_cores=1):
+    """
+    number of members that can run at once with jobs cores and mem_budget MB (0: no memory limit)
+    """
+    concurrency = max(1, jobs // member_cores)
+    if mem_budget:
+        concurrency = min(concurrency, max(1, mem_budget // member_mem))
+    return concurrency
+
+
+def run_member_processes(commands, stdout_files, max_parallel, poll_interval=0.5):
+    """
+    run the commands with at most max_parallel at a time (in the given order), the stdout of each
+    goes to its file; returns the exit codes
+    """
+    exit_codes = [None] * len(commands)
+    running = {}
+    pending = list(range(len(commands)))
+    while pending or running:
+        while pending and len(running) < max_parallel:
+            i = pending.pop(0)
+            stdout = open(stdout_files[i], "w")
+            running[i] = (subprocess.Popen(commands[i], stdout=stdout), stdout)
+        time.sleep(poll_interval)
+        for i, (process, stdout) in list(running.items()):
+            if process.poll() is not None:
+                stdout.close()
+                exit_codes[i] = process.returncode
+                del running[i]
+                print("ensemble member {} finished (exit code {})".format(i, process.returncode), file=sys.stderr)
+    return exit_codes
+
+
+class EnsembleAccumulator(object):
+    """
+    sum of the members' tag distributions over a test set, in a preallocated float32 memory-mapped buffer
+    with a row per token: sentence i spans the rows sent_offsets[i]:sent_offsets[i + 1]
+    """
+    def __init__(self, sent_offsets, num_tags, path=None):
+        self.sent_offsets = np.asarray(sent_offsets, dtype=np.int64)
+        self.own_file = path is None
+        if path is None:
+            fd, path = tempfile.mkstemp(prefix="qmtl-ensemble-", suffix=".npy")
+            os.close(fd)
+        self.path = path
+        # a new buffer is all zeros
+        self.buffer = np.lib.format.open_memmap(path, mode="w+", dtype=np.float32,
+                                                shape=(int(self.sent_offsets[-1]), num_tags))
+
+    def add(self, start, end, distributions):
+        """ add the (positions x tags) distributions of the tokens [start, end) """
+        self.buffer[start:end] += distributions
+
+    def add_all(self, distributions, chunk_size=1 << 16):
+        """ add the distributions of all tokens (e.g. a member dump), a chunk of tokens at a time """
+        for start in range(0, len(self.buffer), chunk_size):
+            self.buffer[start:start + chunk_size] += distributions[start:start + chunk_size]
+
+    def predictions(self, chunk_size=1 << 16):
+        """ index of the highest summed probability of each token """
+        predicted = np.empty(len(self.buffer), dtype=np.int64)
+        for start in range(0, len(self.buffer), chunk_size):
+            predicted[start:start + chunk_size] = np.argmax(self.buffer[start:start + chunk_size], axis=1)
+        return predicted
+
+    def close(self):
+        self.buffer.flush()
+        del self.buffer
+        if self.own_file:
+            os.remove(self.path)
+
+
+def save_member_meta(path, i2t, sent_offsets):
+    """
+    the tag mapping and sentence offsets of a member's dumped distributions (path + ".npy")
+    """
+    with open(path + ".json", "w", encoding="utf-8") as f:
+        json.dump({"tags": [i2t[i] for i in range(len(i2t))], "sent_offsets": [int(o) for o in sent_offsets]}, f)
+
+
+def load_member_distributions(path):
+    """
+    returns (memory-mapped token distributions, i2t, sentence offsets) of a dumped member
+    """
+    with open(path + ".json", encoding="utf-8") as f:
+        meta = json.load(f)
+    return np.load(path + ".npy", mmap_mode="r"), dict(enumerate(meta["tags"])), meta["sent_offsets"]
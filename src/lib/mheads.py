@@ -0,0 +1,67 @@
+"""
+choosing the Q-MTL heads used for prediction from their dev distributions
+"""
+import numpy as np
+
+
+def _accuracy(summed, gold):
+    return float(np.mean(np.argmax(summed, axis=1) == gold)) if len(gold) else 0.0
+
+
+def greedy_head_selection(distributions, gold, tolerance, weighted=False):
+    """
+    distributions: (heads x tokens x tags) dev distributions of the heads, gold: the gold tag index of each
+    token (-1: unknown, never correct)
+
+    heads are added one at a time, always the one whose addition gives the most accurate average, until the
+    average is within tolerance of the accuracy of the average of all heads; with weighted, a head can be added
+    again (its weight is the number of times it was chosen), re-adding a chosen head is preferred on ties
+
+    returns (head ids, their weights, accuracy of the weighted average, accuracy of the average of all heads)
+    """
+    num_heads = len(distributions)
+    full_accuracy = _accuracy(distributions.sum(axis=0), gold)
+    counts = np.zeros(num_heads, dtype=np.int64)
+    summed = np.zeros_like(distributions[0])
+    max_steps = 2 * num_heads if weighted else num_heads
+    accuracy = 0.0
+    for _ in range(max_steps):
+        candidates = range(num_heads) if weighted else np.flatnonzero(counts == 0)
+        # most accurate, then already chosen (no extra cost), then the lowest head id
+        _, _, head = max((_accuracy(summed + distributions[head], gold), counts[head] > 0, -head) for head in candidates)
+        head = -head
+        counts[head] += 1
+        summed += distributions[head]
+        accuracy = _accuracy(summed, gold)
+        if accuracy >= full_accuracy - tolerance:
+            break
+    if accuracy < full_accuracy - tolerance:
+        # not reached (weighted): all heads
+        counts[:] = 1
+        accuracy = full_accuracy
+    heads = np.flatnonzero(counts).tolist()
+    return heads, counts[heads].tolist(), accuracy, full_accuracy
+
+
+class HeadPruner(object):
+    """
+    follows the dev accuracy of the heads being trained against the Q-MTL average after every epoch: a head that
+    stays more than threshold below the average for patience epochs in a row is lagging; the best head never is
+    """
+    def __init__(self, threshold, patience):
+        self.threshold = threshold
+        self.patience = patience
+        self.epochs_behind = {} # head id -> epochs in a row below the average
+
+    def update(self, head_accuracies, average_accuracy):
+        """
+        head_accuracies: head id -> dev accuracy of the heads still trained; returns the lagging heads
+        """
+        best = max(head_accuracies, key=lambda head: (head_accuracies[head], -head))
+        lagging = []
+        for head, accuracy in sorted(head_accuracies.items()):
+            behind = head != best and accuracy < average_accuracy - self.threshold
+            self.epochs_behind[head] = self.epochs_behind.get(head, 0) + 1 if behind else 0
+            if self.epochs_behind[head] >= self.patience:
+                lagging.append(head)
+        return lagging
@@ -1,13 +1,146 @@
 import codecs
 import numpy as np
 import sys
+import os
 import gzip
+import hashlib
+import io
+import json
+import queue
+import threading
 
-def load_embeddings_file(file_name, sep=" ",lower=False):
+EMBEDDINGS_CACHE_VERSION = 2
+
+
+def file_digest(file_name, chunk_size=1 << 20):
+    """
+    sha1 of the content of a file (read in chunks)
+    """
+    digest = hashlib.sha1()
+    with open(file_name, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class EmbeddingsCache(object):
+    """
+    read-only word -> vector mapping backed by a (memory-mapped) float32 matrix
+    behaves like the dict returned by the text loader
+    """
+    def __init__(self, words, matrix):
+        self.words = words
+        self.matrix = matrix
+        self.w2i = {word: i for i, word in enumerate(words)}
+
+    def __getitem__(self, word):
+        return self.matrix[self.w2i[word]]
+
+    def __contains__(self, word):
+        return word in self.w2i
+
+    def __iter__(self):
+        return iter(self.words)
+
+    def __len__(self):
+        return len(self.words)
+
+    def keys(self):
+        return self.w2i.keys()
+
+
+def embeddings_cache_paths(file_name, cache_dir, sep=" ", lower=False):
+    """
+    paths of the binary cache (matrix, vocabulary) of an embeddings file;
+    the key covers the content of the file and the parsing options
+    """
+    key = hashlib.sha1("{}|{}|{}|{}".format(EMBEDDINGS_CACHE_VERSION, file_digest(file_name),
+                                            sep, lower).encode('utf-8')).hexdigest()[:16]
+    prefix = os.path.join(cache_dir, "{}.{}".format(os.path.basename(file_name), key))
+    return prefix + ".npy", prefix + ".vocab"
+
+
+def load_embeddings_file(file_name, sep=" ", lower=False, cache_dir=None, vocab=None, top_n=None):
     """
     load embeddings file
+
+    if cache_dir is given the parsed embeddings are converted once into a float32 .npy matrix
+    plus a vocabulary file in that folder; later calls memory-map the matrix instead of parsing the text
+
+    vocab (set of words) and top_n (the first n entries, i.e. the most frequent ones in polyglot/word2vec files)
+    restrict the words that are kept; a word is kept if it satisfies either of the given restrictions
+    """
+    if cache_dir:
+        matrix_file, vocab_file = embeddings_cache_paths(file_name, cache_dir, sep=sep, lower=lower)
+        if not (os.path.exists(matrix_file) and os.path.exists(vocab_file)):
+            emb, emb_dim = _parse_embeddings_file(file_name, sep=sep, lower=lower)
+            _write_embeddings_cache(emb, emb_dim, matrix_file, vocab_file)
+            del emb
+        emb = _read_embeddings_cache(matrix_file, vocab_file)
+        if vocab is not None or top_n is not None:
+            keep = [i for i, word in enumerate(emb.words) if _keep_embedding(word, i, vocab, top_n)]
+            emb = EmbeddingsCache([emb.words[i] for i in keep], emb.matrix[keep])
+        print("loaded pre-trained embeddings (word->emb_vec) size: {} (lower: {}) from cache {}".format(
+            len(emb), lower, matrix_file), file=sys.stderr)
+        return emb, emb.matrix.shape[1]
+    return _parse_embeddings_file(file_name, sep=sep, lower=lower, vocab=vocab, top_n=top_n)
+
+
+def _keep_embedding(word, rank, vocab, top_n):
+    if vocab is None and top_n is None:
+        return True
+    return (vocab is not None and word in vocab) or (top_n is not None and rank < top_n)
+
+
+def read_vocabulary(file_names, raw=False):
+    """
+    set of all words in the given (conll or raw) files
+    """
+    vocab = set()
+    for file_name in file_names:
+        for words, _ in read_conll_file(file_name, raw=raw):
+            vocab.update(words)
+    return vocab
+
+
+def _write_embeddings_cache(emb, emb_dim, matrix_file, vocab_file):
+    """
+    write the binary cache; files are renamed into place so a killed run never leaves a half-written cache
     """
+    cache_dir = os.path.dirname(matrix_file)
+    if cache_dir and not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    # per process: the members of a parallel ensemble may write the same cache at once
+    tmp_suffix = ".tmp{}".format(os.getpid())
+    matrix = np.lib.format.open_memmap(matrix_file + tmp_suffix, mode="w+", dtype=np.float32, shape=(len(emb), emb_dim))
+    for i, word in enumerate(emb):
+        matrix[i] = emb[word]
+    matrix.flush()
+    del matrix
+    # the words as utf-8 bytes with offsets: any character can be part of a word
+    encoded = [word.encode("utf-8") for word in emb.keys()]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(word) for word in encoded], out=offsets[1:])
+    with open(vocab_file + tmp_suffix, "wb") as f:
+        np.savez(f, strings=np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets=offsets)
+    os.replace(matrix_file + tmp_suffix, matrix_file)
+    os.replace(vocab_file + tmp_suffix, vocab_file)
+    print("stored embeddings cache: {}".format(matrix_file), file=sys.stderr)
+
+
+def _read_embeddings_cache(matrix_file, vocab_file):
+    with np.load(vocab_file) as vocab:
+        blob, offsets = vocab["strings"].tobytes(), vocab["offsets"].tolist()
+    words = [blob[start:end].decode("utf-8") for start, end in zip(offsets[:-1], offsets[1:])]
+    matrix = np.load(matrix_file, mmap_mode="r")
+    assert len(words) == matrix.shape[0], "corrupt embeddings cache: {}".format(matrix_file)
+    return EmbeddingsCache(words, matrix)
+
+
+def _parse_embeddings_file(file_name, sep=" ", lower=False, vocab=None, top_n=None):
     emb={}
+    emb_dim = 0
+    rank = 0 # position of the entry in the file (header excluded)
     if file_name.endswith('.gz'):
         file_to_read = gzip.open(file_name, 'rt', errors='ignore', encoding='utf-8')
     else:
@@ -15,19 +148,24 @@ def load_embeddings_file(file_name, sep=" ",lower=False):
     for line in file_to_read:
         try:
             fields = line.strip().split(sep)
-            if len(emb) == 0 and len(fields) == 2 and fields[0].isnumeric() and fields[1].isnumeric():
+            if rank == 0 and len(fields) == 2 and fields[0].isnumeric() and fields[1].isnumeric():
                 # the first line might contain the number of embeddings and dimensionality of the vectors
                 continue
-            vec = [float(x) for x in fields[1:]]
             word = fields[0]
             if lower:
                 word = word.lower()
+            rank += 1
+            emb_dim = len(fields) - 1
+            if not _keep_embedding(word, rank - 1, vocab, top_n):
+                # skip the float conversion of words we are not interested in
+                continue
+            vec = [float(x) for x in fields[1:]]
             emb[word] = vec
         except ValueError:
             print("Error converting: {}".format(line))
 
     print("loaded pre-trained embeddings (word->emb_vec) size: {} (lower: {})".format(len(emb.keys()), lower), file=sys.stderr)
-    return emb, len(emb[word])
+    return emb, emb_dim
 
 def read_conllUD_file(location):
     current_words = []
@@ -97,7 +235,156 @@ def read_conll_file(file_name, raw=False):
     if current_tags != [] and not raw:
         yield (current_words, current_tags)
 
+
+def read_raw_file(file_name):
+    """
+    read a raw text file (one sentence per line, split by space) lazily; "-" reads stdin
+    :return: generator of lists of words (empty lines are skipped)
+    """
+    f = io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8') if file_name == "-" else codecs.open(file_name, encoding='utf-8')
+    for line in f:
+        words = line.split()
+        if words:
+            yield words
+
+
+def prefetch_chunks(items, chunk_size, max_pending=2):
+    """
+    the items in lists of (up to) chunk_size, produced by a background thread that reads at most
+    max_pending chunks ahead; errors of the producer are raised in the consumer
+    """
+    chunks = queue.Queue(maxsize=max_pending)
+
+    def produce():
+        try:
+            chunk = []
+            for item in items:
+                chunk.append(item)
+                if len(chunk) == chunk_size:
+                    chunks.put((chunk, None))
+                    chunk = []
+            if chunk:
+                chunks.put((chunk, None))
+            chunks.put((None, None))
+        except Exception as e:
+            chunks.put((None, e))
+
+    threading.Thread(target=produce, daemon=True).start()
+    while True:
+        chunk, error = chunks.get()
+        if error is not None:
+            raise error
+        if chunk is None:
+            return
+        yield chunk
+
     
+PREDICTION_FORMATS = ["legacy", "tsv", "conllu", "jsonl"]
+
+
+class PredictionWriter(object):
+    """
+    writes the predictions of a tagger sentence by sentence, in large buffered writes
+
+    formats:
+    - legacy: a block per reported output layer: word, gold tag (unless raw), predicted tag, probability (with probs)
+    - tsv: a line per token: word, gold tag (unless raw), prediction, probability (with probs), the tag of each
+      layer (with heads)
+    - conllu: the prediction as UPOS; gold tag, probability and layer tags (Gold=, Prob=, <layer>=) in MISC
+    - jsonl: a json object per sentence
+
+    the prediction is the tag of layer prediction_layer of layer_names (the reported output layers)
+    """
+    def __init__(self, out, tags, layer_names, prediction_layer=-1, output_format="legacy", probs=False, heads=False,
+                 raw=False, buffer_size=1 << 20):
+        if output_format not in PREDICTION_FORMATS:
+            raise ValueError("unknown prediction format: {}".format(output_format))
+        self.own_file = isinstance(out, str)
+        self.out = open(out, "w", encoding="utf-8", buffering=buffer_size) if self.own_file else out
+        self.tags = np.array(tags, dtype=object) # tag index -> tag
+        self.layer_names = layer_names
+        self.prediction_layer = prediction_layer % len(layer_names)
+        self.output_format = output_format
+        self.probs = probs
+        self.heads = heads
+        self.raw = raw
+        self.buffer_size = buffer_size
+        self.buffer = []
+        self.buffered = 0
+
+    def write(self, words, gold, predicted, confidences):
+        """
+        predicted, confidences: (reported layers x tokens) tag indices and their probabilities for one sentence;
+        gold is not written when None or with raw
+        """
+        if self.raw:
+            gold = None
+        tags = self.tags[predicted].tolist()
+        confidences = confidences.tolist()
+        text = getattr(self, "_format_" + self.output_format)(words, gold, tags, confidences)
+        self.buffer.append(text)
+        self.buffered += len(text)
+        if self.buffered >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        self.out.write("".join(self.buffer))
+        self.buffer, self.buffered = [], 0
+        self.out.flush()
+
+    def close(self):
+        self.flush()
+        if self.own_file:
+            self.out.close()
+
+    def _format_legacy(self, words, gold, tags, confidences):
+        lines = []
+        for layer_tags, layer_confidences in zip(tags, confidences):
+            for i, (w, p, c) in enumerate(zip(words, layer_tags, layer_confidences)):
+                if gold is None:
+                    lines.append(u"{}\t{}\n".format(w, p)) # do not print DUMMY tag when --raw is on
+                elif self.probs:
+                    lines.append(u"%s\t%s\t%s\t%.2f\n" % (w, gold[i], p, c))
+                else:
+                    lines.append(u"%s\t%s\t%s\n" % (w, gold[i], p))
+            lines.append(u"\n")
+        return u"".join(lines)
+
+    def _format_tsv(self, words, gold, tags, confidences):
+        columns = [words]
+        if gold is not None:
+            columns.append(gold)
+        columns.append(tags[self.prediction_layer])
+        if self.probs:
+            columns.append(["%.4f" % c for c in confidences[self.prediction_layer]])
+        if self.heads:
+            columns.extend(tags)
+        return u"".join(u"\t".join(token) + u"\n" for token in zip(*columns)) + u"\n"
+
+    def _format_conllu(self, words, gold, tags, confidences):
+        lines = []
+        for i, (w, p) in enumerate(zip(words, tags[self.prediction_layer])):
+            misc = []
+            if gold is not None:
+                misc.append(u"Gold=" + gold[i])
+            if self.probs:
+                misc.append(u"Prob=%.4f" % confidences[self.prediction_layer][i])
+            if self.heads:
+                misc.extend(u"{}={}".format(name, layer_tags[i]) for name, layer_tags in zip(self.layer_names, tags))
+            lines.append(u"{}\t{}\t_\t{}\t_\t_\t_\t_\t_\t{}\n".format(i + 1, w, p, u"|".join(misc) or u"_"))
+        return u"".join(lines) + u"\n"
+
+    def _format_jsonl(self, words, gold, tags, confidences):
+        sentence = {"words": words, "tags": tags[self.prediction_layer]}
+        if gold is not None:
+            sentence["gold"] = gold
+        if self.probs:
+            sentence["probs"] = [round(c, 4) for c in confidences[self.prediction_layer]]
+        if self.heads:
+            sentence["heads"] = dict(zip(self.layer_names, tags))
+        return json.dumps(sentence, ensure_ascii=False) + u"\n"
+
+
 if __name__=="__main__":
     allsents=[]
     unique_tokens=set()
@@ -6,6 +6,7 @@ import dynet
 import numpy as np
 
 import sys
+from collections import OrderedDict
 
 ## NN classes
 class SequencePredictor:
@@ -46,7 +47,37 @@ class BiRNNSequencePredictor(SequencePredictor):
         forward_sequence = f_init.transduce(f_inputs)
         backward_sequence = b_init.transduce(reversed(b_inputs))
         return forward_sequence, backward_sequence 
-        
+
+    def predict_last_states(self, lookup, sequences):
+        """
+        last forward and backward states of each index sequence (e.g. the char indices of all tokens
+        of a sentence) in one batched pass: the sequences are padded at the end, one lookup_batch per
+        time step, and the state of each sequence is picked at its true last step (before any padding)
+        """
+        sequences = [seq.tolist() if isinstance(seq, np.ndarray) else list(seq) for seq in sequences]
+        lengths = [len(seq) for seq in sequences]
+        max_len = max(lengths)
+        padded = [seq + [0] * (max_len - len(seq)) for seq in sequences]
+        rev_padded = [seq[::-1] + [0] * (max_len - len(seq)) for seq in sequences]
+        forward_states = self._batched_last_states(self.f_builder, lookup, padded, lengths)
+        backward_states = self._batched_last_states(self.b_builder, lookup, rev_padded, lengths)
+        return forward_states, backward_states
+
+    @staticmethod
+    def _batched_last_states(builder, lookup, padded, lengths):
+        ending_at = {}
+        for i, length in enumerate(lengths):
+            ending_at.setdefault(length - 1, []).append(i)
+        last_states = [None] * len(padded)
+        state = builder.initial_state()
+        for t in range(len(padded[0])):
+            state = state.add_input(dynet.lookup_batch(lookup, [seq[t] for seq in padded]))
+            if t in ending_at:
+                output = state.output()
+                for i in ending_at[t]:
+                    last_states[i] = dynet.pick_batch_elem(output, i)
+        return last_states
+
 
 class Layer:
     """ Class for affine layer transformation or two-layer MLP """
@@ -64,6 +95,9 @@ class Layer:
             mlp_dim = in_dim
         self.W = model.add_parameters((output_dim, mlp_dim))
         self.b = model.add_parameters((output_dim))
+
+    def parameters(self):
+        return [self.W, self.b, self.W_mlp, self.b_mlp] if self.mlp else [self.W, self.b]
         
     def __call__(self, x, soft_labels=False, temperature=None, dropout=0.0):
         if self.mlp:
@@ -86,3 +120,80 @@ class Layer:
             elems = dynet.exp(logits / temperature)
             return dynet.cdiv(elems, dynet.sum_elems(elems))
         return self.act(logits)
+
+
+class FusedLayers:
+    """
+    several Layers of identical shape evaluated at once: their parameters are stacked along DyNet's
+    batch dimension (one batch element per layer) and applied to a whole (in_dim x tokens) matrix
+    with one batched matrix multiplication per step
+    """
+    def __init__(self, layers, layer_ids):
+        self.layers = layers
+        self.layer_ids = layer_ids # position of each layer among the heads
+        self.act = layers[0].act
+        self.mlp = layers[0].mlp
+        self.mlp_activation = layers[0].mlp_activation if self.mlp else None
+
+    def __call__(self, x, dropouts=None, soft_labels=False, temperature=None):
+        """
+        x: (in_dim x tokens) matrix, shared by all layers or batched with one element per layer;
+        returns the (output_dim x tokens) outputs (a column per token), batched with one element per layer
+        """
+        logits = self.logits(x, dropouts=dropouts)
+        if soft_labels and temperature:
+            return dynet.softmax(logits / temperature)
+        return self.act(logits)
+
+    def logits(self, x, dropouts=None):
+        if self.mlp:
+            W_mlp = _stack_to_batch([dynet.parameter(layer.W_mlp) for layer in self.layers])
+            b_mlp = _stack_to_batch([dynet.parameter(layer.b_mlp) for layer in self.layers])
+            x = self.mlp_activation(dynet.affine_transform([b_mlp, W_mlp, x]))
+        if dropouts is None:
+            dropouts = [0.0] * len(self.layers)
+        W = _stack_to_batch([dynet.dropout(dynet.parameter(layer.W), dropout) if dropout else dynet.parameter(layer.W)
+                             for layer, dropout in zip(self.layers, dropouts)])
+        b = _stack_to_batch([dynet.parameter(layer.b) for layer in self.layers])
+        return dynet.affine_transform([b, W, x])
+
+
+def _stack_to_batch(expressions):
+    return dynet.concatenate_to_batch(expressions) if len(expressions) > 1 else expressions[0]
+
+
+class LRUCache:
+    """ least recently used cache with hit/miss statistics """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        value = self.entries.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+    def reset_stats(self):
+        self.hits, self.misses = 0, 0
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def __len__(self):
+        return len(self.entries)
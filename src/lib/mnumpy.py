@@ -0,0 +1,298 @@
+"""
+inference without DyNet: a tagger exported by qmtl.export_numpy (a model bundle with the parameters of
+the biRNNs, the char biRNN and the output heads) runs as batched numpy matrix operations
+
+the sentences of a batch (of the same length) go through the biRNNs together, the input projections
+of all time steps are one matrix product per builder, the heads of the same shape are one batched product
+
+usage: python -m lib.mnumpy MODEL.numpy.qmtl [FILE|-] tags raw text (one sentence per line)
+"""
+import argparse
+import sys
+from collections import OrderedDict, defaultdict
+
+import numpy as np
+
+from lib.mbundle import load_bundle, decode_vocabulary
+from lib.mio import read_raw_file, prefetch_chunks, PredictionWriter, PREDICTION_FORMATS
+
+NUMPY_FORMAT = "qmtl-numpy"
+
+UNK = "_UNK"
+
+# parameters of a layer of each builder, in the order of the builder's get_parameters()
+RNN_PARAMETER_NAMES = {
+    "lstm": ["x2i", "h2i", "b"], # dynet.VanillaLSTMBuilder: the gates i, f, o, g stacked
+    "lstmc": ["x2i", "h2i", "c2i", "bi", "x2o", "h2o", "c2o", "bo", "x2c", "h2c", "bc"],
+    "gru": ["x2z", "h2z", "bz", "x2r", "h2r", "br", "x2h", "h2h", "bh"],
+    "rnn": ["x2h", "h2h", "bh"],
+}
+
+VANILLA_LSTM_FORGET_BIAS = 1.0 # added to the forget gate by dynet.VanillaLSTMBuilder
+
+ACTIVATIONS = {
+    "tanh": np.tanh,
+    "rectify": lambda x: np.maximum(x, 0),
+}
+
+
+def _logistic(x):
+    return 0.5 * np.tanh(0.5 * x) + 0.5
+
+
+def _softmax(x, axis=-1):
+    e = np.exp(x - np.max(x, axis=axis, keepdims=True))
+    return e / np.sum(e, axis=axis, keepdims=True)
+
+
+def run_rnn(builder, params, inputs):
+    """
+    outputs of a one-layer RNN of the given builder type over inputs (time x batch x in_dim),
+    all sequences start from zero states like dynet's initial_state()
+    """
+    num_steps, batch_size = inputs.shape[:2]
+    flat = inputs.reshape(num_steps * batch_size, -1)
+    if builder == "lstm":
+        hidden = params["h2i"].shape[1]
+        projected = (flat @ params["x2i"].T + params["b"]).reshape(num_steps, batch_size, -1)
+        W_h = params["h2i"].T
+    elif builder == "lstmc":
+        hidden = params["h2i"].shape[1]
+        projected = (flat @ np.concatenate([params["x2i"], params["x2o"], params["x2c"]]).T
+                     + np.concatenate([params["bi"], params["bo"], params["bc"]])).reshape(num_steps, batch_size, -1)
+        W_h = np.concatenate([params["h2i"], params["h2o"], params["h2c"]]).T
+        W_ci, W_co = params["c2i"].T, params["c2o"].T
+    elif builder == "gru":
+        hidden = params["h2z"].shape[1]
+        projected = (flat @ np.concatenate([params["x2z"], params["x2r"], params["x2h"]]).T
+                     + np.concatenate([params["bz"], params["br"], params["bh"]])).reshape(num_steps, batch_size, -1)
+        W_h = np.concatenate([params["h2z"], params["h2r"]]).T
+        W_hh = params["h2h"].T
+    elif builder == "rnn":
+        hidden = params["h2h"].shape[1]
+        projected = (flat @ params["x2h"].T + params["bh"]).reshape(num_steps, batch_size, -1)
+        W_h = params["h2h"].T
+    else:
+        raise ValueError("unknown builder: {}".format(builder))
+
+    h = np.zeros((batch_size, hidden), dtype=projected.dtype)
+    c = np.zeros_like(h)
+    outputs = np.empty((num_steps, batch_size, hidden), dtype=projected.dtype)
+    for t in range(num_steps):
+        x_t = projected[t]
+        if builder == "lstm":
+            gates = x_t + h @ W_h
+            i = _logistic(gates[:, :hidden])
+            f = _logistic(gates[:, hidden:2 * hidden] + VANILLA_LSTM_FORGET_BIAS)
+            o = _logistic(gates[:, 2 * hidden:3 * hidden])
+            c = f * c + i * np.tanh(gates[:, 3 * hidden:])
+            h = o * np.tanh(c)
+        elif builder == "lstmc":
+            # coupled input and forget gates, peepholes (the output gate sees the new cell)
+            recurrent = h @ W_h
+            i = _logistic(x_t[:, :hidden] + recurrent[:, :hidden] + c @ W_ci)
+            c = (1 - i) * c + i * np.tanh(x_t[:, 2 * hidden:] + recurrent[:, 2 * hidden:])
+            o = _logistic(x_t[:, hidden:2 * hidden] + recurrent[:, hidden:2 * hidden] + c @ W_co)
+            h = o * np.tanh(c)
+        elif builder == "gru":
+            recurrent = h @ W_h
+            z = _logistic(x_t[:, :hidden] + recurrent[:, :hidden])
+            r = _logistic(x_t[:, hidden:2 * hidden] + recurrent[:, hidden:])
+            h_tilde = np.tanh(x_t[:, 2 * hidden:] + (r * h) @ W_hh)
+            h = (1 - z) * h + z * h_tilde
+        else:
+            h = np.tanh(x_t + h @ W_h)
+        outputs[t] = h
+    return outputs
+
+
+class NumpyTagger(object):
+    """
+    the inference part of an NNTagger (predict_distributions, tag_layers, tag_sentences) on exported parameters
+    """
+    def __init__(self, meta, tensors):
+        if meta.get("format") != NUMPY_FORMAT:
+            raise ValueError("not an exported numpy tagger")
+        self.builder = meta["builder"]
+        self.activation = ACTIVATIONS[meta["activation"]]
+        self.c_in_dim = meta["c_in_dim"]
+        self.h_layers = meta["h_layers"]
+        self.tasks_ids = meta["tasks_ids"]
+        self.task2tag2idx = meta["task2tag2idx"]
+        self.task_expected_at = meta["task_expected_at"]
+        self.predict_on_layer = meta["predict_on_layer"]
+        self.head_subset = meta.get("head_subset")
+        self.head_weights = meta.get("head_weights")
+        self.eval_batch_size = 64
+        self.w2i = decode_vocabulary(tensors["w2i.strings"], tensors["w2i.offsets"], tensors["w2i.indices"])
+        self.c2i = decode_vocabulary(tensors["c2i.strings"], tensors["c2i.offsets"], tensors["c2i.indices"])
+        self.wembeds = np.asarray(tensors["wembeds"])
+        self.cembeds = np.asarray(tensors["cembeds"]) if self.c_in_dim > 0 else None
+
+        def rnn_params(prefix):
+            return {name: np.asarray(tensors["{}.{}".format(prefix, name)]) for name in RNN_PARAMETER_NAMES[self.builder]}
+
+        self.inner = [(rnn_params("inner.{}.f".format(i)), rnn_params("inner.{}.b".format(i))) for i in range(self.h_layers)]
+        self.char_rnn = (rnn_params("char.f"), rnn_params("char.b")) if self.c_in_dim > 0 else None
+
+        # per task: the heads used for prediction, grouped by shape into stacked (heads x ...) parameters
+        self.head_groups = {}
+        for task_id, heads in meta["heads"].items():
+            head_ids = list(range(len(heads))) if self.head_subset is None else list(self.head_subset)
+            if self.predict_on_layer is not None:
+                head_ids = [self.predict_on_layer]
+            groups = OrderedDict()
+            for head_id in head_ids:
+                prefix = "{}.head{}.".format(task_id, head_id)
+                key = (heads[head_id]["mlp"], heads[head_id]["mlp_activation"], tensors[prefix + "W"].shape)
+                groups.setdefault(key, []).append(head_id)
+            self.head_groups[task_id] = []
+            for (mlp, mlp_activation, _), ids in groups.items():
+                names = ["W", "b", "W_mlp", "b_mlp"] if mlp else ["W", "b"]
+                stacked = {name: np.stack([tensors["{}.head{}.{}".format(task_id, head_id, name)] for head_id in ids])
+                           for name in names}
+                self.head_groups[task_id].append((ids, ACTIVATIONS[mlp_activation] if mlp else None, stacked))
+
+    @classmethod
+    def load(cls, path):
+        return cls(*load_bundle(path))
+
+    def get_features(self, words):
+        word_indices = [self.w2i.get(word, self.w2i[UNK]) for word in words]
+        char_indices = [self.get_char_indices(word) for word in words] if self.c_in_dim > 0 else []
+        return word_indices, char_indices
+
+    def get_char_indices(self, word):
+        unk = self.c2i[UNK]
+        return [self.c2i["<w>"]] + [self.c2i.get(char, unk) for char in word] + [self.c2i["</w>"]]
+
+    def char_states(self, sequences):
+        """
+        last forward and backward char biRNN states of each char index sequence (distinct sequences once)
+        """
+        keys = [tuple(seq) for seq in sequences]
+        unique_keys = list(dict.fromkeys(keys))
+        lengths = np.array([len(key) for key in unique_keys])
+        max_len = lengths.max()
+        padded = np.zeros((len(unique_keys), max_len), dtype=np.int64)
+        rev_padded = np.zeros_like(padded)
+        for k, key in enumerate(unique_keys):
+            padded[k, :len(key)] = key
+            rev_padded[k, :len(key)] = key[::-1]
+        last = (lengths - 1, np.arange(len(unique_keys)))
+        forward = run_rnn(self.builder, self.char_rnn[0], self.cembeds[padded.T])[last]
+        backward = run_rnn(self.builder, self.char_rnn[1], self.cembeds[rev_padded.T])[last]
+        position = {key: k for k, key in enumerate(unique_keys)}
+        rows = np.array([position[key] for key in keys])
+        return forward[rows], backward[rows]
+
+    def predict_distributions(self, batch_word_indices, batch_char_indices, task_id):
+        """
+        tag distributions of the heads used for prediction for a batch of sentences of the same length,
+        a float32 array of shape (heads, sentences, positions, tags) like NNTagger.predict_distributions
+        """
+        batch_size, sent_len = len(batch_word_indices), len(batch_word_indices[0])
+        # time major: (positions x sentences x features)
+        features = self.wembeds[np.array(batch_word_indices, dtype=np.int64).T]
+        if self.c_in_dim > 0:
+            tokens = [chars_of_token for char_indices in batch_char_indices for chars_of_token in char_indices]
+            forward, backward = self.char_states(tokens)
+            forward = forward.reshape(batch_size, sent_len, -1).transpose(1, 0, 2)
+            backward = backward.reshape(batch_size, sent_len, -1).transpose(1, 0, 2)
+            features = np.concatenate([features, forward, backward], axis=2)
+
+        # the same sequence operations as NNTagger.predict_batch: the backward outputs are in reversed order
+        prev, prev_rev = features, features
+        for i, (f_params, b_params) in enumerate(self.inner):
+            forward_sequence = run_rnn(self.builder, f_params, prev)
+            backward_sequence = run_rnn(self.builder, b_params, prev_rev[::-1])
+            if i > 0:
+                forward_sequence = self.activation(forward_sequence)
+                backward_sequence = self.activation(backward_sequence)
+            if i == self.task_expected_at[task_id] - 1:
+                concat = np.concatenate([forward_sequence, backward_sequence[::-1]], axis=2)
+                # a row per token, token t of sentence b at b * sent_len + t
+                x = concat.transpose(1, 0, 2).reshape(batch_size * sent_len, -1)
+                return self._heads(x, task_id).reshape(-1, batch_size, sent_len, len(self.task2tag2idx[task_id]))
+            prev, prev_rev = forward_sequence, backward_sequence
+        raise ValueError("task {} is not predicted at any layer".format(task_id))
+
+    def _heads(self, x, task_id):
+        head_values = []
+        for ids, mlp_activation, stacked in self.head_groups[task_id]:
+            x_in = x[None]
+            if mlp_activation is not None:
+                x_in = mlp_activation(np.matmul(x_in, stacked["W_mlp"].transpose(0, 2, 1)) + stacked["b_mlp"][:, None])
+            logits = np.matmul(x_in, stacked["W"].transpose(0, 2, 1)) + stacked["b"][:, None]
+            head_values.extend(zip(ids, _softmax(logits)))
+        head_values.sort(key=lambda head_value: head_value[0])
+        return np.stack([values for _, values in head_values]).astype(np.float32)
+
+    def with_average(self, distributions):
+        if self.head_weights is not None and self.predict_on_layer is None:
+            if len(self.head_weights) != len(distributions):
+                raise ValueError("{} head weights for {} heads".format(len(self.head_weights), len(distributions)))
+            weights = np.asarray(self.head_weights, dtype=np.float32)
+            average = np.tensordot(weights / weights.sum(), distributions, axes=1).astype(np.float32)
+            return np.concatenate([distributions, average[None]])
+        average = distributions[0].copy()
+        for head_distributions in distributions[1:]:
+            average += head_distributions
+        average /= np.float32(len(distributions))
+        return np.concatenate([distributions, average[None]])
+
+    def tag_layers(self, sentences, task_id="task0"):
+        """ like NNTagger.tag_layers """
+        by_length = defaultdict(list)
+        for i, words in enumerate(sentences):
+            by_length[len(words)].append(i)
+        results = [None] * len(sentences)
+        for indices in by_length.values():
+            for start in range(0, len(indices), self.eval_batch_size):
+                batch = indices[start:start + self.eval_batch_size]
+                batch_word_indices, batch_char_indices = zip(*[self.get_features(sentences[i]) for i in batch])
+                layers = self.with_average(self.predict_distributions(batch_word_indices, batch_char_indices, task_id))
+                predicted, confidences = np.argmax(layers, axis=3), np.max(layers, axis=3)
+                for b, i in enumerate(batch):
+                    results[i] = (predicted[:, b], confidences[:, b])
+        return results
+
+    def tag_sentences(self, sentences, task_id="task0"):
+        """ like NNTagger.tag_sentences """
+        tag2idx = self.task2tag2idx[task_id]
+        i2t = np.array(sorted(tag2idx, key=tag2idx.get), dtype=object)
+        return [{"heads": i2t[predicted[:-1]].tolist(), "qmtl": i2t[predicted[-1]].tolist()}
+                for predicted, _ in self.tag_layers(sentences, task_id)]
+
+    def prediction_writer(self, out, task_id, output_format="legacy", probs=False, heads=False):
+        out_indices = [head_id for ids, _, _ in self.head_groups[task_id] for head_id in ids]
+        layer_names = ["head{}".format(head_id) for head_id in sorted(out_indices)] + ["qmtl"]
+        tag2idx = self.task2tag2idx[task_id]
+        return PredictionWriter(out, sorted(tag2idx, key=tag2idx.get), layer_names,
+                                0 if self.predict_on_layer is not None else -1,
+                                output_format=output_format, probs=probs, heads=heads, raw=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="tag raw text (one sentence per line) with an exported tagger, without DyNet")
+    parser.add_argument("model", help="exported tagger (see --export-numpy of qmtl.py)")
+    parser.add_argument("input", nargs="?", default="-", help="raw text file [default: stdin]")
+    parser.add_argument("--task", default="task0")
+    parser.add_argument("--output-format", choices=PREDICTION_FORMATS, default="legacy")
+    parser.add_argument("--output-heads", action="store_true", default=False)
+    parser.add_argument("--batch-size", type=int, default=64, help="max number of sentences tagged in one pass [default: 64]")
+    parser.add_argument("--chunk-size", type=int, default=1000, help="sentences read and tagged at a time [default: 1000]")
+    args = parser.parse_args()
+
+    tagger = NumpyTagger.load(args.model)
+    tagger.eval_batch_size = args.batch_size
+    writer = tagger.prediction_writer(sys.stdout, args.task, args.output_format, heads=args.output_heads)
+    for chunk in prefetch_chunks(read_raw_file(args.input), args.chunk_size):
+        for words, (predicted, confidences) in zip(chunk, tagger.tag_layers(chunk, args.task)):
+            writer.write(words, None, predicted, confidences)
+        writer.flush()
+    writer.close()
+
+
+if __name__ == "__main__":
+    main()
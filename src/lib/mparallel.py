@@ -0,0 +1,254 @@
+"""
+helper processes for training:
+- data-parallel training: worker processes hold replicas of a model and are synchronized by parameter averaging
+- background evaluation of parameter snapshots
+
+the parameters are exchanged through memory-mapped files (flat float32 vectors),
+the queues only carry the work orders and the results
+"""
+import multiprocessing
+import os
+import queue
+import shutil
+import sys
+import tempfile
+import traceback
+
+import dynet
+import numpy as np
+
+
+def model_parameters(model):
+    """ parameters and lookup parameters of a dynet ParameterCollection, in a fixed order """
+    return model.parameters_list() + model.lookup_parameters_list()
+
+
+def parameter_size(model):
+    return sum(int(np.prod(param.shape())) for param in model_parameters(model))
+
+
+def get_parameter_vector(model, out):
+    """ copy all parameters of the model into the flat vector out """
+    offset = 0
+    for param in model_parameters(model):
+        values = param.as_array()
+        out[offset:offset + values.size] = values.ravel()
+        offset += values.size
+    return out
+
+
+def set_parameter_vector(model, vector):
+    """ set all parameters of the model from the flat vector """
+    values = []
+    offset = 0
+    for param in model_parameters(model):
+        shape = param.shape()
+        size = int(np.prod(shape))
+        values.append(np.reshape(vector[offset:offset + size], shape))
+        offset += size
+    set_parameter_values(model, values)
+
+
+def set_parameter_values(model, values):
+    """ set the parameters of the model from a list of arrays (in the order of model_parameters) """
+    for param, param_values in zip(model_parameters(model), values):
+        param_values = np.asarray(param_values, dtype=np.float32).reshape(param.shape())
+        if isinstance(param, dynet.LookupParameters):
+            param.init_from_array(param_values)
+        else:
+            param.set_value(param_values)
+
+
+class ParameterAveragingPool(object):
+    """
+    master side: every round, each worker starts from the parameters of the master model, trains on its
+    shard and writes back its replica; the master model is then set to the average of the replicas
+
+    usage: pool = ParameterAveragingPool(n, model); store what the workers need in pool.work_dir;
+    pool.start(worker_main, args); pool.run_round(shards) ...; pool.close()
+    worker_main(worker, *args) is called in the worker processes with a ParameterAveragingWorker
+    """
+    def __init__(self, num_workers, model):
+        self.num_workers = num_workers
+        self.model = model
+        self.work_dir = tempfile.mkdtemp(prefix="qmtl-workers-")
+        size = parameter_size(model)
+        self.master = np.lib.format.open_memmap(os.path.join(self.work_dir, "master.npy"), mode="w+",
+                                                dtype=np.float32, shape=(size,))
+        self.replicas = np.lib.format.open_memmap(os.path.join(self.work_dir, "replicas.npy"), mode="w+",
+                                                  dtype=np.float32, shape=(num_workers, size))
+        self.processes = []
+
+    def start(self, worker_main, args=()):
+        # spawn: fork does not go well with DyNet's allocated memory
+        context = multiprocessing.get_context("spawn")
+        self.orders = [context.Queue() for _ in range(self.num_workers)]
+        self.results = context.Queue()
+        for worker_id in range(self.num_workers):
+            process = context.Process(target=_run_worker, daemon=True,
+                                      args=(ParameterAveragingWorker, worker_main, worker_id, self.work_dir,
+                                            self.orders[worker_id], self.results, args))
+            process.start()
+            self.processes.append(process)
+        print("started {} training workers".format(self.num_workers), file=sys.stderr)
+
+    def run_round(self, shards, **order):
+        """
+        train one shard per worker (empty shards are skipped) and average the replicas into the model;
+        order holds further (picklable) data for the workers; returns the statistics of the workers
+        """
+        get_parameter_vector(self.model, self.master)
+        self.master.flush()
+        active = [worker_id for worker_id, shard in enumerate(shards) if len(shard)]
+        for worker_id in active:
+            self.orders[worker_id].put(dict(order, shard=shards[worker_id]))
+        stats = {}
+        for _ in active:
+            worker_id, ok, result = self.results.get()
+            if not ok:
+                self.close()
+                raise RuntimeError("training worker {} failed:\n{}".format(worker_id, result))
+            stats[worker_id] = result
+        set_parameter_vector(self.model, self.replicas[active].mean(axis=0))
+        return [stats[worker_id] for worker_id in active]
+
+    def close(self):
+        if self.work_dir is None:
+            return
+        for orders in getattr(self, "orders", []):
+            orders.put(None)
+        for process in self.processes:
+            process.join(timeout=10)
+            if process.is_alive():
+                process.terminate()
+        self.processes = []
+        del self.master, self.replicas
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+        self.work_dir = None
+
+
+class ParameterAveragingWorker(object):
+    """
+    worker side: serve(model, train_shard) loads the master parameters into the model, calls
+    train_shard(order) for every work order and writes the trained parameters to its replica slot
+    """
+    def __init__(self, worker_id, work_dir, orders, results):
+        self.worker_id = worker_id
+        self.work_dir = work_dir
+        self.orders = orders
+        self.results = results
+        self.master = np.load(os.path.join(work_dir, "master.npy"), mmap_mode="r")
+        self.replicas = np.load(os.path.join(work_dir, "replicas.npy"), mmap_mode="r+")
+
+    def serve(self, model, train_shard):
+        while True:
+            order = self.orders.get()
+            if order is None:
+                break
+            set_parameter_vector(model, self.master)
+            stats = train_shard(order)
+            get_parameter_vector(model, self.replicas[self.worker_id])
+            self.replicas.flush()
+            self.results.put((self.worker_id, True, stats))
+
+
+class SnapshotEvaluator(object):
+    """
+    master side of a background process that evaluates parameter snapshots of a model: submit() copies
+    the current parameters into a free snapshot slot and returns at once, the results come back in order
+
+    usage like ParameterAveragingPool; worker_main(worker, *args) gets a SnapshotEvaluatorWorker
+    """
+    def __init__(self, model, num_slots=1):
+        self.model = model
+        self.work_dir = tempfile.mkdtemp(prefix="qmtl-evaluator-")
+        self.snapshots = np.lib.format.open_memmap(os.path.join(self.work_dir, "snapshots.npy"), mode="w+",
+                                                   dtype=np.float32, shape=(num_slots, parameter_size(model)))
+        self.free_slots = list(range(num_slots))
+        self.pending = [] # tags of the submitted snapshots, oldest first
+        self.finished = [] # results collected by submit, not yet returned by collect
+        self.process = None
+
+    def start(self, worker_main, args=()):
+        context = multiprocessing.get_context("spawn")
+        self.orders = context.Queue()
+        self.results = context.Queue()
+        self.process = context.Process(target=_run_worker, daemon=True,
+                                       args=(SnapshotEvaluatorWorker, worker_main, 0, self.work_dir,
+                                             self.orders, self.results, args))
+        self.process.start()
+
+    def num_pending(self):
+        return len(self.pending)
+
+    def submit(self, tag=None):
+        """ evaluate the current parameters in the background; blocks only if all slots are in use """
+        while not self.free_slots:
+            self.finished.extend(self._receive(block=True))
+        slot = self.free_slots.pop(0)
+        get_parameter_vector(self.model, self.snapshots[slot])
+        self.snapshots.flush()
+        self.orders.put((slot, tag))
+        self.pending.append(tag)
+
+    def collect(self, block=False):
+        """ the (tag, result) pairs of the finished evaluations; with block, waits for at least one """
+        finished, self.finished = self.finished, []
+        finished.extend(self._receive(block=block and not finished))
+        return finished
+
+    def _receive(self, block):
+        received = []
+        while self.pending:
+            try:
+                worker_id, ok, result = self.results.get(block=block and not received)
+            except queue.Empty:
+                break
+            if not ok:
+                self.close()
+                raise RuntimeError("evaluation process failed:\n{}".format(result))
+            slot, tag, value = result
+            self.free_slots.append(slot)
+            self.pending.pop(0)
+            received.append((tag, value))
+        return received
+
+    def close(self):
+        if self.work_dir is None:
+            return
+        if self.process is not None:
+            self.orders.put(None)
+            self.process.join(timeout=10)
+            if self.process.is_alive():
+                self.process.terminate()
+        del self.snapshots
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+        self.work_dir = None
+
+
+class SnapshotEvaluatorWorker(object):
+    """
+    evaluator side: serve(model, evaluate) loads each submitted snapshot into the model and sends back evaluate()
+    """
+    def __init__(self, worker_id, work_dir, orders, results):
+        self.worker_id = worker_id
+        self.work_dir = work_dir
+        self.orders = orders
+        self.results = results
+        self.snapshots = np.load(os.path.join(work_dir, "snapshots.npy"), mmap_mode="r")
+
+    def serve(self, model, evaluate):
+        while True:
+            order = self.orders.get()
+            if order is None:
+                break
+            slot, tag = order
+            set_parameter_vector(model, self.snapshots[slot])
+            self.results.put((self.worker_id, True, (slot, tag, evaluate())))
+
+
+def _run_worker(worker_class, worker_main, worker_id, work_dir, orders, results, args):
+    try:
+        worker_main(worker_class(worker_id, work_dir, orders, results), *args)
+    except Exception:
+        results.put((worker_id, False, traceback.format_exc()))
@@ -0,0 +1,109 @@
+"""
+PTA operations on the output heads relative to the best one on dev:
+G copies the best head into the others, P perturbs their weights, H jitters their dropout rates
+
+the heads' parameters are read once into stacked (heads x ...) arrays, every operation works on all heads
+at once and the changed heads are written back; the time spent in each operation is recorded
+"""
+import sys
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import numpy as np
+
+
+class PTAEngine(object):
+    """
+    applies the PTA operations configured in pta_params (G, P, H, D, D-Lower, D-Upper) to a list of
+    output Layers; pta_params['D'] (the per head dropout rates) is updated in place
+    """
+    def __init__(self, pta_params):
+        self.pta_params = pta_params
+        self.timings = OrderedDict() # operation -> [calls, seconds]
+
+    @contextmanager
+    def timed(self, operation):
+        start = time.perf_counter()
+        yield
+        timing = self.timings.setdefault(operation, [0, 0.0])
+        timing[0] += 1
+        timing[1] += time.perf_counter() - start
+
+    def update(self, layers, best, excluded=()):
+        """
+        G/P/H on all heads but the best one and the excluded ones (out of training); G only reaches the heads
+        with the shape of the best one
+        """
+        targets = [i for i in range(len(layers)) if i != best and i not in excluded]
+        if not targets:
+            return
+        if self.pta_params['G'] or self.pta_params['P']:
+            changed = set()
+            for group in _group_by_shape(layers):
+                if not self.pta_params['P'] and best not in group:
+                    continue
+                with self.timed("read"):
+                    stacked = _read_stacked(layers, group)
+                group_targets = [position for position, i in enumerate(group) if i in targets]
+                if self.pta_params['G'] and best in group:
+                    with self.timed("copy"):
+                        best_position = group.index(best)
+                        for values in stacked.values():
+                            values[group_targets] = values[best_position]
+                        dropouts = self.pta_params['D']
+                        for position in group_targets:
+                            dropouts[group[position]] = dropouts[best]
+                    changed.update(group[position] for position in group_targets)
+                if self.pta_params['P']:
+                    with self.timed("perturb"):
+                        # isotropic gaussian noise with variance P on every weight
+                        W = stacked["W"]
+                        W[group_targets] += np.random.normal(0.0, np.sqrt(self.pta_params['P']),
+                                                             size=W[group_targets].shape).astype(W.dtype)
+                    changed.update(group[position] for position in group_targets)
+                with self.timed("write"):
+                    _write_stacked(layers, group, stacked, [i for i in group if i in changed])
+
+        if self.pta_params['H']:
+            with self.timed("dropout"):
+                self.jitter_dropouts(targets)
+
+    def jitter_dropouts(self, targets):
+        dropouts = self.pta_params['D']
+        noise = np.random.normal(0, self.pta_params['H'], size=len(targets))
+        for i, noise_i in zip(targets, noise.tolist()):
+            noised_dropout = dropouts[i] + noise_i
+            if noised_dropout >= self.pta_params['D-Upper'] or noised_dropout < self.pta_params['D-Lower']:
+                print("Omitting dropout of %f in head %d" % (noised_dropout, i), file=sys.stderr, flush=True)
+                continue
+            dropouts[i] += noise_i
+
+    def timing_report(self):
+        return ", ".join("{}: {} x {:.1f} ms".format(operation, calls, 1000 * seconds / calls)
+                         for operation, (calls, seconds) in self.timings.items())
+
+
+def _parameter_names(layer):
+    return ["W", "b", "W_mlp", "b_mlp"] if layer.mlp else ["W", "b"]
+
+
+def _group_by_shape(layers):
+    """ head indices grouped by the shapes of their parameters """
+    groups = OrderedDict()
+    for i, layer in enumerate(layers):
+        key = tuple(getattr(layer, name).shape() for name in _parameter_names(layer))
+        groups.setdefault(key, []).append(i)
+    return list(groups.values())
+
+
+def _read_stacked(layers, group):
+    return OrderedDict((name, np.stack([getattr(layers[i], name).as_array() for i in group]))
+                       for name in _parameter_names(layers[group[0]]))
+
+
+def _write_stacked(layers, group, stacked, heads):
+    for position, i in enumerate(group):
+        if i in heads:
+            for name, values in stacked.items():
+                getattr(layers[i], name).set_value(values[position])
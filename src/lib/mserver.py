@@ -0,0 +1,202 @@
+"""
+tagging service: a long-running http server around a loaded tagger
+
+concurrent requests are grouped into micro-batches by a single tagging thread (the tagger is not thread-safe):
+a batch is tagged when it holds max_batch_size sentences or max_latency seconds after its first request arrived
+
+POST /tag  {"sentences": [["a", "tokenized", "sentence"], ...]} or {"text": "one sentence per line"}
+GET /stats latency percentiles and throughput counters
+"""
+import json
+import queue
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+
+class MicroBatcher(object):
+    """
+    tag_batch(sentences) is called in the tagging thread with the sentences of several requests and returns
+    one result per sentence; submit(sentences) returns a Future of the results of the request's sentences
+    """
+    def __init__(self, tag_batch, max_batch_size=64, max_latency=0.005, stats=None):
+        self.tag_batch = tag_batch
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.stats = stats
+        self.requests = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, sentences):
+        future = Future()
+        self.requests.put((sentences, future, time.perf_counter()))
+        return future
+
+    def close(self):
+        self.requests.put(None)
+        self.thread.join()
+
+    def _next_batch(self):
+        """ the requests of the next batch (None when closed); at least one request, blocks for the first """
+        first = self.requests.get()
+        if first is None:
+            return None
+        batch, size = [first], len(first[0])
+        deadline = time.perf_counter() + self.max_latency
+        while size < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                request = self.requests.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if request is None:
+                self.requests.put(None) # close after this batch
+                break
+            batch.append(request)
+            size += len(request[0])
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                break
+            sentences = [sentence for request_sentences, _, _ in batch for sentence in request_sentences]
+            try:
+                results = self.tag_batch(sentences) if sentences else []
+            except Exception as e:
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+            done = time.perf_counter()
+            offset = 0
+            for request_sentences, future, arrival in batch:
+                future.set_result(results[offset:offset + len(request_sentences)])
+                offset += len(request_sentences)
+                if self.stats is not None:
+                    self.stats.add_request(done - arrival, len(request_sentences),
+                                           sum(len(sentence) for sentence in request_sentences))
+            if self.stats is not None:
+                self.stats.add_batch()
+
+
+class ServingStats(object):
+    """
+    request counters and the latencies (seconds, arrival to result) of the last window_size requests
+    """
+    def __init__(self, window_size=10000):
+        self.start = time.time()
+        self.latencies = deque(maxlen=window_size)
+        self.requests = 0
+        self.sentences = 0
+        self.tokens = 0
+        self.batches = 0
+        self.lock = threading.Lock()
+
+    def add_request(self, latency, num_sentences, num_tokens):
+        with self.lock:
+            self.latencies.append(latency)
+            self.requests += 1
+            self.sentences += num_sentences
+            self.tokens += num_tokens
+
+    def add_batch(self):
+        with self.lock:
+            self.batches += 1
+
+    def report(self):
+        with self.lock:
+            latencies = np.array(self.latencies, dtype=np.float64)
+            uptime = time.time() - self.start
+            report = {"uptime_seconds": round(uptime, 3),
+                      "requests": self.requests,
+                      "sentences": self.sentences,
+                      "tokens": self.tokens,
+                      "batches": self.batches,
+                      "sentences_per_batch": self.sentences / self.batches if self.batches else 0.0,
+                      "requests_per_second": self.requests / uptime,
+                      "tokens_per_second": self.tokens / uptime}
+        for percentile in (50, 90, 99):
+            report["latency_p{}_ms".format(percentile)] = \
+                float(np.percentile(latencies, percentile)) * 1000 if len(latencies) else None
+        return report
+
+
+def _request_sentences(request):
+    if "sentences" in request:
+        sentences = request["sentences"]
+        if not all(isinstance(sentence, list) and sentence and all(isinstance(token, str) for token in sentence)
+                   for sentence in sentences):
+            raise ValueError("sentences must be non-empty lists of tokens")
+        return sentences
+    if "text" in request:
+        return [line.split() for line in request["text"].splitlines() if line.strip()]
+    raise ValueError("a request holds either sentences or text")
+
+
+def make_handler(batcher, stats, timeout=60):
+    class TaggingHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            if self.path == "/stats":
+                self._reply(200, stats.report())
+            else:
+                self._reply(404, {"error": "not found"})
+
+        def do_POST(self):
+            if self.path != "/tag":
+                self._reply(404, {"error": "not found"})
+                return
+            try:
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                sentences = _request_sentences(json.loads(body.decode("utf-8")))
+            except (ValueError, TypeError, AttributeError) as e:
+                self._reply(400, {"error": str(e)})
+                return
+            try:
+                results = batcher.submit(sentences).result(timeout=timeout)
+            except Exception as e:
+                self._reply(500, {"error": str(e)})
+                return
+            self._reply(200, {"sentences": results})
+
+        def _reply(self, status, content):
+            body = json.dumps(content, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass # per-request logging would dominate the latency; see /stats
+
+    return TaggingHandler
+
+
+def serve(address, tag_batch, max_batch_size=64, max_latency=0.005):
+    """
+    serve tag_batch on address (host, port) until interrupted
+    """
+    stats = ServingStats()
+    batcher = MicroBatcher(tag_batch, max_batch_size, max_latency, stats)
+    server = ThreadingHTTPServer(address, make_handler(batcher, stats))
+    server.daemon_threads = True
+    print("tagging server listening on http://{}:{}".format(*server.server_address), file=sys.stderr, flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        batcher.close()
+        print("tagging server stopped: {}".format(json.dumps(stats.report())), file=sys.stderr)
@@ -13,15 +13,29 @@ import numpy as np
 import os
 import pickle
 import dynet
-import codecs
 import heterogenious_output_utils
 import json
+import shutil
+import tempfile
 
 from sklearn.model_selection import train_test_split
 
-from collections import Counter, defaultdict, Sequence
-from lib.mnnl import FFSequencePredictor, Layer, RNNSequencePredictor, BiRNNSequencePredictor
-from lib.mio import read_conll_file, read_conllUD_file, load_embeddings_file
+from collections import Counter, OrderedDict, defaultdict, Sequence
+from lib.mnnl import FFSequencePredictor, Layer, RNNSequencePredictor, BiRNNSequencePredictor, LRUCache
+from lib.mio import read_conll_file, read_conllUD_file, load_embeddings_file, read_vocabulary, read_raw_file, prefetch_chunks, \
+    PredictionWriter, PREDICTION_FORMATS
+from lib.mcorpus import IndexedCorpus, IndexedCorpusBuilder, corpus_cache_path, mapping_digest, \
+    load_corpus_cache, save_corpus_cache, encode_strings, decode_strings
+from lib.mparallel import ParameterAveragingPool, SnapshotEvaluator, model_parameters, set_parameter_values
+from lib.mbundle import save_bundle, load_bundle, encode_vocabulary, decode_vocabulary
+from lib.mpta import PTAEngine
+from lib.mcheckpoint import CheckpointWriter, get_rng_state, set_rng_state
+from lib.mserver import serve
+from lib.mnumpy import NumpyTagger, NUMPY_FORMAT, RNN_PARAMETER_NAMES
+from lib.mdistill import SoftTargets, soft_targets_cache_path
+from lib.mheads import greedy_head_selection, HeadPruner
+from lib.mensemble import DYNET_DEFAULT_MEM, EnsembleAccumulator, member_concurrency, run_member_processes, \
+    save_member_meta, load_member_distributions
 from itertools import product
 import logging
 
@@ -29,6 +43,9 @@ UNK = "_UNK"
 
 PREDICT_ON_LAYER = None
 
+MODEL_SUFFIX = ".qmtl" # single-file model bundle
+CHECKPOINT_SUFFIX = ".checkpoint" + MODEL_SUFFIX # resumable training state, see NNTagger.fit
+
 
 from lib.mmappers import TRAINER_MAP, ACTIVATION_MAP, INITIALIZER_MAP, BUILDERS
 
@@ -41,6 +58,11 @@ def dump_frobenius_values(tagger):
     print("Fro W: %s" % '\t'.join([str(num) for num in fro_W]), file=sys.stderr)
 
 
+def _chunks(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
 def main():
     parser = argparse.ArgumentParser(description="""Run the NN tagger""")
     parser.add_argument("--train", nargs='*', help="train folder for each task") # allow multiple train files, each asociated with a task = position in the list
@@ -48,16 +70,25 @@ def main():
     parser.add_argument("--model", help="load model from file", required=False)
     parser.add_argument("--iters", help="training iterations [default: 30]", required=False,type=int,default=30)
     parser.add_argument("--in_dim", help="input dimension [default: 64] (like Polyglot embeds)", required=False,type=int,default=64)
+    parser.add_argument("--char-cache-size", help="number of word types whose char biRNN states are cached at inference time [default: 0=disabled]", required=False, type=int, default=0)
     parser.add_argument("--c_in_dim", help="input dimension for character embeddings [default: 100]", required=False,type=int,default=100)
     parser.add_argument("--h_dim", help="hidden dimension [default: 100]", required=False,type=int,default=100)
     parser.add_argument("--h_layers", help="number of stacked LSTMs [default: 1 = no stacking]", required=False,type=int,default=1)
     parser.add_argument("--test", nargs='*', help="test file(s)", required=False) # should be in the same order/task as train
-    parser.add_argument("--raw", help="if test file is in raw format (one sentence per line)", required=False, action="store_true", default=False)
+    parser.add_argument("--raw", help="if test file is in raw format (one sentence per line), - reads stdin (one model only, not with ensembles); raw text is tagged as it is read and the predictions are written to stdout unless --output is given (ensembles: only with --output)", required=False, action="store_true", default=False)
+    parser.add_argument("--raw-chunk-size", help="sentences read and tagged at a time with --raw [default: 1000]", default=1000, type=int)
     parser.add_argument("--dev", help="dev file(s)", required=False)
     parser.add_argument("--output", help="output predictions to file", required=False,default=None)
     parser.add_argument("--output-probs", help="output prediction probs to file (last column)", required=False, default=None)
-    parser.add_argument("--save", help="save model to file (appends .model as well as .pickle)",default=None)
+    parser.add_argument("--output-format", help="format of the predictions written to --output [default: legacy]", choices=PREDICTION_FORMATS, default="legacy")
+    parser.add_argument("--output-heads", help="output the tags of each reported output layer as well (tsv, conllu, jsonl)", required=False, action="store_true", default=False)
+    parser.add_argument("--save", help="save model to file (appends .qmtl)",default=None)
+    parser.add_argument("--convert-model", help="convert a model saved in the legacy format (.model and .params.pickle) to a .qmtl bundle and exit", default=None)
     parser.add_argument("--embeds", help="word embeddings file", required=False, default=None)
+    parser.add_argument("--embeds-cache", help="folder for the binary (memory-mapped) cache of the embeddings file [default: disabled]", required=False, default=None)
+    parser.add_argument("--embeds-vocab", help="which pre-trained embeddings to add to the vocabulary: all of them or only the words of the train/dev/test files [default: all]", choices=["all", "corpus"], default="all")
+    parser.add_argument("--corpus-cache", help="folder for the on-disk cache of indexed train/dev/test files [default: disabled]", required=False, default=None)
+    parser.add_argument("--embeds-top-n", help="(also) keep the first N (most frequent) pre-trained embeddings [default: no limit]", required=False, default=None, type=int)
     parser.add_argument("--sigma", help="noise sigma", required=False, default=0.2, type=float)
     parser.add_argument("--ac", help="activation function [rectify, tanh, ...]", default="tanh", choices=ACTIVATION_MAP.keys())
     parser.add_argument("--mlp", help="use MLP layer of this dimension [default 0=disabled]", required=False, default=0, type=int)
@@ -65,6 +96,8 @@ def main():
     parser.add_argument("--trainer", help="trainer [default: sgd]", required=False, choices=TRAINER_MAP.keys(), default="sgd")
     parser.add_argument("--learning-rate", help="learning rate [0: use default]", default=0, type=float) # see: http://dynet.readthedocs.io/en/latest/optimizers.html
     parser.add_argument("--patience", help="patience [default: 0=not used], requires specification of --dev and model path --save", required=False, default=0, type=int)
+    parser.add_argument("--checkpoint-every", help="write a resumable checkpoint (MODEL.checkpoint.qmtl, in the background) after every epoch and every N updates [default: not used, 0=after every epoch], requires --save", required=False, default=None, type=int)
+    parser.add_argument("--resume", help="continue training from the checkpoint of --save (same data and training options)", required=False, action="store_true", default=False)
     parser.add_argument("--log-losses", help="log loss (for each task if multiple active)", required=False, action="store_true", default=False)
     parser.add_argument("--word-dropout-rate", help="word dropout rate [default: 0.25], if 0=disabled, recommended: 0.25 (Kipperwasser & Goldberg, 2016)", required=False, default=0.25, type=float)
     parser.add_argument("--label-noise", help="amount of label noise to be applied [default: 0.0]", required=False, default=0.0, type=float)
@@ -73,7 +106,24 @@ def main():
     parser.add_argument("--dynet-mem", help="memory for dynet (needs to be first argument!)", required=False, type=int)
     parser.add_argument("--dynet-gpus", help="1 for GPU usage", default=0, type=int) # warning: non-deterministic results on GPU https://github.com/clab/dynet/issues/399
     parser.add_argument("--dynet-autobatch", help="if 1 enable autobatching", default=0, type=int)
-    parser.add_argument("--minibatch-size", help="size of minibatch for autobatching (1=disabled)", default=1, type=int)
+    parser.add_argument("--eval-batch-size", help="max number of sentences (of the same length) tagged in one pass at evaluation time [default: 64]", default=64, type=int)
+    parser.add_argument("--serve", help="serve the --model as a tagging service on HOST:PORT (POST /tag, GET /stats) instead of testing", default=None)
+    parser.add_argument("--serve-batch-size", help="max number of sentences tagged together by the service [default: 64]", default=64, type=int)
+    parser.add_argument("--serve-window", help="max milliseconds the service waits for more requests to batch with the first one [default: 5]", default=5.0, type=float)
+    parser.add_argument("--distill-from", help="train a single-head student of this (multi-head) teacher model on its averaged soft targets", default=None)
+    parser.add_argument("--distill-temperature", help="temperature of the soft targets and the student's softmax [default: 2.0]", default=2.0, type=float)
+    parser.add_argument("--distill-alpha", help="weight of the gold tags in the student's loss [default: 0.0=soft targets only]", default=0.0, type=float)
+    parser.add_argument("--distill-h-dim", help="h_dim of the student [default: 0=--h_dim]", default=0, type=int)
+    parser.add_argument("--distill-cache", help="folder of the cached soft targets [default: next to the teacher]", default=None)
+    parser.add_argument("--prune-heads", help="during training, take heads out whose dev accuracy stays more than this below the Q-MTL average (e.g. 0.01) for --prune-patience epochs; requires --dev", default=None, type=float)
+    parser.add_argument("--prune-patience", help="epochs a head may lag behind before it is pruned [default: 2]", default=2, type=int)
+    parser.add_argument("--prune-mode", help="remove: pruned heads are not computed any more and not saved; freeze: they still predict but are not trained [default: remove]", choices=("remove", "freeze"), default="remove")
+    parser.add_argument("--select-heads", help="after training (or loading), choose the smallest set of heads whose average keeps the --dev accuracy within this tolerance (e.g. 0.001); the model is saved with it and only these heads are computed", default=None, type=float)
+    parser.add_argument("--select-heads-weighted", help="with --select-heads: heads can be chosen several times, the average is weighted", action="store_true", default=False)
+    parser.add_argument("--export-numpy", help="export the --model for inference without DyNet (lib/mnumpy.py) to this file and exit; the export is checked on the first --test file", default=None)
+    parser.add_argument("--workers", help="number of training processes (data-parallel, replicas are averaged) [default: 1]", default=1, type=int)
+    parser.add_argument("--sync-every", help="minibatches each worker trains on between two parameter averagings [default: 50]", default=50, type=int)
+    parser.add_argument("--minibatch-size", help="number of sentences (of the same length) per training batch (1=disabled)", default=1, type=int)
 
     parser.add_argument("--save-embeds", help="save word embeddings file", required=False, default=None)
     parser.add_argument("--disable-backprob-embeds", help="disable backprob into embeddings (default is to update)", required=False, action="store_false", default=True)
@@ -86,6 +136,10 @@ def main():
     parser.add_argument("--num-out-layers", help="redundant layer number at the end of the model", type=int,
                         default=5)
     parser.add_argument("--model-to-run", help="redundant layer number at the end of the model", type=str, default=None)
+    parser.add_argument("--ensemble-jobs", help="cores for training/testing the members of --model-to-run ensemble in parallel [default: 1=one member after the other]", type=int, default=1)
+    parser.add_argument("--ensemble-mem-budget", help="memory (MB) for the parallel ensemble members, each needs --dynet-mem (times --workers) [default: 0=no limit]", type=int, default=0)
+    parser.add_argument("--ensemble-member", help=argparse.SUPPRESS, type=int, default=None) # internal: run only this member
+    parser.add_argument("--ensemble-dump", help=argparse.SUPPRESS, default=None) # internal: where the member stores its test distributions
     parser.add_argument("--training-cutoff", help="what (1/x) portion of the training data is used (default: 1)", type=int, default=1)
     parser.add_argument("--output-builder-query", help="accepts queries with the given form: (activ unit1_num1)xnum_out1 (activ unit2_num2)xnum_out2 ; [WARNING: overrides mlp, ac-mlp and num-out-layers]", type=str, default=None)
 
@@ -104,9 +158,16 @@ def main():
     parser.add_argument('--pta-G', type=int, default=0)
 
     parser.add_argument('--pta-M', type=int, default=-1)
+    parser.add_argument('--pta-M-Async', type=int, default=0, help="1: evaluate the PTA snapshots in a background process while training goes on")
+    parser.add_argument('--pta-M-Lag', type=int, default=1, help="max number of PTA evaluations in flight with --pta-M-Async (training waits beyond that)")
+    parser.add_argument('--pta-M-Sample', type=int, default=0, help="PTA decides on a fixed random sample of this many dev sentences [default: 0=all]")
 
     args = parser.parse_args()
 
+    if args.convert_model:
+        convert_model(args.convert_model)
+        return
+
     output_builder_query = args.output_builder_query if args.output_builder_query else "(%s %d)x%d" % (
         args.ac_mlp, args.mlp, args.num_out_layers)
 
@@ -118,13 +179,59 @@ def main():
 
     if args.model_to_run == 'ensemble':
             models = range(args.num_out_layers)
+            if args.ensemble_member is not None:
+                models = [args.ensemble_member]
     elif args.model_to_run:
         models = [None if args.model_to_run=="all" else int(args.model_to_run)]
     else:
         models = [None]
         models.extend(range(heterogenious_output_utils.get_output_number(output_builder_query)))
 
-    ensembled_predictions = []
+    # options of a run that are not stored with the model
+    runtime_options = {"corpus_cache": args.corpus_cache,
+                       "char_cache_size": args.char_cache_size,
+                       "eval_batch_size": args.eval_batch_size}
+
+    teacher, soft_targets = None, None
+    if args.distill_from:
+        if not args.train or len(args.train) != 1 or args.workers > 1:
+            print("distillation requires one training file (--train) and one worker")
+            exit()
+        teacher = load(args.distill_from, **runtime_options)
+        soft_targets = distillation_targets(teacher, args.distill_from, args.train[0], args.distill_temperature, args.distill_cache)
+        # the student: one head like the teacher's (first) prediction head, optionally smaller
+        mlp_activation, mlp = heterogenious_output_utils.get_layer_params(teacher.output_builder_query)[teacher.predict_on_layer or 0]
+        output_builder_query = "({} {})x1".format(mlp_activation, mlp)
+        if args.distill_h_dim:
+            args.h_dim = args.distill_h_dim
+        models = [None]
+        print("distilling {} into a single head ({}, h_dim {})".format(args.distill_from, output_builder_query, args.h_dim), file=sys.stderr)
+
+    if args.raw and args.test and "-" in args.test:
+        # stdin can be read once: by one model, not by several or by ensemble members that reread the last test file
+        if args.model_to_run == 'ensemble' or len(models) > 1 or args.test.count("-") > 1:
+            print("--raw reads stdin (-) only once: use a file with --model-to-run ensemble or several models")
+            exit()
+
+    if args.select_heads is not None:
+        if not args.dev:
+            print("--select-heads requires a dev set (--dev)")
+            exit()
+        if None not in models:
+            print("--select-heads only applies to the model of all heads (--model-to-run all), it is ignored", file=sys.stderr)
+
+    if args.prune_heads is not None:
+        if not args.dev:
+            print("--prune-heads requires a dev set (--dev)")
+            exit()
+        if None not in models:
+            print("--prune-heads only applies to the model of all heads (--model-to-run all), it is ignored", file=sys.stderr)
+
+    ensemble_accumulator = None # summed distributions of the members on the (last) test file
+    ensemble_i2t = None
+    if args.model_to_run == 'ensemble' and args.ensemble_member is None and args.ensemble_jobs > 1 and args.test:
+        ensemble_accumulator, ensemble_i2t, org_X, org_Y = run_ensemble_members(args, models)
+        models = [] # done
     seed = [args.dynet_seed]
     for current_model, seed in product(models, seed):
         if args.output is not None:
@@ -157,14 +264,19 @@ def main():
         if args.c_in_dim == 0:
             print(">>> disable character embeddings <<<", file=sys.stderr)
 
-        if args.minibatch_size > 1:
-            raise NotImplementedError("Minibatch running is currently not supported")
-
         if args.patience:
             if not args.dev or not args.save:
                 print("patience requires a dev set and model path (--dev and --save)")
                 exit()
 
+        if (args.checkpoint_every is not None or args.resume) and not args.save:
+            print("checkpoints require a model path (--save)")
+            exit()
+
+        if args.resume and not os.path.exists(save_model + CHECKPOINT_SUFFIX):
+            print("no checkpoint to resume from: {}".format(save_model + CHECKPOINT_SUFFIX))
+            exit()
+
         if args.save:
             # check if folder exists
             if os.path.isdir(save_model):
@@ -183,11 +295,26 @@ def main():
             if args.model_to_run == 'ensemble':
                 model_to_load = model_to_load.replace('ensemble', str(current_model))
             print("loading model from file {}".format(model_to_load), file=sys.stderr)
-            tagger = load(model_to_load, args.embeds)
+            tagger = load(model_to_load, args.embeds, args.embeds_cache, **runtime_options)
 
             if args.get_model_norm:
                 dump_frobenius_values(tagger)
                 exit()
+
+            if args.export_numpy:
+                export_numpy(tagger, args.export_numpy)
+                if args.test:
+                    test_X, _, _, _, task_labels = tagger.get_data_as_indices(args.test[0], "task0", raw=args.raw)
+                    max_diff, dynet_time, numpy_time = verify_numpy_export(tagger, NumpyTagger.load(args.export_numpy),
+                                                                           test_X, task_labels)
+                    print("numpy export check: max difference of the distributions {:.2e}, "
+                          "dynet {:.2f} seconds, numpy {:.2f} seconds".format(max_diff, dynet_time, numpy_time), file=sys.stderr)
+                return
+
+            if args.serve:
+                host, port = args.serve.rsplit(":", 1)
+                serve((host, int(port)), tagger.tag_sentences, args.serve_batch_size, args.serve_window / 1000)
+                return
         else:
             pta_params = defaultdict()
             pta_params['I'] = args.pta_I == 1
@@ -197,15 +324,27 @@ def main():
             pta_params['H'] = args.pta_H
             pta_params['G'] = args.pta_G == 1
             pta_params['M'] = args.pta_M
+            pta_params['M-Async'] = args.pta_M_Async == 1
+            pta_params['M-Lag'] = args.pta_M_Lag
+            pta_params['M-Sample'] = args.pta_M_Sample
             pta_params['D-Lower'] = args.pta_D_Lower
             pta_params['D-Upper'] = args.pta_D_Upper
 
+            embeds_vocab = None
+            if args.embeds and args.embeds_vocab == "corpus":
+                # train words are added when the vocabulary is built in fit
+                embeds_vocab = read_vocabulary([args.dev] if args.dev and os.path.exists(args.dev) else [])
+                embeds_vocab.update(read_vocabulary([test for test in args.test or [] if test != "-"], raw=args.raw))
+
             tagger = NNTagger(args.in_dim,
                               args.h_dim,
                               args.c_in_dim,
                               args.h_layers,
                               args.pred_layer,
                               embeds_file=args.embeds,
+                              embeds_cache=args.embeds_cache,
+                              embeds_vocab=embeds_vocab,
+                              embeds_top_n=args.embeds_top_n,
                               activation=ACTIVATION_MAP[args.ac],
                               noise_sigma=args.sigma,
                               learning_algo=args.trainer,
@@ -217,6 +356,7 @@ def main():
                               predict_on_layer=current_model,
                               output_builder_query=output_builder_query,
                               pta_params=pta_params,
+                              **runtime_options
                               )
 
         start = time.time()
@@ -224,15 +364,25 @@ def main():
             tagger.fit(args.train, args.iters, args.training_cutoff,
                        dev=args.dev, word_dropout_rate=args.word_dropout_rate,
                        model_path=save_model, patience=args.patience, minibatch_size=args.minibatch_size,
-                       log_losses=args.log_losses, label_noise=args.label_noise, build_cg=True)
+                       log_losses=args.log_losses, label_noise=args.label_noise, build_cg=True,
+                       num_workers=args.workers, sync_every=args.sync_every,
+                       checkpoint_every=args.checkpoint_every, resume=args.resume, soft_targets=soft_targets,
+                       distill_temperature=args.distill_temperature, distill_alpha=args.distill_alpha,
+                       prune_heads=args.prune_heads if current_model is None else None, prune_patience=args.prune_patience, prune_mode=args.prune_mode)
             print(("Done. Training took {0:.2f} seconds.".format(time.time()-start)),file=sys.stderr)
 
             if args.save and not args.patience:  # in case patience is active it gets saved in the fit function
                 save(tagger, save_model)
-                tagger = load(save_model, args.embeds)
+                tagger = load(save_model, args.embeds, args.embeds_cache, **runtime_options)
 
             if args.patience:
-                tagger = load(save_model, args.embeds)
+                tagger = load(save_model, args.embeds, args.embeds_cache, **runtime_options)
+
+        if args.select_heads is not None and tagger.predict_on_layer is None:
+            dev_X, dev_Y, _, _, dev_task_labels = tagger.get_data_as_indices(args.dev, "task0")
+            tagger.select_heads(dev_X, dev_Y, dev_task_labels, args.select_heads, args.select_heads_weighted)
+            if save_model or args.model:
+                save(tagger, save_model or model_to_load)
 
         if args.test and len(args.test) != 0:
             if not args.model:
@@ -243,22 +393,46 @@ def main():
             start = time.time()
             for i, test in enumerate(args.test):
 
-                if args.output is not None and args.model_to_run != 'ensemble':
-                    file_pred = "{}.{}_task{}".format(args.output, 'all' if current_model is None else current_model, i)
-                    sys.stdout = codecs.open(file_pred, 'w', encoding='utf-8')
+                prediction_writer = None
+                if args.output is not None or (args.raw and args.model_to_run != 'ensemble'):
+                    file_pred = sys.stdout
+                    if args.output is not None and args.model_to_run != 'ensemble':
+                        file_pred = "{}.{}_task{}".format(args.output, 'all' if current_model is None else current_model, i)
+                    prediction_writer = tagger.prediction_writer(file_pred, "task"+str(i), args.output_format,
+                                                                 probs=args.output_probs, heads=args.output_heads, raw=args.raw)
 
                 sys.stderr.write('\nTesting Task'+str(i)+'\n')
                 sys.stderr.write('*******\n')
+                if args.raw and not (args.model_to_run == 'ensemble' and i == len(args.test) - 1):
+                    # nothing to score: tagged chunk by chunk as the text is read, in constant memory
+                    num_sentences = tagger.tag_raw_stream(test, prediction_writer, args.raw_chunk_size, "task"+str(i))
+                    if prediction_writer is not None:
+                        prediction_writer.close()
+                    print(("[{}] Done. Tagged {} sentences in {:.2f} seconds.".format(i, num_sentences, time.time()-start)), file=sys.stderr)
+                    continue
                 test_X, test_Y, org_X, org_Y, task_labels = tagger.get_data_as_indices(test, "task"+str(i), raw=args.raw)
-                correct_list, total_list, predictions = tagger.evaluate(test_X, test_Y, org_X, org_Y, task_labels,
-                                                 output_predictions=args.output, output_probs=args.output_probs, raw=args.raw, get_predictions_array=args.model_to_run=='ensemble')
-
-                if args.model_to_run=='ensemble':
-                    if current_model==0:
-                        ensembled_predictions = [np.array(p) for p in predictions[current_model]]
+                accumulator = None
+                if args.model_to_run == 'ensemble' and i == len(args.test) - 1:
+                    if args.ensemble_member is not None:
+                        # a member run by run_ensemble_members: its distributions go to its own dump
+                        accumulator = EnsembleAccumulator(test_X.sent_offsets, len(tagger.task2tag2idx["task0"]),
+                                                          path=args.ensemble_dump + ".npy")
                     else:
-                        for pi, p in enumerate(predictions[current_model]):
-                            ensembled_predictions[pi] += np.array(p)
+                        if ensemble_accumulator is None:
+                            ensemble_accumulator = EnsembleAccumulator(test_X.sent_offsets, len(tagger.task2tag2idx["task0"]))
+                        accumulator = ensemble_accumulator
+                correct_list, total_list = tagger.evaluate(test_X, test_Y, org_X, org_Y, task_labels,
+                                                           prediction_writer=prediction_writer, ensemble_accumulator=accumulator)
+                if prediction_writer is not None:
+                    prediction_writer.close()
+
+                if accumulator is not None and args.ensemble_member is not None:
+                    i2t = {idx: tag for tag, idx in tagger.task2tag2idx["task0"].items()}
+                    save_member_meta(args.ensemble_dump, i2t, test_X.sent_offsets)
+                    accumulator.close()
+
+                if teacher is not None and not args.raw:
+                    compare_teacher_student(teacher, tagger, test, "task"+str(i))
 
                 if not args.raw:
                     test_accuracy = "\t".join(["%.4f"%(0 if total==0 else correct/total) for correct, total in zip(correct_list, total_list)])
@@ -281,31 +455,90 @@ def main():
         if args.save_embeds:
             tagger.save_embeds(args.save_embeds)
 
-    if args.model_to_run=='ensemble':
+    if args.model_to_run=='ensemble' and args.ensemble_member is None and ensemble_accumulator is not None:
         task_id = "task0"
-        ensemble_file_pred = None
-        correct, total = 0, 0
+        i2t = ensemble_i2t or {tagger.task2tag2idx[task_id][t] : t for t in tagger.task2tag2idx[task_id].keys()}
+        tags = np.array([i2t[i] for i in range(len(i2t))], dtype=object)
+        predicted_tags = tags[ensemble_accumulator.predictions()]
+        gold_tags = np.array([tag for etalon_tags_per_sentence in org_Y for tag in etalon_tags_per_sentence], dtype=object)
+        correct, total = int(np.sum(predicted_tags == gold_tags)), len(gold_tags)
         if args.output:
-            ensemble_file_pred = open("{}.ensemble_{}".format(args.output, task_id), "w")
-        for pred_per_sentence, tokens_per_sentence, etalon_tags_per_sentence in zip(ensembled_predictions, org_X, org_Y):
-            i2t = {tagger.task2tag2idx[task_id][t] : t for t in tagger.task2tag2idx[task_id].keys()}
-            predicted_tags = np.argmax(pred_per_sentence, axis=1)
-            if ensemble_file_pred:
-                for tok, gold, pred_id in zip(tokens_per_sentence, etalon_tags_per_sentence, predicted_tags):
-                    total += 1
-                    correct += 1 if gold == i2t[pred_id] else 0
-                    ensemble_file_pred.write("{}\t{}\t{}\n".format(tok, gold, i2t[pred_id]))
-            ensemble_file_pred.write('\n')
-        if ensemble_file_pred:
-            ensemble_file_pred.close()
-        print(args.output, correct / total)
-
-
-def load(model_path, embeds_file=None):
+            sent_offsets = ensemble_accumulator.sent_offsets
+            with open("{}.ensemble_{}".format(args.output, task_id), "w") as ensemble_file_pred:
+                for i, tokens_per_sentence in enumerate(org_X):
+                    start, end = sent_offsets[i], sent_offsets[i + 1]
+                    ensemble_file_pred.write("".join("{}\t{}\t{}\n".format(tok, gold, pred) for tok, gold, pred in
+                                                     zip(tokens_per_sentence, gold_tags[start:end], predicted_tags[start:end])))
+                    ensemble_file_pred.write('\n')
+        ensemble_accumulator.close()
+        print(args.output, 0 if total == 0 else correct / total)
+
+
+def run_ensemble_members(args, members):
+    """
+    train and test the ensemble members in parallel processes (this script with --ensemble-member),
+    within the core (--ensemble-jobs) and memory (--ensemble-mem-budget) budget; every member keeps
+    the seed and save path it has in the sequential loop, the test distributions are summed in member order
+
+    returns the EnsembleAccumulator with the summed distributions, the tag mapping and the test sentences
+
+    the members and this process all read the test files, stdin ("-") cannot be shared among them
     """
-    load a model from file; specify the .model file, it assumes the *pickle file in the same location
+    if "-" in args.test:
+        raise ValueError("ensemble members cannot read the test data from stdin (-), use a file")
+    member_cores = max(args.workers, 1)
+    member_mem = (args.dynet_mem or DYNET_DEFAULT_MEM) * member_cores
+    max_parallel = member_concurrency(args.ensemble_jobs, args.ensemble_mem_budget, member_mem, member_cores)
+    print("running {} ensemble members, {} at a time".format(len(members), max_parallel), file=sys.stderr)
+
+    dump_dir = tempfile.mkdtemp(prefix="qmtl-ensemble-")
+    dumps = [os.path.join(dump_dir, "member{}".format(member)) for member in members]
+    stdout_files = [dump + ".out" for dump in dumps]
+    commands = [[sys.executable, os.path.abspath(__file__)] + sys.argv[1:] +
+                ["--ensemble-member", str(member), "--ensemble-dump", dump] for member, dump in zip(members, dumps)]
+    exit_codes = run_member_processes(commands, stdout_files, max_parallel)
+
+    # the output of the members, in the order of the sequential run
+    for stdout_file in stdout_files:
+        with open(stdout_file, encoding="utf-8") as f:
+            sys.stdout.write(f.read())
+    failed = [member for member, exit_code in zip(members, exit_codes) if exit_code != 0]
+    if failed:
+        shutil.rmtree(dump_dir, ignore_errors=True)
+        print("ensemble members failed: {}".format(failed), file=sys.stderr)
+        sys.exit(1)
+
+    ensemble_accumulator = None
+    for dump in dumps:
+        distributions, i2t, sent_offsets = load_member_distributions(dump)
+        if ensemble_accumulator is None:
+            ensemble_accumulator = EnsembleAccumulator(sent_offsets, len(i2t))
+        ensemble_accumulator.add_all(distributions)
+        del distributions
+    shutil.rmtree(dump_dir, ignore_errors=True)
+
+    org_X, org_Y = [], []
+    for words, tags in read_conll_file(args.test[-1], raw=args.raw):
+        org_X.append(words)
+        org_Y.append(tags)
+    return ensemble_accumulator, i2t, org_X, org_Y
+
+
+def load(model_path, embeds_file=None, embeds_cache=None, legacy=False, **runtime_options):
     """
-    myparams = pickle.load(open(model_path+".params.pickle", "rb"))
+    load a model from file: the bundle model_path + MODEL_SUFFIX, or the legacy format
+    (model_path + .model and .params.pickle), which is read even if there is a bundle with legacy
+    runtime_options (caches, batch sizes, training settings) are passed on to the NNTagger, they are not stored with the model
+
+    the parameters are only shaped from the stored sizes before the stored values overwrite them, the embeddings
+    file is not read (every pre-trained vector used in training is stored with the model); embeds_file and
+    embeds_cache are only kept for training the loaded tagger further (see below)
+    """
+    start = time.time()
+    if not legacy and os.path.exists(model_path + MODEL_SUFFIX):
+        myparams, parameter_values = read_model_bundle(model_path + MODEL_SUFFIX)
+    else:
+        myparams, parameter_values = pickle.load(open(model_path+".params.pickle", "rb")), None
     query = myparams["output_builder_query"] if "output_builder_query" in myparams \
         else "(%s %d)x%d" % (myparams["activation_mlp"].__name__, myparams["mlp"], myparams["out_num"])
     tagger = NNTagger(myparams["in_dim"],
@@ -319,60 +552,288 @@ def load(model_path, embeds_file=None):
                       predict_on_layer=myparams["predict_on_layer"],
                       output_builder_query=query,
                       pta_params= myparams['pta_params'],
+                      **runtime_options
                       )
     if embeds_file:
+        # not used here: read by load_embeddings when fit rebuilds the graph of the loaded tagger
+        # (--model with --train, build_cg=True) from the new training data
         tagger.embeds_file = embeds_file
+        tagger.embeds_cache = embeds_cache
+        # every pre-trained word that was used in training is in the stored w2i already
+        tagger.embeds_vocab = set()
     tagger.set_indices(myparams["w2i"],myparams["c2i"],myparams["task2tag2idx"])
+    tagger.head_subset, tagger.head_weights = myparams.get("head_subset"), myparams.get("head_weights")
+    tagger.pruned_heads, tagger.frozen_heads = myparams.get("pruned_heads", []), myparams.get("frozen_heads", [])
     tagger.predictors, tagger.char_rnn, tagger.wembeds, tagger.cembeds = \
         tagger.build_computation_graph(myparams["num_words"],
-                                       myparams["num_chars"])
+                                       myparams["num_chars"],
+                                       init_embeddings=False)
 
-    tagger.model.populate(model_path+".model")
+    if parameter_values is None:
+        tagger.model.populate(model_path+".model")
+    else:
+        set_parameter_values(tagger.model, parameter_values)
 
-    print("model loaded: {}".format(model_path), file=sys.stderr)
+    print("model loaded: {} ({:.2f} seconds)".format(model_path, time.time() - start), file=sys.stderr)
     return tagger
 
 
-def save(nntagger, model_path):
+def data_parallel_worker(worker, options):
+    """
+    training process of NNTagger.fit with several workers: a replica of the model trains on the minibatches it is sent
+    """
+    seed = options["seed"] + worker.worker_id
+    np.random.seed(seed)
+    random.seed(seed)
+    dynet.reset_random_seed(seed)
+
+    tagger = load(os.path.join(worker.work_dir, "model"), learning_algo=options["learning_algo"],
+                  learning_rate=options["learning_rate"], backprob_embeds=options["backprob_embeds"],
+                  noise_sigma=options["noise_sigma"])
+    tagger.freeze_parameters()
+    arrays, _ = load_corpus_cache(os.path.join(worker.work_dir, "train"))
+    train_X = IndexedCorpus.from_arrays(arrays)
+    task_labels = [tagger.tasks_ids[task] for task in arrays["task_labels"]]
+    widCount = arrays.get("wid_count")
+
+    def train_shard(order):
+        tagger.pta_params['D'] = order["dropouts"]
+        if order["pruned_heads"] != tagger.pruned_heads or order["frozen_heads"] != tagger.frozen_heads:
+            tagger.deactivate_heads(order["pruned_heads"], order["frozen_heads"])
+        stats = []
+        for batch in order["shard"]:
+            stats.append(tagger.train_batch(batch, train_X, train_X.tags, task_labels, widCount,
+                                            options["word_dropout_rate"], options["label_noise"]))
+            tagger.update_parameters()
+        return stats
+
+    worker.serve(tagger.model, train_shard)
+
+
+def pta_evaluation_worker(worker, options):
+    """
+    background process of asynchronous PTA: evaluates parameter snapshots of the model on the PTA dev sentences
+    """
+    tagger = load(os.path.join(worker.work_dir, "model"), eval_batch_size=options["eval_batch_size"])
+    arrays, _ = load_corpus_cache(os.path.join(worker.work_dir, "dev"))
+    dev_X = IndexedCorpus.from_arrays(arrays)
+    task_labels = [tagger.tasks_ids[task] for task in arrays["task_labels"]]
+
+    def evaluate():
+        correct_list, total_list = tagger.evaluate(dev_X, dev_X.tags, None, None, task_labels, verbose=False)
+        return correct_list, total_list
+
+    worker.serve(tagger.model, evaluate)
+
+
+def save(nntagger, model_path, keep_pruned=False):
     """
-    save a model; dynet only saves the parameters, need to store the rest separately
+    save a model as a single-file bundle (model_path + MODEL_SUFFIX): the settings as json metadata,
+    the vocabularies and all parameters as contiguous arrays; the heads removed in training are dropped
+    unless keep_pruned
     """
-    modelname = model_path + ".model"
+    modelname = model_path + MODEL_SUFFIX
+    save_bundle(modelname, *model_bundle(nntagger, keep_pruned))
+    print("model stored: {}".format(modelname), file=sys.stderr)
 
-    open(modelname, "w").close()
 
-    for param in nntagger.model.parameters_list() + nntagger.model.lookup_parameters_list():
-        param.save(modelname, append=True)
+def model_bundle(nntagger, keep_pruned=False):
+    """
+    the settings and arrays save writes for a model; the parameter arrays are copies
+
+    the heads removed in training (pruned_heads) are dropped and the other heads renumbered, with keep_pruned
+    (checkpoints, worker processes) all parameters are kept and the heads out of training are part of the settings
+    """
+    parameters = model_parameters(nntagger.model)
 
     myparams = {"num_words": len(nntagger.w2i),
                 "num_chars": len(nntagger.c2i),
+                "num_parameters": len(parameters),
                 "tasks_ids": nntagger.tasks_ids,
-                "w2i": nntagger.w2i,
-                "c2i": nntagger.c2i,
                 "task2tag2idx": nntagger.task2tag2idx,
-                "activation": nntagger.activation,
+                "activation": _name_in(ACTIVATION_MAP, nntagger.activation),
                 "in_dim": nntagger.in_dim,
                 "h_dim": nntagger.h_dim,
                 "c_in_dim": nntagger.c_in_dim,
                 "h_layers": nntagger.h_layers,
                 "embeds_file": nntagger.embeds_file,
                 "pred_layer": nntagger.pred_layer,
-                "builder": nntagger.builder,
+                "builder": _name_in(BUILDERS, nntagger.builder),
                 "predict_on_layer": nntagger.predict_on_layer,
+                "head_subset": nntagger.head_subset,
+                "head_weights": nntagger.head_weights,
                 "output_builder_query": nntagger.output_builder_query,
                 "pta_params": nntagger.pta_params,
                 }
-    pickle.dump(myparams, open( model_path+".params.pickle", "wb" ) )
-    print("model stored: {}".format(modelname), file=sys.stderr)
+    if keep_pruned:
+        myparams.update(pruned_heads=nntagger.pruned_heads, frozen_heads=nntagger.frozen_heads)
+    elif nntagger.pruned_heads:
+        kept, head_settings = _without_pruned_heads(nntagger)
+        dropped = {param.name() for output_predictors in nntagger.predictors["output_layers_dict"].values()
+                   for head_id in nntagger.pruned_heads for param in output_predictors[head_id].network_builder.parameters()}
+        parameters = [param for param in parameters if param.name() not in dropped]
+        layers = heterogenious_output_utils.get_layer_params(nntagger.output_builder_query)
+        pta_params = defaultdict(None, nntagger.pta_params)
+        if isinstance(pta_params['D'], list):
+            pta_params['D'] = [pta_params['D'][head_id] for head_id in kept]
+        myparams.update(head_settings, num_parameters=len(parameters), pta_params=pta_params,
+                        output_builder_query=heterogenious_output_utils.layers_to_query([layers[head_id] for head_id in kept]))
+    tensors = OrderedDict()
+    for name, mapping in (("w2i", nntagger.w2i), ("c2i", nntagger.c2i)):
+        tensors[name + ".strings"], tensors[name + ".offsets"], tensors[name + ".indices"] = encode_vocabulary(mapping)
+    for i, param in enumerate(parameters):
+        tensors["param.{}".format(i)] = param.as_array().astype(np.float32, copy=False)
+    return myparams, tensors
+
+
+def _without_pruned_heads(nntagger):
+    """
+    the heads that are not removed and the settings naming heads (predict_on_layer, head_subset, head_weights)
+    renumbered to them
+    """
+    kept = [head_id for head_id in range(nntagger.out_num) if head_id not in nntagger.pruned_heads]
+    new_ids = {head_id: i for i, head_id in enumerate(kept)}
+    settings = {"predict_on_layer": new_ids.get(nntagger.predict_on_layer), "head_subset": None, "head_weights": None}
+    if nntagger.head_subset is not None:
+        weights = nntagger.head_weights or [1] * len(nntagger.head_subset)
+        selected = [(new_ids[head_id], weight) for head_id, weight in zip(nntagger.head_subset, weights) if head_id in new_ids]
+        settings["head_subset"] = [head_id for head_id, _ in selected] or None
+        settings["head_weights"] = [weight for _, weight in selected] if nntagger.head_weights is not None and selected else None
+    return kept, settings
+
+
+def read_model_bundle(bundle_file):
+    """
+    settings (as stored by the legacy format) and parameter arrays (memory-mapped) of a model bundle
+    """
+    meta, tensors = load_bundle(bundle_file)
+    myparams = dict(meta)
+    myparams["activation"] = ACTIVATION_MAP[meta["activation"]]
+    myparams["builder"] = BUILDERS[meta["builder"]]
+    myparams["pta_params"] = defaultdict(None, meta["pta_params"])
+    for name in ("w2i", "c2i"):
+        myparams[name] = decode_vocabulary(tensors[name + ".strings"], tensors[name + ".offsets"], tensors[name + ".indices"])
+    return myparams, [tensors["param.{}".format(i)] for i in range(meta["num_parameters"])]
+
+
+def convert_model(model_path):
+    """
+    convert a model in the legacy format (.model and .params.pickle) to a bundle
+    """
+    for legacy_file in (model_path + ".model", model_path + ".params.pickle"):
+        if not os.path.exists(legacy_file):
+            raise IOError("no model in the legacy format: {} does not exist".format(legacy_file))
+    # an existing bundle is replaced (atomically) only once the legacy model is loaded
+    save(load(model_path, legacy=True), model_path)
+
+
+def distillation_targets(teacher, teacher_path, train_file, temperature, cache_dir=None):
+    """
+    the soft targets of the teacher for train_file, computed once and cached in cache_dir (default: next to the teacher)
+    """
+    teacher_file = teacher_path + MODEL_SUFFIX if os.path.exists(teacher_path + MODEL_SUFFIX) else teacher_path + ".model"
+    cache_file = soft_targets_cache_path(cache_dir or os.path.dirname(os.path.abspath(teacher_path)), train_file,
+                                         teacher_file, temperature, teacher.predict_on_layer)
+    if not os.path.exists(cache_file):
+        start = time.time()
+        teacher.soft_targets(train_file, "task0", temperature).save(cache_file)
+        print("teacher soft targets computed in {:.2f} seconds: {}".format(time.time() - start, cache_file), file=sys.stderr)
+    return SoftTargets.load(cache_file)
+
+
+def compare_teacher_student(teacher, student, test_file, task_id):
+    """
+    accuracy (of each tagger's prediction) and tagging speed of a teacher and its distilled student on a test file
+    """
+    for name, tagger in (("teacher", teacher), ("student", student)):
+        test_X, test_Y, org_X, org_Y, task_labels = tagger.get_data_as_indices(test_file, task_id)
+        start = time.time()
+        correct_list, total_list = tagger.evaluate(test_X, test_Y, org_X, org_Y, task_labels, verbose=False)
+        seconds = time.time() - start
+        out_indices, prediction_layer = tagger.reported_layers()
+        correct, total = correct_list[out_indices[prediction_layer]], total_list[out_indices[prediction_layer]]
+        print("distillation {}: accuracy {:.4f}, {:.1f} sentences/sec ({} output layers, h_dim {})".format(
+            name, 0 if total == 0 else correct / total, len(test_X) / seconds, tagger.out_num, tagger.h_dim), file=sys.stderr)
+
+
+def export_numpy(nntagger, path):
+    """
+    export the inference part of a model (embeddings, biRNNs, char biRNN, output heads) as a bundle for
+    lib/mnumpy.NumpyTagger, which does not need DyNet
+    """
+    builder = _name_in(BUILDERS, nntagger.builder)
+    kept, head_settings = _without_pruned_heads(nntagger)
+    meta = {"format": NUMPY_FORMAT,
+            "builder": builder,
+            "activation": _name_in(ACTIVATION_MAP, nntagger.activation),
+            "c_in_dim": nntagger.c_in_dim,
+            "h_layers": nntagger.h_layers,
+            "tasks_ids": nntagger.tasks_ids,
+            "task2tag2idx": nntagger.task2tag2idx,
+            "task_expected_at": nntagger.predictors["task_expected_at"],
+            "heads": {}}
+    meta.update(head_settings)
+    tensors = OrderedDict()
+    for name, mapping in (("w2i", nntagger.w2i), ("c2i", nntagger.c2i)):
+        tensors[name + ".strings"], tensors[name + ".offsets"], tensors[name + ".indices"] = encode_vocabulary(mapping)
+    tensors["wembeds"] = nntagger.wembeds.as_array()
+
+    def add_rnn(prefix, rnn_builder):
+        (layer_params,) = rnn_builder.get_parameters() # one layer per builder
+        for name, param in zip(RNN_PARAMETER_NAMES[builder], layer_params):
+            tensors["{}.{}".format(prefix, name)] = param.as_array()
+
+    for i, layer in enumerate(nntagger.predictors["inner"]):
+        add_rnn("inner.{}.f".format(i), layer.f_builder)
+        add_rnn("inner.{}.b".format(i), layer.b_builder)
+    if nntagger.c_in_dim > 0:
+        tensors["cembeds"] = nntagger.cembeds.as_array()
+        add_rnn("char.f", nntagger.char_rnn.f_builder)
+        add_rnn("char.b", nntagger.char_rnn.b_builder)
+    for task_id, output_predictors in nntagger.predictors["output_layers_dict"].items():
+        meta["heads"][task_id] = []
+        for j, head_id in enumerate(kept):
+            layer = output_predictors[head_id].network_builder
+            meta["heads"][task_id].append({"mlp": layer.mlp,
+                                           "mlp_activation": _name_in(ACTIVATION_MAP, layer.mlp_activation) if layer.mlp else None})
+            for name in (["W", "b", "W_mlp", "b_mlp"] if layer.mlp else ["W", "b"]):
+                tensors["{}.head{}.{}".format(task_id, j, name)] = getattr(layer, name).as_array()
+    save_bundle(path, meta, tensors)
+    print("numpy tagger exported: {}".format(path), file=sys.stderr)
+
+
+def verify_numpy_export(tagger, numpy_tagger, test_X, task_labels, num_sentences=500):
+    """
+    max absolute difference between the tag distributions of the tagger and its numpy export on (the first
+    num_sentences of) test_X; returns it with the seconds each of them took
+    """
+    max_diff, dynet_time, numpy_time = 0.0, 0.0, 0.0
+    for batch in tagger.get_minibatches(range(min(num_sentences, len(test_X))), test_X, task_labels, tagger.eval_batch_size):
+        batch_word_indices, batch_char_indices = zip(*[test_X[i] for i in batch])
+        task_id = task_labels[batch[0]]
+        start = time.time()
+        expected = tagger.predict_distributions(batch_word_indices, batch_char_indices, task_id)
+        dynet_time += time.time() - start
+        start = time.time()
+        actual = numpy_tagger.predict_distributions(batch_word_indices, batch_char_indices, task_id)
+        numpy_time += time.time() - start
+        max_diff = max(max_diff, float(np.max(np.abs(expected - actual))))
+    return max_diff, dynet_time, numpy_time
+
+
+def _name_in(mapping, value):
+    """ key of value in one of the helper mappings (activations, builders) """
+    return next(name for name, mapped in mapping.items() if mapped == value)
 
 
 class NNTagger(object):
 
     def __init__(self,in_dim,h_dim,c_in_dim,h_layers,pred_layer, learning_algo="sgd", learning_rate=0,
-                 embeds_file=None,activation=ACTIVATION_MAP["tanh"],
+                 embeds_file=None, embeds_cache=None, embeds_vocab=None, embeds_top_n=None,
+                 activation=ACTIVATION_MAP["tanh"],
                  backprob_embeds=True,noise_sigma=0.1, tasks_ids=[],
                  initializer=INITIALIZER_MAP["glorot"], builder=BUILDERS["lstmc"],
-                 max_vocab_size=None, predict_on_layer=PREDICT_ON_LAYER,
+                 max_vocab_size=None, predict_on_layer=PREDICT_ON_LAYER, corpus_cache=None, char_cache_size=0, eval_batch_size=64,
                  output_builder_query="(%s %d)*%d" % (ACTIVATION_MAP["rectify"], 0, 5), pta_params = defaultdict()):
         self.w2i = {}  # word to index mapping
         self.c2i = {}  # char to index mapping
@@ -386,10 +847,15 @@ class NNTagger(object):
         self.activation = activation
         self.noise_sigma = noise_sigma
         self.h_layers = h_layers
-        self.predictors = {"inner": [], "output_layers_dict": {}, "task_expected_at": {} } # the inner layers and predictors
+        self.predictors = {"inner": [], "output_layers_dict": {}, "task_expected_at": {}, "fused_output_layers": {} } # the inner layers and predictors
         self.wembeds = None # lookup: embeddings for words
         self.cembeds = None # lookup: embeddings for characters
         self.embeds_file = embeds_file
+        self.embeds_cache = embeds_cache # folder of the binary embeddings cache (None: parse the text file)
+        self.embeds_vocab = embeds_vocab # words kept from the embeddings file besides w2i (None: keep all)
+        self.embeds_top_n = embeds_top_n # keep the first n embeddings (None: no limit)
+        self.learning_algo = learning_algo
+        self.learning_rate = learning_rate
         trainer_algo = TRAINER_MAP[learning_algo]
         if learning_rate > 0:
             self.trainer = trainer_algo(self.model, learning_rate=learning_rate)
@@ -399,10 +865,20 @@ class NNTagger(object):
         self.backprob_embeds = backprob_embeds
         self.initializer = initializer
         self.char_rnn = None # biRNN for character input
+        # inference-time cache: char indices of a word type -> last (forward, backward) char biRNN states
+        self.char_cache = LRUCache(char_cache_size) if char_cache_size > 0 else None
+        self.eval_batch_size = eval_batch_size # sentences per forward pass in evaluate
         self.builder = builder # default biRNN is an LSTM
         self.max_vocab_size = max_vocab_size
+        self.corpus_cache = corpus_cache # folder of the indexed corpora cache (None: disabled)
 
         self.predict_on_layer = predict_on_layer
+        # the heads (and their weights in the Q-MTL average) used for prediction, see select_heads; None: all
+        self.head_subset = None
+        self.head_weights = None
+        # heads taken out of training (see deactivate_heads): removed ones are not computed any more, frozen ones still predict
+        self.pruned_heads = []
+        self.frozen_heads = []
         self.output_builder_query = output_builder_query
         self.output_builder = heterogenious_output_utils.query_to_dynet_builder(output_builder_query)
         self.out_num = heterogenious_output_utils.get_output_number(output_builder_query)
@@ -410,21 +886,58 @@ class NNTagger(object):
         if not isinstance(pta_params['D'], list):
             pta_params['D'] = [pta_params['D']] * self.out_num
         self.pta_params = pta_params
+        self.pta = PTAEngine(pta_params)
 
         self.train_log = []
 
     def pick_neg_log(self, pred, gold):
         return -dynet.log(dynet.pick(pred, gold))
 
+    def pick_neg_log_softmax_batch(self, logits, golds, num_heads=1):
+        """
+        summed negative log softmax likelihood of the golds, from the logits (a column per gold,
+        batched with one element per head): one log-softmax over all tokens of all heads
+        """
+        num_tags, num_cols = logits.dim()[0][0], len(golds)
+        per_token = dynet.reshape(logits, (num_tags,), batch_size=num_cols * num_heads)
+        return dynet.sum_batches(dynet.pickneglogsoftmax_batch(per_token, golds * num_heads))
+
+    def soft_target_loss(self, logits, targets, temperature):
+        """
+        cross-entropy of the soft targets (tags x tokens, in the column order of the logits) under the softmax
+        of the logits divided by the temperature, scaled by temperature^2 (Hinton et al., 2015); summed over the heads
+        """
+        log_probs = dynet.log_softmax(logits / temperature)
+        return -dynet.sum_batches(dynet.sum_elems(dynet.cmult(dynet.inputTensor(targets), log_probs))) * (temperature ** 2)
+
+    def update_parameters(self):
+        """
+        trainer step; cached char representations are stale afterwards
+        """
+        self.trainer.update()
+        if self.char_cache is not None:
+            self.char_cache.clear()
+
     def set_indices(self, w2i, c2i, task2t2i):
         for task_id in task2t2i:
             self.task2tag2idx[task_id] = task2t2i[task_id]
         self.w2i = w2i
         self.c2i = c2i
 
-    def fit(self, list_folders_name, num_iterations, training_fraction, dev=None, word_dropout_rate=0.0, model_path=None, patience=0, minibatch_size=0, log_losses=False, label_noise=0.0, build_cg=True):
+    def fit(self, list_folders_name, num_iterations, training_fraction, dev=None, word_dropout_rate=0.0, model_path=None, patience=0, minibatch_size=0, log_losses=False, label_noise=0.0, build_cg=True, num_workers=1, sync_every=50, checkpoint_every=None, resume=False, soft_targets=None, distill_temperature=1.0, distill_alpha=0.0, prune_heads=None, prune_patience=2, prune_mode="remove"):
         """
-        train the tagger
+        train the tagger; with num_workers > 1, the minibatches are spread over worker processes
+        whose replicas are averaged every sync_every minibatches (per worker)
+
+        models (patience) and checkpoints are written in the background; with checkpoint_every (not None), a
+        checkpoint (model_path + CHECKPOINT_SUFFIX) is written after every epoch and every checkpoint_every updates
+        (rounds with several workers), resume continues from it
+
+        with soft_targets (the SoftTargets of a teacher for the training file), the tagger is trained as a
+        distillation student (see train_batch)
+
+        with prune_heads (a threshold), a head whose dev accuracy stays more than prune_heads below the Q-MTL
+        average for prune_patience epochs is taken out of training (prune_mode "remove" or "freeze", see deactivate_heads)
         """
         print("read training data",file=sys.stderr)
 
@@ -434,8 +947,11 @@ class NNTagger(object):
 
         train_X, train_Y, task_labels, w2i, c2i, task2t2i = self.get_train_data(list_folders_name)
 
-        train_X = train_X[0:len(train_X)//training_fraction]
-        train_Y = train_Y[0:len(train_X)]
+        num_file_sentences = len(train_X)
+        train_X = train_X.subset(range(len(train_X)//training_fraction))
+        train_sentence_ids = np.arange(len(train_X)) # positions in the training files
+        train_Y = train_X.tags
+        task_labels = task_labels[0:len(train_X)]
         print("{} many training sentences used".format(len(train_X)), file=sys.stderr)
         assert (len(train_X) == len(train_Y))
 
@@ -447,22 +963,37 @@ class NNTagger(object):
         self.set_indices(w2i,c2i,task2t2i)
 
         # if we use word dropout keep track of counts
+        widCount = None
         if word_dropout_rate > 0.0:
-            widCount = Counter()
-            for sentence, _ in train_X:
-                widCount.update([w for w in sentence])
+            widCount = np.bincount(train_X.words, minlength=len(w2i))
 
         if dev:
             if not os.path.exists(dev):
                 print('%s does not exist. Using 10 percent of the training '
                       'dataset for validation.' % dev)
-                train_X, dev_X, train_Y, dev_Y = train_test_split(
-                    train_X, train_Y, test_size=0.1)
+                train_idx, dev_idx = train_test_split(np.arange(len(train_X)), test_size=0.1)
+                train_X, dev_X = train_X.subset(train_idx), train_X.subset(dev_idx)
+                train_Y, dev_Y = train_X.tags, dev_X.tags
+                task_labels = [task_labels[i] for i in train_idx]
+                train_sentence_ids = train_sentence_ids[train_idx]
                 org_X, org_Y = None, None
                 dev_task_labels = ['task0'] * len(train_X)
             else:
                 dev_X, dev_Y, org_X, org_Y, dev_task_labels = self.get_data_as_indices(dev, "task0")
 
+        if soft_targets is not None:
+            if len(self.tasks_ids) != 1 or num_workers > 1:
+                raise ValueError("distillation requires a single training task and worker")
+            if len(soft_targets) != num_file_sentences:
+                raise ValueError("the soft targets cover {} sentences, the training file {}".format(len(soft_targets), num_file_sentences))
+            soft_targets = soft_targets.use_tags(self.task2tag2idx[self.tasks_ids[0]]).select(train_sentence_ids)
+
+        pruner = None
+        if prune_heads is not None:
+            if not dev or self.predict_on_layer is not None:
+                raise ValueError("head pruning requires a dev set and predictions of all heads")
+            pruner = HeadPruner(prune_heads, prune_patience)
+
         # init lookup parameters and define graph
         print("build graph",file=sys.stderr)
 
@@ -475,20 +1006,14 @@ class NNTagger(object):
             self.predictors, self.char_rnn, self.wembeds, self.cembeds = self.build_computation_graph(num_words, num_chars)
 
 
-        if self.backprob_embeds == False:
-            ## disable backprob into embeds (default: True)
-            self.wembeds.set_updated(False)
-            print(">>> disable wembeds update <<< (is updated: {})".format(self.wembeds.is_updated()), file=sys.stderr)
-
-        train_data = list(zip(train_X,train_Y, task_labels))
+        # sentences are looked up in the corpus buffers by index, only the order is shuffled
+        train_order = list(range(len(train_X)))
 
         best_val_acc, epochs_no_improvement = 0.0, 0
 
         if dev and model_path is not None and patience > 0:
             print('Using early stopping with patience of %d...' % patience)
 
-        batch = []
-
         # DecInit
 
         output_layers_dict = self.predictors['output_layers_dict']
@@ -506,142 +1031,119 @@ class NNTagger(object):
 
             dynet.renew_cg()
 
-        if self.pta_params['F']:
-            for task_id in self.tasks_ids:
-                for i in range(len(output_layers_dict[task_id])):
-                    if i == 0:
-                        continue
-                    output_layers_dict[task_id][i].network_builder.W.set_updated(False)
-                    output_layers_dict[task_id][i].network_builder.b.set_updated(False)
-
-                    if output_layers_dict[task_id][i].network_builder.mlp:
-                        output_layers_dict[task_id][i].network_builder.W_mlp.set_updated(False)
-                        output_layers_dict[task_id][i].network_builder.b_mlp.set_updated(False)
-            dynet.renew_cg()
-
-        for iter in range(num_iterations):
-
-            total_loss=0.0
-            dynet_losses = []
-            total_tagged=0.0
-            random.shuffle(train_data)
-
-            loss_accum_loss = defaultdict(float)
-            loss_accum_tagged = defaultdict(float)
-
-            for batch_num, ((word_indices,char_indices),y, task_of_instance) in enumerate(train_data):
-
-                if word_dropout_rate > 0.0:
-                    word_indices = [self.w2i[UNK] if
-                                        (random.random() > (widCount.get(w)/(word_dropout_rate+widCount.get(w))))
-                                        else w for w in word_indices]
-
-                if task_of_instance not in losses:
-                    losses[task_of_instance] = [] #initialize
-
-                if minibatch_size > 1:
-                    output = self.predict(word_indices, char_indices, task_of_instance, train=True)
-                    total_tagged += len(word_indices)
-
-                    loss1 = dynet.esum([self.pick_neg_log(pred,gold) for pred, gold in zip(output, y)])
-                    batch.append(loss1)
-                    if len(batch) == minibatch_size:
-                        loss = dynet.esum(batch)
-                        dynet_losses.append(loss)
-                        total_loss += loss.value()
-
-                        # logging
-                        loss_accum_tagged[task_of_instance] += len(word_indices)
-                        loss_accum_loss[task_of_instance] += loss.value()
-
-                        loss.backward()
-                        self.trainer.update()
-                        dynet.renew_cg()  # use new computational graph for each BATCH when batching is active
-                        batch = []
+        self.freeze_parameters()
+
+        pool = None
+        if num_workers > 1:
+            pool = self.start_training_workers(num_workers, train_X, task_labels, widCount, word_dropout_rate, label_noise)
+
+        pta_evaluator = None
+        if self.pta_params['M'] and dev:
+            pta_dev = self.pta_dev_sample(dev_X, org_X, org_Y, dev_task_labels)
+            if self.pta_params.get('M-Async'):
+                pta_evaluator = self.start_pta_evaluator(*pta_dev)
+
+        writer = CheckpointWriter() if model_path is not None else None
+        checkpoint_file = None if model_path is None else model_path + CHECKPOINT_SUFFIX
+
+        def training_state(epoch, num_rounds):
+            return {"epoch": epoch, "round": num_rounds, "num_trained": num_trained,
+                    "total_loss": total_loss, "total_tagged": total_tagged,
+                    "loss_accum_loss": loss_accum_loss, "loss_accum_tagged": loss_accum_tagged, "losses": losses,
+                    "best_val_acc": best_val_acc, "epochs_no_improvement": epochs_no_improvement,
+                    "epochs_behind": pruner.epochs_behind if pruner is not None else {}}
+
+        state, start_epoch = None, 0
+        if resume:
+            state, resumed_order = self.resume_training(checkpoint_file)
+            start_epoch = state["epoch"]
+            losses = state["losses"]
+            best_val_acc, epochs_no_improvement = state["best_val_acc"], state["epochs_no_improvement"]
+            if pruner is not None:
+                pruner.epochs_behind = {int(head_id): epochs for head_id, epochs in state.get("epochs_behind", {}).items()}
+            print("resuming from {} at epoch {} (after {} updates)".format(checkpoint_file, start_epoch, state["round"]),
+                  file=sys.stderr, flush=True)
+
+        for iter in range(start_epoch, num_iterations):
+
+            skip_rounds = 0
+            if state is not None and state["epoch"] == iter and state["round"] > 0:
+                # the interrupted epoch: same sentence order, the rounds already trained are skipped
+                train_order = resumed_order.tolist()
+                skip_rounds = state["round"]
+                total_loss, total_tagged, num_trained = state["total_loss"], state["total_tagged"], state["num_trained"]
+                loss_accum_loss = defaultdict(float, state["loss_accum_loss"])
+                loss_accum_tagged = defaultdict(float, state["loss_accum_tagged"])
+            else:
+                total_loss=0.0
+                total_tagged=0.0
+                random.shuffle(train_order)
+
+                loss_accum_loss = defaultdict(float)
+                loss_accum_tagged = defaultdict(float)
+                num_trained = 0 # sentences seen in this epoch
+
+            epoch_start = time.time()
+            batches = self.get_minibatches(train_order, train_X, task_labels, minibatch_size)
+            if pool is None:
+                # one batch per update; PTA is checked after each of them
+                rounds = ([batch] for batch in batches)
+            else:
+                # each worker trains on sync_every batches per round, then the replicas are averaged
+                rounds = _chunks(list(batches), num_workers * sync_every)
+            for round_idx, round_batches in enumerate(rounds):
+                if round_idx < skip_rounds:
+                    continue
+                if pool is None:
+                    round_stats = [self.train_batch(round_batches[0], train_X, train_Y, task_labels, widCount,
+                                                    word_dropout_rate, label_noise, soft_targets,
+                                                    distill_temperature, distill_alpha)]
+                    self.update_parameters()
                 else:
-                    dynet.renew_cg() # new graph per item
-                    output_list = self.predict(word_indices, char_indices, task_of_instance, train=True)
-                    total_tagged += len(word_indices)
-                    loss_avg = []
-                    loss_objts = []
-                    y = [np.random.randint(len(self.task2tag2idx[task_of_instance])) if b else v for (v,b) in zip(y, np.random.rand(len(y)) < label_noise)]
-
-
-                    for layer, output in enumerate(output_list):
-                        loss1 = dynet.esum([self.pick_neg_log(pred,gold) for pred, gold in zip(output, y)])
-                        lv = loss1.value()
-                        loss_avg.append(lv)
-                        loss_objts.append(loss1)
-
-                    total_loss += np.average(loss_avg)
+                    round_stats = pool.run_round([round_batches[w::num_workers] for w in range(num_workers)],
+                                                 dropouts=self.pta_params['D'], pruned_heads=self.pruned_heads,
+                                                 frozen_heads=self.frozen_heads)
+                    if self.char_cache is not None:
+                        self.char_cache.clear()
+                    round_stats = [batch_stats for worker_stats in round_stats for batch_stats in worker_stats]
+
+                for task_of_instance, num_sentences, num_tagged, loss_avg in round_stats:
+                    if task_of_instance not in losses:
+                        losses[task_of_instance] = [] #initialize
+                    total_tagged += num_tagged
+                    total_loss += loss_avg
 
                     # logging
-                    loss_accum_tagged[task_of_instance] += len(word_indices)
-                    loss_accum_loss[task_of_instance] += np.average(loss_avg)
-
-                    dynet.esum(loss_objts).backward()
-                    self.trainer.update()
-
-
-                if self.pta_params['M'] and batch_num % (len(train_data) // self.pta_params['M']) == 0:
-                    if not dev:
-                        continue
-                    correct_list, total_list, _ = self.evaluate(dev_X, dev_Y, org_X, org_Y, dev_task_labels, verbose=False)
-                    dev_accuracy = '\t'.join(["%.4f" % (0 if total == 0 else correct / total) for (correct, total) in
-                                              zip(correct_list, total_list)])
-                    # DecUpdate
-                    best_model_idx = np.argmax(np.array(dev_accuracy.split('\t')[:-1]))
-
-                    if self.pta_params['G']:
-                        best_W = self.predictors['output_layers_dict']['task0'][best_model_idx].network_builder.W
-                        best_b = self.predictors['output_layers_dict']['task0'][best_model_idx].network_builder.b
-                        if self.predictors['output_layers_dict']['task0'][best_model_idx].network_builder.mlp:
-                            best_W_mlp = self.predictors['output_layers_dict']['task0'][
-                                best_model_idx].network_builder.W_mlp
-                            best_b_mlp = self.predictors['output_layers_dict']['task0'][
-                                best_model_idx].network_builder.b_mlp
-                        for i in range(len(self.predictors['output_layers_dict']['task0'])):
-                            if i == best_model_idx:
-                                continue
-
-                            W = self.predictors['output_layers_dict']['task0'][i].network_builder.W
-                            b = self.predictors['output_layers_dict']['task0'][i].network_builder.b
-                            W.set_value(best_W.value())
-                            b.set_value(best_b.value())
-                            self.pta_params['D'][i] = self.pta_params['D'][best_model_idx]
-
-                            if self.predictors['output_layers_dict']['task0'][i].network_builder.mlp:
-                                W_mlp = self.predictors['output_layers_dict']['task0'][i].network_builder.W_mlp
-                                b_mlp = self.predictors['output_layers_dict']['task0'][i].network_builder.b_mlp
-                                W_mlp.set_value(best_W_mlp.value())
-                                b_mlp.set_value(best_b_mlp.value())
-
-                        dynet.renew_cg()
-
-                    if self.pta_params['P']:
-                        # todo: evaluate only returns 1 task
-
-                        for i in range(len(self.predictors['output_layers_dict']['task0'])):
-                            if i == best_model_idx:
-                                continue
-
-                            W = self.predictors['output_layers_dict']['task0'][i].network_builder.W
-                            noise = np.random.multivariate_normal([0] * W.shape()[0],
-                                                                  self.pta_params['P'] * np.eye(W.shape()[0]), W.shape()[1])
-                            W.set_value(noise.T + W.value())
-                        dynet.renew_cg()
-
-                    if self.pta_params['H']:
-                        for i in range(len(self.predictors['output_layers_dict']['task0'])):
-                            if i == best_model_idx:
-                                continue
-                            noise = np.random.normal(0, self.pta_params['H'])
-                            noised_dropout = self.pta_params['D'][i] + noise
-                            if noised_dropout >= self.pta_params['D-Upper'] or noised_dropout < self.pta_params['D-Lower']:
-                                print("Omitting dropout of %f in head %d" % (noised_dropout, i), file=sys.stderr, flush=True)
-                                continue
-                            self.pta_params['D'][i] += noise
-
+                    loss_accum_tagged[task_of_instance] += num_tagged
+                    loss_accum_loss[task_of_instance] += loss_avg
+
+                prev_trained = num_trained
+                num_trained += sum(batch_stats[1] for batch_stats in round_stats)
+                if self.pta_params['M'] and dev:
+                    pta_interval = len(train_order) // self.pta_params['M']
+                    if any(i % pta_interval == 0 for i in range(prev_trained, num_trained)):
+                        if pta_evaluator is None:
+                            self.pta_update(*pta_dev)
+                        else:
+                            # evaluated in the background, the decision is applied when the result is back
+                            with self.pta.timed("snapshot"):
+                                pta_evaluator.submit()
+                if pta_evaluator is not None:
+                    self.pta_apply_results(pta_evaluator.collect())
+                if checkpoint_every and (round_idx + 1) % checkpoint_every == 0:
+                    self.write_checkpoint(writer, checkpoint_file, train_order, training_state(iter, round_idx + 1))
+
+            if pta_evaluator is not None:
+                # the PTA decisions of the epoch are applied before the dev evaluation
+                while pta_evaluator.num_pending():
+                    self.pta_apply_results(pta_evaluator.collect(block=True))
+                self.pta_apply_results(pta_evaluator.collect())
+            if self.pta.timings:
+                print("iter {} PTA timings: {}".format(iter, self.pta.timing_report()), file=sys.stderr, flush=True)
+
+            print("iter {} tokens/sec: {:.1f} (minibatch size {}, workers {})".format(iter, total_tagged / (time.time() - epoch_start),
+                                                                                    max(minibatch_size, 1), max(num_workers, 1)),
+                  file=sys.stderr, flush=True)
             print("iter {2} {0:>12}: {1:.2f}".format("total loss",
                                                      total_loss/total_tagged,
                                                      iter), file=sys.stderr, flush=True)
@@ -655,7 +1157,7 @@ class NNTagger(object):
 
             if dev:
                 # evaluate after every epoch
-                correct_list, total_list, _ = self.evaluate(dev_X, dev_Y, org_X, org_Y, dev_task_labels)
+                correct_list, total_list = self.evaluate(dev_X, dev_Y, org_X, org_Y, dev_task_labels)
                 dev_accuracy = '\t'.join(["%.4f" % (0 if total == 0 else correct/total) for (correct, total) in zip(correct_list, total_list)])
                 print("\ndev accuracy: %s" % dev_accuracy, file=sys.stderr, flush=True)
 
@@ -670,7 +1172,7 @@ class NNTagger(object):
                                   file=sys.stderr, flush=True)
                             best_val_acc = val_accuracy
                             epochs_no_improvement = 0
-                            save(self, model_path)
+                            writer.submit(model_path + MODEL_SUFFIX, *model_bundle(self))
                         else:
                             print('Accuracy %.4f is worse than best val loss %.4f.' %
                                   (val_accuracy, best_val_acc), file=sys.stderr, flush=True)
@@ -680,14 +1182,254 @@ class NNTagger(object):
                                   epochs_no_improvement, file=sys.stderr, flush=True)
                             break
 
+                if pruner is not None:
+                    self.prune_lagging_heads(pruner, correct_list, total_list, prune_mode)
+
+            if checkpoint_every is not None:
+                self.write_checkpoint(writer, checkpoint_file, train_order, training_state(iter + 1, 0))
+
+        if pool is not None:
+            pool.close()
+        if pta_evaluator is not None:
+            pta_evaluator.close()
+        if writer is not None:
+            writer.close()
+
+    def prune_lagging_heads(self, pruner, correct_list, total_list, prune_mode="remove"):
+        """
+        take the heads the pruner finds lagging behind the Q-MTL average on dev out of training
+        """
+        accuracies = [0 if total == 0 else correct / total for correct, total in zip(correct_list, total_list)]
+        lagging = pruner.update({head_id: accuracies[head_id] for head_id in self.trained_heads()}, accuracies[self.out_num])
+        if not lagging:
+            return
+        if prune_mode == "freeze":
+            self.deactivate_heads(frozen_heads=lagging)
+        else:
+            self.deactivate_heads(pruned_heads=lagging)
+        print("heads {} lag behind the average for {} epochs: {} ({} of {} heads trained)".format(
+            lagging, pruner.patience, "frozen" if prune_mode == "freeze" else "removed", len(self.trained_heads()),
+            self.out_num), file=sys.stderr, flush=True)
+
+    def write_checkpoint(self, writer, checkpoint_file, train_order, state):
+        """
+        snapshot of the model and the training state (counters, train log, random number generators, sentence order
+        of the epoch), written in the background; a checkpoint is a model bundle with additional metadata and arrays
+        """
+        meta, tensors = model_bundle(self, keep_pruned=True)
+        rng_meta, rng_tensors = get_rng_state()
+        meta["training"] = dict(state, rng=rng_meta, train_log=self.train_log, learning_rate=self.trainer.learning_rate)
+        tensors.update(rng_tensors)
+        tensors["train_order"] = np.array(train_order, dtype=np.int64)
+        writer.submit(checkpoint_file, meta, tensors)
+
+    def resume_training(self, checkpoint_file):
+        """
+        set the parameters, PTA dropout rates, heads out of training, train log, learning rate and random number generators from a checkpoint
+        written by fit; returns the training state and the sentence order of the interrupted epoch
+
+        dynet's own generator (dropout masks, noise) and the trainer's moment estimates cannot be read from
+        dynet: the generator is reseeded, adaptive trainers start with fresh moments
+        """
+        meta, tensors = load_bundle(checkpoint_file)
+        parameters = model_parameters(self.model)
+        if meta["num_words"] != len(self.w2i) or meta["num_chars"] != len(self.c2i) \
+                or meta["num_parameters"] != len(parameters):
+            raise ValueError("{} does not match the model built from the training data".format(checkpoint_file))
+        set_parameter_values(self.model, [tensors["param.{}".format(i)] for i in range(len(parameters))])
+        state = meta["training"]
+        self.pta_params['D'] = meta["pta_params"]['D']
+        self.train_log = state["train_log"]
+        self.trainer.learning_rate = state["learning_rate"]
+        set_rng_state(state["rng"], tensors)
+        self.deactivate_heads(meta.get("pruned_heads", []), meta.get("frozen_heads", []))
+        dynet.reset_random_seed(state["epoch"] * 1000003 + state["round"] + 1)
+        dynet.renew_cg()
+        return state, np.array(tensors["train_order"])
+
+    def train_batch(self, batch, train_X, train_Y, task_labels, widCount, word_dropout_rate, label_noise,
+                    soft_targets=None, temperature=1.0, alpha=0.0):
+        """
+        forward and backward pass for a batch of sentences (of the same length and task), the trainer update
+        is left to the caller; returns (task, number of sentences, number of tokens, loss averaged over the heads)
+
+        with soft_targets (distillation), the loss of a head is (1 - alpha) * soft_target_loss + alpha * the loss of the gold tags
+        """
+        task_of_instance = task_labels[batch[0]]
+        batch_word_indices, batch_char_indices, batch_y = [], [], []
+        for sentence_idx in batch:
+            (word_indices, char_indices), y = train_X[sentence_idx], train_Y[sentence_idx]
+
+            if word_dropout_rate > 0.0:
+                word_indices = [self.w2i[UNK] if
+                                    (random.random() > (widCount[w]/(word_dropout_rate+widCount[w])))
+                                    else w for w in word_indices]
+
+            y = [np.random.randint(len(self.task2tag2idx[task_of_instance])) if b else v for (v,b) in zip(y, np.random.rand(len(y)) < label_noise)]
+            batch_word_indices.append(word_indices)
+            batch_char_indices.append(char_indices)
+            batch_y.append(y)
+
+        dynet.renew_cg() # new graph per batch (of sentences with the same length)
+        output_list = self.predict_batch(batch_word_indices, batch_char_indices, task_of_instance, train=True, logits=True)
+        num_tagged = len(batch) * len(batch_word_indices[0])
+        loss_objts = []
+
+        # gold tags in the column order of the outputs (token t of sentence b at b * sent_len + t)
+        gold = [int(tag) for y in batch_y for tag in y]
+        targets = soft_targets.batch(batch) if soft_targets is not None else None
+        num_heads = 0
+        for head_ids, output in output_list:
+            if targets is None:
+                loss_objts.append(self.pick_neg_log_softmax_batch(output, gold, len(head_ids)))
+            else:
+                head_loss = (1 - alpha) * self.soft_target_loss(output, targets, temperature)
+                if alpha > 0:
+                    head_loss = head_loss + alpha * self.pick_neg_log_softmax_batch(output, gold, len(head_ids))
+                loss_objts.append(head_loss)
+            num_heads += len(head_ids)
+        loss = dynet.esum(loss_objts) if len(loss_objts) > 1 else loss_objts[0]
+        loss.backward()
+        # read after backward: the forward values are already computed, no extra pass
+        loss_avg = loss.scalar_value() / num_heads # average over the output layers
+        return task_of_instance, len(batch), num_tagged, loss_avg
+
+    def freeze_parameters(self):
+        """
+        exclude the embeddings (if backprob_embeds is off), the heads taken out of training and, with PTA F,
+        all heads but the first from the updates
+        """
+        if self.backprob_embeds == False:
+            ## disable backprob into embeds (default: True)
+            self.wembeds.set_updated(False)
+            print(">>> disable wembeds update <<< (is updated: {})".format(self.wembeds.is_updated()), file=sys.stderr)
+
+        if self.pta_params['F']:
+            output_layers_dict = self.predictors['output_layers_dict']
+            for task_id in self.tasks_ids:
+                for i in range(len(output_layers_dict[task_id])):
+                    if i == 0:
+                        continue
+                    output_layers_dict[task_id][i].network_builder.W.set_updated(False)
+                    output_layers_dict[task_id][i].network_builder.b.set_updated(False)
+
+                    if output_layers_dict[task_id][i].network_builder.mlp:
+                        output_layers_dict[task_id][i].network_builder.W_mlp.set_updated(False)
+                        output_layers_dict[task_id][i].network_builder.b_mlp.set_updated(False)
+            dynet.renew_cg()
+
+        if self.pruned_heads or self.frozen_heads:
+            self.deactivate_heads()
+
+    def start_training_workers(self, num_workers, train_X, task_labels, widCount, word_dropout_rate, label_noise):
+        """
+        worker processes for data-parallel training, bootstrapped from a copy of the current model and the training corpus
+        """
+        pool = ParameterAveragingPool(num_workers, self.model)
+        save(self, os.path.join(pool.work_dir, "model"), keep_pruned=True)
+        arrays = dict(train_X.arrays(), task_labels=np.array([self.tasks_ids.index(task) for task in task_labels], dtype=np.int32))
+        if widCount is not None:
+            arrays["wid_count"] = widCount
+        save_corpus_cache(os.path.join(pool.work_dir, "train"), arrays, {})
+        options = {"learning_algo": self.learning_algo,
+                   "learning_rate": self.learning_rate,
+                   "backprob_embeds": self.backprob_embeds,
+                   "noise_sigma": self.noise_sigma,
+                   "word_dropout_rate": word_dropout_rate,
+                   "label_noise": label_noise,
+                   "seed": np.random.randint(2**31 - num_workers)}
+        pool.start(data_parallel_worker, (options,))
+        return pool
+
+    def pta_dev_sample(self, dev_X, org_X, org_Y, dev_task_labels):
+        """
+        the dev sentences PTA decides on: all of them, or a fixed random sample of pta_params['M-Sample'] sentences
+        """
+        dev_task_labels = dev_task_labels[:len(dev_X)]
+        sample_size = self.pta_params.get('M-Sample', 0)
+        if not sample_size or sample_size >= len(dev_X):
+            return dev_X, dev_X.tags, org_X, org_Y, dev_task_labels
+        sample = np.sort(np.random.choice(len(dev_X), sample_size, replace=False))
+        sample_X = dev_X.subset(sample)
+        print("PTA decides on {} of {} dev sentences".format(sample_size, len(dev_X)), file=sys.stderr)
+        return (sample_X, sample_X.tags,
+                None if org_X is None else [org_X[i] for i in sample],
+                None if org_Y is None else [org_Y[i] for i in sample],
+                [dev_task_labels[i] for i in sample])
+
+    def start_pta_evaluator(self, dev_X, dev_Y, org_X, org_Y, dev_task_labels):
+        """
+        background process for asynchronous PTA, bootstrapped from a copy of the current model and the dev sentences
+        """
+        evaluator = SnapshotEvaluator(self.model, num_slots=max(1, self.pta_params.get('M-Lag', 1)))
+        save(self, os.path.join(evaluator.work_dir, "model"), keep_pruned=True)
+        task_ids = np.array([self.tasks_ids.index(task) for task in dev_task_labels], dtype=np.int32)
+        save_corpus_cache(os.path.join(evaluator.work_dir, "dev"), dict(dev_X.arrays(), task_labels=task_ids), {})
+        evaluator.start(pta_evaluation_worker, ({"eval_batch_size": self.eval_batch_size},))
+        return evaluator
+
+    def pta_apply_results(self, results):
+        for _, (correct_list, total_list) in results:
+            self.pta_apply(correct_list, total_list)
+
+    def pta_update(self, dev_X, dev_Y, org_X, org_Y, dev_task_labels):
+        """
+        evaluate on dev and update the heads (G/P/H) relative to the best one
+        """
+        with self.pta.timed("evaluate"):
+            correct_list, total_list = self.evaluate(dev_X, dev_Y, org_X, org_Y, dev_task_labels, verbose=False)
+        self.pta_apply(correct_list, total_list)
+
+    def pta_apply(self, correct_list, total_list):
+        """
+        update the heads (G/P/H) relative to the best one on dev; the heads out of training are left alone
+        """
+        dev_accuracy = '\t'.join(["%.4f" % (0 if total == 0 else correct / total) for (correct, total) in
+                                  zip(correct_list, total_list)])
+        # DecUpdate (removed heads are out)
+        head_accuracies = np.array(dev_accuracy.split('\t')[:-1], dtype=np.float64)
+        head_accuracies[self.pruned_heads] = -1
+        best_model_idx = np.argmax(head_accuracies)
+
+        # todo: evaluate only returns 1 task
+        layers = [output_predictor.network_builder for output_predictor in self.predictors['output_layers_dict']['task0']]
+        self.pta.update(layers, best_model_idx, excluded=self.pruned_heads + self.frozen_heads)
+        if self.pta_params['G'] or self.pta_params['P']:
+            dynet.renew_cg()
+
+    def get_minibatches(self, order, X, task_labels, minibatch_size):
+        """
+        group the sentences (in the given order) into batches of up to minibatch_size sentences
+        of the same task and length; batches are yielded as soon as they are full, the rest at the end
+        """
+        if minibatch_size <= 1:
+            for sentence_idx in order:
+                yield [sentence_idx]
+            return
+        lengths = X.sentence_lengths()
+        buckets = {}
+        for sentence_idx in order:
+            bucket = buckets.setdefault((task_labels[sentence_idx], lengths[sentence_idx]), [])
+            bucket.append(sentence_idx)
+            if len(bucket) == minibatch_size:
+                yield bucket
+                buckets[(task_labels[sentence_idx], lengths[sentence_idx])] = []
+        for bucket in buckets.values():
+            if bucket:
+                yield bucket
 
     def load_embeddings(self):
         print("loading embeddings", file=sys.stderr)
-        embeddings, emb_dim = load_embeddings_file(self.embeds_file)
+        vocab = None
+        if self.embeds_vocab is not None:
+            vocab = set(self.w2i.keys()).union(self.embeds_vocab)
+        embeddings, emb_dim = load_embeddings_file(self.embeds_file, cache_dir=self.embeds_cache,
+                                                   vocab=vocab, top_n=self.embeds_top_n)
         assert(emb_dim==self.in_dim)
         num_words=len(set(embeddings.keys()).union(set(self.w2i.keys()))) # initialize all with embeddings
         # init model parameters and initialize them
         wembeds = self.model.add_lookup_parameters((num_words, self.in_dim), init=self.initializer)
+        print("wembeds: {} x {} ({:.1f} MB)".format(num_words, self.in_dim, num_words * self.in_dim * 4 / 2**20), file=sys.stderr)
 
         init=0
         for word in embeddings:
@@ -702,15 +1444,19 @@ class NNTagger(object):
 
         return wembeds
 
-    def build_computation_graph(self, num_words, num_chars):
+    def build_computation_graph(self, num_words, num_chars, init_embeddings=True):
         """
-        build graph and link to parameters
+        build graph and link to parameters; without init_embeddings, the word embeddings are only
+        shaped (num_words) and not read from embeds_file, e.g. when the values are loaded afterwards
         """
         ## initialize word embeddings
-        if self.embeds_file:
+        if self.embeds_file and init_embeddings:
             wembeds = self.load_embeddings()
-        else:
+        elif init_embeddings:
             wembeds = self.model.add_lookup_parameters((num_words, self.in_dim), init=self.initializer)
+        else:
+            # overwritten anyway, a constant is the cheapest initialization
+            wembeds = self.model.add_lookup_parameters((num_words, self.in_dim), init=dynet.ConstInitializer(0.0))
 
 
         ## initialize character embeddings
@@ -764,9 +1510,65 @@ class NNTagger(object):
         predictors["inner"] = layers
         predictors["output_layers_dict"] = output_layers_dict
         predictors["task_expected_at"] = task_expected_at
+        predictors["fused_output_layers"] = self.fuse_output_layers(output_layers_dict)
+        predictors["trained_output_layers"] = self.fuse_output_layers(output_layers_dict, trained=True)
 
         return predictors, char_rnn, wembeds, cembeds
 
+    def prediction_heads(self):
+        """
+        the heads computed at prediction time: predict_on_layer, the selected heads (select_heads) or all,
+        without the removed ones
+        """
+        if self.predict_on_layer is not None:
+            return [self.predict_on_layer]
+        if self.head_subset is not None:
+            return list(self.head_subset)
+        return [head_id for head_id in range(self.out_num) if head_id not in self.pruned_heads]
+
+    def fuse_heads(self):
+        """
+        regroup the output layers after the heads used for prediction or training changed
+        """
+        output_layers_dict = self.predictors["output_layers_dict"]
+        self.predictors["fused_output_layers"] = self.fuse_output_layers(output_layers_dict)
+        self.predictors["trained_output_layers"] = self.fuse_output_layers(output_layers_dict, trained=True)
+
+    def deactivate_heads(self, pruned_heads=(), frozen_heads=()):
+        """
+        take heads out of training: the removed ones (pruned_heads) are not computed any more and their parameters
+        are dropped when the model is saved, the frozen ones keep predicting but are neither computed nor
+        updated in training
+        """
+        self.pruned_heads = sorted(set(self.pruned_heads) | set(pruned_heads))
+        self.frozen_heads = sorted((set(self.frozen_heads) | set(frozen_heads)) - set(self.pruned_heads))
+        if self.head_subset is not None:
+            # the selected heads and their weights lose the removed heads together
+            weights = self.head_weights or [1] * len(self.head_subset)
+            selected = [(head_id, weight) for head_id, weight in zip(self.head_subset, weights) if head_id not in self.pruned_heads]
+            self.head_subset = [head_id for head_id, _ in selected] or None
+            self.head_weights = [weight for _, weight in selected] if self.head_weights is not None and selected else None
+        for output_predictors in self.predictors["output_layers_dict"].values():
+            for head_id in self.pruned_heads + self.frozen_heads:
+                for param in output_predictors[head_id].network_builder.parameters():
+                    param.set_updated(False)
+        self.fuse_heads()
+
+    def trained_heads(self):
+        """
+        the heads computed in training: the heads used for prediction that are not frozen
+        """
+        return [head_id for head_id in self.prediction_heads() if head_id not in self.frozen_heads]
+
+    def fuse_output_layers(self, output_layers_dict, trained=False):
+        """
+        group the output layers used for prediction (see prediction_heads), or with trained the ones
+        trained (see trained_heads), to be evaluated at once
+        """
+        head_ids = self.trained_heads() if trained else self.prediction_heads()
+        return {task_id: heterogenious_output_utils.fuse_output_layers(output_predictors, head_ids)
+                for task_id, output_predictors in output_layers_dict.items()}
+
     def get_features(self, words):
         """
         from a list of words, return the word and word char indices
@@ -780,56 +1582,101 @@ class NNTagger(object):
                 word_indices.append(self.w2i[UNK])
 
             if self.c_in_dim > 0:
-                chars_of_word = [self.c2i["<w>"]]
-                for char in word:
-                    if char in self.c2i:
-                        chars_of_word.append(self.c2i[char])
-                    else:
-                        chars_of_word.append(self.c2i[UNK])
-                chars_of_word.append(self.c2i["</w>"])
-                word_char_indices.append(chars_of_word)
+                word_char_indices.append(self.get_char_indices(word))
         return word_indices, word_char_indices
 
+    def get_char_indices(self, word):
+        """
+        char indices of a word (with word start and end symbols)
+        """
+        chars_of_word = [self.c2i["<w>"]]
+        for char in word:
+            if char in self.c2i:
+                chars_of_word.append(self.c2i[char])
+            else:
+                chars_of_word.append(self.c2i[UNK])
+        chars_of_word.append(self.c2i["</w>"])
+        return chars_of_word
+
     def get_data_as_indices(self, folder_name, task, raw=False):
         """
-        X = list of (word_indices, word_char_indices)
-        Y = list of tag indices
+        X = IndexedCorpus, X[i] = (word_indices, word_char_indices)
+        Y = tag indices per sentence (X.tags)
         """
-        X, Y = [],[]
+        cache_path = None
+        if self.corpus_cache:
+            cache_path = corpus_cache_path(self.corpus_cache, [folder_name], "data", task, raw, self.c_in_dim,
+                                           mapping_digest(self.w2i, self.c2i, self.task2tag2idx[task]))
+            cached = load_corpus_cache(cache_path)
+            if cached:
+                arrays, _ = cached
+                X = IndexedCorpus.from_arrays(arrays)
+                forms = decode_strings(arrays["forms"], arrays["form_offsets"])
+                gold_tags = decode_strings(arrays["gold_tags"], arrays["gold_tag_offsets"])
+                sent_offsets = X.sent_offsets.tolist()
+                token_types = X.token_types.tolist()
+                gold_tag_ids = arrays["gold_tag_ids"].tolist()
+                org_X = [[forms[f] for f in token_types[start:end]] for start, end in zip(sent_offsets[:-1], sent_offsets[1:])]
+                org_Y = [[gold_tags[t] for t in gold_tag_ids[start:end]] for start, end in zip(sent_offsets[:-1], sent_offsets[1:])]
+                return X, X.tags, org_X, org_Y, [task] * len(X)
+
+        corpus_builder = IndexedCorpusBuilder(self.get_char_indices if self.c_in_dim > 0 else None)
         org_X, org_Y = [], []
         task_labels = []
         for (words, tags) in read_conll_file(folder_name, raw=raw):
-            word_indices, word_char_indices = self.get_features(words)
+            word_indices = [self.w2i.get(word, self.w2i[UNK]) for word in words]
             tag_indices = [self.task2tag2idx[task].get(tag) for tag in tags]
-            X.append((word_indices,word_char_indices))
-            Y.append(tag_indices)
+            corpus_builder.add(words, word_indices, tag_indices)
             org_X.append(words)
             org_Y.append(tags)
             task_labels.append( task )
-        return X, Y, org_X, org_Y, task_labels
+        X = corpus_builder.build()
+
+        if cache_path:
+            arrays = X.arrays()
+            # the word types of the corpus are the original tokens
+            arrays["forms"], arrays["form_offsets"] = encode_strings(corpus_builder.types())
+            tag2id = {}
+            arrays["gold_tag_ids"] = np.array([tag2id.setdefault(t, len(tag2id)) for tags in org_Y for t in tags], dtype=np.int32)
+            arrays["gold_tags"], arrays["gold_tag_offsets"] = encode_strings(list(tag2id))
+            save_corpus_cache(cache_path, arrays, {"file": folder_name, "task": task})
+        return X, X.tags, org_X, org_Y, task_labels
 
     def predict(self, word_indices, char_indices, task_id, train=False):
         """
-        predict tags for a sentence represented as char+word embeddings
+        predict tags for a sentence represented as char+word embeddings (see predict_batch)
         """
+        return self.predict_batch([word_indices], [char_indices], task_id, train=train)
+
+    def predict_batch(self, batch_word_indices, batch_char_indices, task_id, train=False, logits=False, temperature=None):
+        """
+        predict tags for a batch of sentences of the same length, represented as char+word embeddings;
+        the sentences share DyNet's batch dimension up to the output layers, which see the whole batch
+        as one matrix; returns a (head indices, tag distributions) pair per group of fused output layers,
+        the distributions have a column per token (token t of sentence b at b * sent_len + t) and are
+        batched with one element per head; with logits, the scores before the softmax are returned, with
+        temperature the soft labels (the softmax of the scores divided by the temperature)
+        """
+        batch_size = len(batch_word_indices)
+        sent_len = len(batch_word_indices[0])
 
         # word embeddings
-        wfeatures = [self.wembeds[w] for w in word_indices]
+        if batch_size == 1:
+            wfeatures = [self.wembeds[w] for w in batch_word_indices[0]]
+        else:
+            wfeatures = [dynet.lookup_batch(self.wembeds, [int(word_indices[t]) for word_indices in batch_word_indices])
+                         for t in range(sent_len)]
 
-        # char embeddings
+        # char embeddings (all tokens of the batch at once, token t of sentence b at b * sent_len + t)
         if self.c_in_dim > 0:
-            char_emb = []
-            rev_char_emb = []
-            # get representation for words
-            for chars_of_token in char_indices:
-                char_feats = [self.cembeds[c] for c in chars_of_token]
-                # use last state as word representation
-                f_char, b_char = self.char_rnn.predict_sequence(char_feats, char_feats)
-                last_state = f_char[-1]
-                rev_last_state = b_char[-1]
-                char_emb.append(last_state)
-                rev_char_emb.append(rev_last_state)
-
+            tokens_char_indices = [chars_of_token for char_indices in batch_char_indices for chars_of_token in char_indices]
+            if not train and self.char_cache is not None:
+                char_emb, rev_char_emb = self.get_cached_char_features(tokens_char_indices)
+            else:
+                char_emb, rev_char_emb = self.get_char_features(tokens_char_indices)
+            if batch_size > 1:
+                char_emb = [dynet.concatenate_to_batch(char_emb[t::sent_len]) for t in range(sent_len)]
+                rev_char_emb = [dynet.concatenate_to_batch(rev_char_emb[t::sent_len]) for t in range(sent_len)]
             features = [dynet.concatenate([w,c,rev_c]) for w,c,rev_c in zip(wfeatures,char_emb,rev_char_emb)]
         else:
             features = wfeatures
@@ -855,18 +1702,27 @@ class NNTagger(object):
                 backward_sequence = [self.activation(s) for s in backward_sequence]
 
             if i == output_expected_at_layer:
+                concat_layer = [dynet.concatenate([f, b]) for f, b in zip(forward_sequence,reversed(backward_sequence))]
+                # the whole minibatch as one matrix, the column of token t of sentence b is b * sent_len + t
+                sentence_matrix = dynet.concatenate_cols(concat_layer)
+                if batch_size > 1:
+                    sentence_matrix = dynet.reshape(sentence_matrix, (2 * self.h_dim, batch_size * sent_len))
                 output = []
-                output_predictors = self.predictors["output_layers_dict"][task_id]
-                for j, output_predictor in enumerate(output_predictors):
-                    concat_layer = [dynet.concatenate([f, b]) for f, b in zip(forward_sequence,reversed(backward_sequence))]
-
+                for fused_layers in self.predictors["trained_output_layers" if train else "fused_output_layers"][task_id]:
+                    num_heads = len(fused_layers.layer_ids)
+                    x = sentence_matrix
                     if train and self.noise_sigma > 0.0:
-                        concat_layer = [dynet.noise(fe,self.noise_sigma) for fe in concat_layer]
-                    if train:
-                        output.append(output_predictor.predict_sequence(concat_layer, dropout=self.pta_params['D'][j]))
+                        # each head sees its own noise
+                        if num_heads > 1:
+                            x = dynet.concatenate_to_batch([x] * num_heads)
+                        x = dynet.noise(x, self.noise_sigma)
+                    dropouts = [self.pta_params['D'][j] for j in fused_layers.layer_ids] if train else None
+                    if logits:
+                        output.append((fused_layers.layer_ids, fused_layers.logits(x, dropouts=dropouts)))
                     else:
-                        output.append(output_predictor.predict_sequence(concat_layer))
-                return [o for i,o in enumerate(output) if self.predict_on_layer is None or i == self.predict_on_layer]
+                        output.append((fused_layers.layer_ids, fused_layers(x, dropouts=dropouts, soft_labels=temperature is not None,
+                                                                            temperature=temperature)))
+                return output
 
             prev = forward_sequence
             prev_rev = backward_sequence
@@ -874,58 +1730,239 @@ class NNTagger(object):
         raise Exception("oops should not be here")
         return None
 
-    def evaluate(self, test_X, test_Y, org_X, org_Y, task_labels, output_predictions=None, output_probs=False, verbose=True, raw=False, get_predictions_array=False):
+    def get_char_features(self, char_indices):
+        """
+        last forward and backward char biRNN states (the word representation) of each token;
+        all distinct words of the sentence (or minibatch) go through the char biRNN in one batched pass
+        """
+        keys = [tuple(chars_of_token.tolist() if isinstance(chars_of_token, np.ndarray) else chars_of_token)
+                for chars_of_token in char_indices]
+        unique_keys = list(dict.fromkeys(keys))
+        f_states, b_states = self.char_rnn.predict_last_states(self.cembeds, unique_keys)
+        states = {key: (f, b) for key, f, b in zip(unique_keys, f_states, b_states)}
+        return [states[key][0] for key in keys], [states[key][1] for key in keys]
+
+    def get_cached_char_features(self, char_indices):
+        """
+        last forward and backward char biRNN states of each token, looked up in the char cache;
+        states of uncached word types are computed (batched) and stored (values only, so use at inference time)
+        """
+        keys = [tuple(chars_of_token.tolist() if isinstance(chars_of_token, np.ndarray) else chars_of_token)
+                for chars_of_token in char_indices]
+        values = {}
+        missing = []
+        for key in keys:
+            if key in values:
+                continue
+            values[key] = self.char_cache.get(key)
+            if values[key] is None:
+                missing.append(key)
+        if missing:
+            f_states, b_states = self.char_rnn.predict_last_states(self.cembeds, missing)
+            for key, f, b in zip(missing, f_states, b_states):
+                values[key] = (f.npvalue(), b.npvalue())
+                self.char_cache.put(key, values[key])
+        states = {key: (dynet.inputTensor(f), dynet.inputTensor(b)) for key, (f, b) in values.items()}
+        return [states[key][0] for key in keys], [states[key][1] for key in keys]
+
+    def predict_distributions(self, batch_word_indices, batch_char_indices, task_id, temperature=None):
+        """
+        tag distributions of all output layers for a batch of sentences of the same length, computed
+        in one forward pass (softened by temperature if given); returns a float32 array of shape
+        (output layers, sentences, positions, tags)
+        """
+        dynet.renew_cg()
+        output_list = self.predict_batch(batch_word_indices, batch_char_indices, task_id, temperature=temperature)
+        num_tags, sent_len, batch_size = len(self.task2tag2idx[task_id]), len(batch_word_indices[0]), len(batch_word_indices)
+        head_values = []
+        for head_ids, output in output_list:
+            # npvalue drops trailing dimensions of size 1, the column-major order is the same in any case
+            values = np.reshape(output.npvalue(), (num_tags, sent_len, batch_size, len(head_ids)), order='F')
+            head_values.extend(zip(head_ids, values.transpose(3, 2, 1, 0)))
+        head_values.sort(key=lambda head_value: head_value[0])
+        return np.stack([values for _, values in head_values]).astype(np.float32)
+
+    def with_average(self, distributions):
+        """
+        the distributions of the output layers followed by the Q-MTL average of the heads,
+        summed in head order in float32 (like dynet.average); weighted with the head_weights of select_heads
+        (one per head of head_subset) unless predicting on a single layer
+        """
+        if self.head_weights is not None and self.predict_on_layer is None:
+            if len(self.head_weights) != len(distributions):
+                raise ValueError("{} head weights for {} heads".format(len(self.head_weights), len(distributions)))
+            weights = np.asarray(self.head_weights, dtype=np.float32)
+            average = np.tensordot(weights / weights.sum(), distributions, axes=1).astype(np.float32)
+            return np.concatenate([distributions, average[None]])
+        average = distributions[0].copy()
+        for head_distributions in distributions[1:]:
+            average += head_distributions
+        average /= np.float32(len(distributions))
+        return np.concatenate([distributions, average[None]])
+
+    def tag_layers(self, sentences, task_id="task0"):
+        """
+        tag tokenized (non-empty) sentences in batches of the same length (eval_batch_size); returns per sentence
+        the predicted tag indices and their probabilities, arrays of (output layers + Q-MTL average) x tokens
+        """
+        by_length = defaultdict(list)
+        for i, words in enumerate(sentences):
+            by_length[len(words)].append(i)
+        results = [None] * len(sentences)
+        for indices in by_length.values():
+            for batch in _chunks(indices, self.eval_batch_size):
+                batch_word_indices, batch_char_indices = zip(*[self.get_features(sentences[i]) for i in batch])
+                layers = self.with_average(self.predict_distributions(batch_word_indices, batch_char_indices, task_id))
+                predicted, confidences = np.argmax(layers, axis=3), np.max(layers, axis=3)
+                for b, i in enumerate(batch):
+                    results[i] = (predicted[:, b], confidences[:, b])
+        return results
+
+    def tag_sentences(self, sentences, task_id="task0"):
+        """
+        tag tokenized (non-empty) sentences; returns per sentence the tags of each output layer ("heads")
+        and of their Q-MTL average ("qmtl")
+        """
+        tag2idx = self.task2tag2idx[task_id]
+        i2t = np.array(sorted(tag2idx, key=tag2idx.get), dtype=object)
+        results = []
+        for predicted, _ in self.tag_layers(sentences, task_id):
+            tags = i2t[predicted]
+            results.append({"heads": tags[:-1].tolist(), "qmtl": tags[-1].tolist()})
+        return results
+
+    def tag_raw_stream(self, file_name, prediction_writer, chunk_size=1000, task_id="task0"):
+        """
+        tag a raw text file ("-": stdin) a chunk of sentences at a time while a background thread reads ahead,
+        the predictions go to prediction_writer (if given); returns the number of sentences
+        """
+        num_sentences = 0
+        for chunk in prefetch_chunks(read_raw_file(file_name), chunk_size):
+            results = self.tag_layers(chunk, task_id)
+            if prediction_writer is not None:
+                for words, (predicted, confidences) in zip(chunk, results):
+                    prediction_writer.write(words, None, predicted, confidences)
+                prediction_writer.flush()
+            num_sentences += len(chunk)
+        return num_sentences
+
+    def reported_layers(self):
+        """
+        indices of the output layers evaluate reports: the heads used for prediction and the Q-MTL average
+        (out_num); returns them with the position of the tagger's prediction (the predict_on_layer head or the average)
+        """
+        out_indices = self.prediction_heads() + [self.out_num]
+        return out_indices, 0 if self.predict_on_layer is not None else len(out_indices) - 1
+
+    def prediction_writer(self, out, task_id, output_format="legacy", probs=False, heads=False, raw=False):
+        """
+        PredictionWriter for the reported output layers of a task, to out (a file name or stream)
+        """
+        out_indices, prediction_layer = self.reported_layers()
+        tag2idx = self.task2tag2idx[task_id]
+        layer_names = ["head{}".format(out_index) for out_index in out_indices[:-1]] + ["qmtl"]
+        return PredictionWriter(out, sorted(tag2idx, key=tag2idx.get), layer_names, prediction_layer,
+                                output_format=output_format, probs=probs, heads=heads, raw=raw)
+
+    def select_heads(self, dev_X, dev_Y, task_labels, tolerance, weighted=False):
+        """
+        choose the heads used for prediction: greedily the smallest set (with weighted, a weighted set) whose
+        average keeps the dev accuracy within tolerance of the average of all heads; the other heads are not
+        computed any more; returns the accuracies of the chosen and of all heads
+        """
+        self.head_subset, self.head_weights = None, None
+        self.fuse_heads()
+        candidates = self.prediction_heads()
+        distributions = np.zeros((len(candidates), dev_X.num_tokens(), len(self.task2tag2idx[task_labels[0]])), dtype=np.float32)
+        for batch in self.get_minibatches(range(len(dev_X)), dev_X, task_labels, self.eval_batch_size):
+            batch_word_indices, batch_char_indices = zip(*[dev_X[i] for i in batch])
+            batch_distributions = self.predict_distributions(batch_word_indices, batch_char_indices, task_labels[batch[0]])
+            for b, sentence_idx in enumerate(batch):
+                distributions[:, dev_X.sent_offsets[sentence_idx]:dev_X.sent_offsets[sentence_idx + 1]] = batch_distributions[:, b]
+        gold = np.concatenate([np.asarray(y, dtype=np.int64) for y in dev_Y])
+        heads, weights, accuracy, full_accuracy = greedy_head_selection(distributions, gold, tolerance, weighted)
+        heads = [candidates[head] for head in heads]
+        if len(heads) < len(candidates) or len(set(weights)) > 1:
+            self.head_subset, self.head_weights = heads, weights if weighted else None
+        self.fuse_heads()
+        print("selected heads {} (weights {}): dev accuracy {:.4f}, all {} heads {:.4f}".format(
+            heads, weights, accuracy, len(candidates), full_accuracy), file=sys.stderr)
+        return accuracy, full_accuracy
+
+    def soft_targets(self, file_name, task_id, temperature=1.0):
+        """
+        distillation targets: the (Q-MTL) average of the tag distributions of the heads used for prediction
+        at the temperature, for every token of file_name
+        """
+        X, _, _, _, task_labels = self.get_data_as_indices(file_name, task_id)
+        targets = np.zeros((X.num_tokens(), len(self.task2tag2idx[task_id])), dtype=np.float32)
+        for batch in self.get_minibatches(range(len(X)), X, task_labels, self.eval_batch_size):
+            batch_word_indices, batch_char_indices = zip(*[X[i] for i in batch])
+            distributions = self.with_average(self.predict_distributions(batch_word_indices, batch_char_indices, task_id,
+                                                                         temperature=temperature))[-1]
+            for b, sentence_idx in enumerate(batch):
+                targets[X.sent_offsets[sentence_idx]:X.sent_offsets[sentence_idx + 1]] = distributions[b]
+        tag2idx = self.task2tag2idx[task_id]
+        return SoftTargets(sorted(tag2idx, key=tag2idx.get), targets, X.sent_offsets)
+
+    def evaluate(self, test_X, test_Y, org_X, org_Y, task_labels, prediction_writer=None, verbose=True, ensemble_accumulator=None):
         """
         compute accuracy on a test file
+
+        sentences are tagged in batches of the same length (eval_batch_size); the results are reported
+        in the original order. Only the predicted tags (and their probabilities) of the reported output
+        layers are kept per token, they are written to prediction_writer if given; the distributions of
+        the tagger's prediction (the predict_on_layer head, or the Q-MTL average) are added to
+        ensemble_accumulator at the token offsets if given
         """
+        if self.char_cache is not None:
+            self.char_cache.reset_stats()
         correct = (self.out_num+1) * [0]
         total = (self.out_num+1) * [0.0]
-        prediction_array = [[] for _ in range(self.out_num+1)]
 
-        if output_predictions != None:
-            i2w = {self.w2i[w] : w for w in self.w2i.keys()}
-            task_id = task_labels[0] # get first
-            i2t = {self.task2tag2idx[task_id][t] : t for t in self.task2tag2idx[task_id].keys()}
+        out_indices, accumulated_layer = self.reported_layers()
+
+        # per reported output layer and token offset: the predicted tag index and its probability
+        sent_offsets = test_X.sent_offsets
+        predicted = np.zeros((len(out_indices), test_X.num_tokens()), dtype=np.int64)
+        confidences = np.zeros((len(out_indices), test_X.num_tokens()), dtype=np.float32)
+        num_tagged = 0
+        for batch in self.get_minibatches(range(len(test_X)), test_X, task_labels, self.eval_batch_size):
+            batch_word_indices, batch_char_indices = zip(*[test_X[i] for i in batch])
+            distributions = self.predict_distributions(batch_word_indices, batch_char_indices, task_labels[batch[0]])
+            layers = self.with_average(distributions)
+            batch_predicted, batch_confidences = np.argmax(layers, axis=3), np.max(layers, axis=3)
+            for b, sentence_idx in enumerate(batch):
+                start, end = sent_offsets[sentence_idx], sent_offsets[sentence_idx + 1]
+                predicted[:, start:end] = batch_predicted[:, b]
+                confidences[:, start:end] = batch_confidences[:, b]
+                if ensemble_accumulator is not None:
+                    ensemble_accumulator.add(start, end, layers[accumulated_layer, b])
 
-        for i, ((word_indices, word_char_indices), gold_tag_indices, task_of_instance) in enumerate(zip(test_X, test_Y, task_labels)):
             if verbose:
-                if i%100==0:
-                    sys.stderr.write('%s'%i)
-                elif i%10==0:
-                    sys.stderr.write('.')
-
-            output_list = self.predict(word_indices, word_char_indices, task_of_instance)
-            #meta_output = np.mean([[token.value() for token in output] for output in output_list], axis=0)
-            expressions_to_average = [[] for _ in range(len(output_list[0]))]
-            for ol in output_list:
-                for j, o in enumerate(ol):
-                    expressions_to_average[j].append(o)
-            output_list.append([dynet.average(e) for e in expressions_to_average])
-            labeled_output_list = enumerate(output_list) if self.predict_on_layer is None else \
-                [(self.predict_on_layer, output_list[0]), (self.out_num, output_list[1])]
-            for out_index, output in labeled_output_list:
-                predicted_tag_indices = [np.argmax(o.value()) for o in output]  # logprobs to indices
-                if output_predictions:
-                    prediction = [i2t[idx] for idx in predicted_tag_indices]
-                    tag_confidences = [np.max(o.value()) for o in output]
-
-                    words = org_X[i]
-                    gold = org_Y[i]
-
-                    for w, g, p, c in zip(words, gold, prediction, tag_confidences):
-                        if raw:
-                            print(u"{}\t{}".format(w, p)) # do not print DUMMY tag when --raw is on
-                        else:
-                            if output_probs:
-                                print(u"%s\t%s\t%s\t%.2f" % (w, g, p, c))
-                            else:
-                                print(u"%s\t%s\t%s" % (w, g, p))
-                    print("")
-                correct[out_index] += sum([1 for (predicted, gold) in zip(predicted_tag_indices, gold_tag_indices) if predicted == gold])
-                total[out_index] += len(gold_tag_indices)
-                prediction_array[out_index].append([o.value() for o in output])
-
-        return correct, total, prediction_array if get_predictions_array else []
+                for i in range(num_tagged, num_tagged + len(batch)):
+                    if i%100==0:
+                        sys.stderr.write('%s'%i)
+                    elif i%10==0:
+                        sys.stderr.write('.')
+            num_tagged += len(batch)
+
+        # unknown gold tags are -1, they never match
+        gold_tag_indices = np.concatenate([np.asarray(y, dtype=np.int64) for y in test_Y]) if len(test_Y) else np.zeros(0, dtype=np.int64)
+        for layer, out_index in enumerate(out_indices):
+            correct[out_index] = int(np.sum(predicted[layer] == gold_tag_indices))
+            total[out_index] = float(len(gold_tag_indices))
+
+        if prediction_writer is not None:
+            for i in range(len(test_X)):
+                start, end = sent_offsets[i], sent_offsets[i + 1]
+                prediction_writer.write(org_X[i], org_Y[i], predicted[:, start:end], confidences[:, start:end])
+
+        if verbose and self.char_cache is not None:
+            print("\nchar cache: {} entries, {} hits, {} misses (hit rate {:.2%})".format(
+                len(self.char_cache), self.char_cache.hits, self.char_cache.misses, self.char_cache.hit_rate()), file=sys.stderr)
+
+        return correct, total
 
     def get_train_data(self, list_folders_name):
         """
@@ -936,8 +1973,19 @@ class NNTagger(object):
         transform training data to features (word indices)
         map tags to integers
         """
-        X = []
-        Y = []
+        cache_path = None
+        if self.corpus_cache:
+            cache_path = corpus_cache_path(self.corpus_cache, list_folders_name, "train", self.max_vocab_size, self.c_in_dim)
+            cached = load_corpus_cache(cache_path)
+            if cached:
+                arrays, meta = cached
+                X = IndexedCorpus.from_arrays(arrays)
+                self.tasks_ids = meta["tasks_ids"]
+                task_labels = [self.tasks_ids[t] for t in arrays["tasks"].tolist()]
+                print("%s sentences %s tokens" % (len(X), X.num_tokens()), file=sys.stderr)
+                print("%s w features, %s c features " % (len(meta["w2i"]), len(meta["c2i"])), file=sys.stderr)
+                return X, X.tags, task_labels, meta["w2i"], meta["c2i"], meta["task2tag2idx"]
+
         task_labels = [] # keeps track of where instances come from "task1" or "task2"..
         self.tasks_ids = [] # record ids of the tasks
 
@@ -951,6 +1999,18 @@ class NNTagger(object):
         c2i["<w>"] = 1   # word start
         c2i["</w>"] = 2  # word end index
 
+        def char_indices_of(word):
+            chars_of_word = [c2i["<w>"]]
+            for char in word:
+                if char not in c2i:
+                    c2i[char] = len(c2i)
+                chars_of_word.append(c2i[char])
+            chars_of_word.append(c2i["</w>"])
+            return chars_of_word
+
+        # sentences are kept in flat buffers, char indices once per word type
+        corpus_builder = IndexedCorpusBuilder(char_indices_of if self.c_in_dim > 0 else None)
+
         if self.max_vocab_size is not None:
             word_counter = Counter()
             print('Reading files to create vocabulary of size %d.' %
@@ -972,7 +2032,6 @@ class NNTagger(object):
             for instance_idx, (words, tags) in enumerate(read_conll_file(folder_name)):
                 num_sentences += 1
                 instance_word_indices = [] #sequence of word indices
-                instance_char_indices = [] #sequence of char indices
                 instance_tags_indices = [] #sequence of tag indices
 
                 for i, (word, tag) in enumerate(zip(words, tags)):
@@ -987,22 +2046,12 @@ class NNTagger(object):
                             w2i[word] = len(w2i)
                         instance_word_indices.append(w2i[word])
 
-                    if self.c_in_dim > 0:
-                        chars_of_word = [c2i["<w>"]]
-                        for char in word:
-                            if char not in c2i:
-                                c2i[char] = len(c2i)
-                            chars_of_word.append(c2i[char])
-                        chars_of_word.append(c2i["</w>"])
-                        instance_char_indices.append(chars_of_word)
-
                     if tag not in task2tag2idx[task_id]:
                         task2tag2idx[task_id][tag]=len(task2tag2idx[task_id])
 
                     instance_tags_indices.append(task2tag2idx[task_id].get(tag))
 
-                X.append((instance_word_indices, instance_char_indices)) # list of word indices, for every word list of char indices
-                Y.append(instance_tags_indices)
+                corpus_builder.add(words, instance_word_indices, instance_tags_indices)
                 task_labels.append(task_id)
 
             if num_sentences == 0 or num_tokens == 0:
@@ -1012,8 +2061,15 @@ class NNTagger(object):
             print("%s sentences %s tokens" % (num_sentences, num_tokens), file=sys.stderr)
             print("%s w features, %s c features " % (len(w2i),len(c2i)), file=sys.stderr)
 
-        assert(len(X)==len(Y))
-        return X, Y, task_labels, w2i, c2i, task2tag2idx  #sequence of features, sequence of labels, necessary mappings
+        X = corpus_builder.build()
+        print("corpus buffers: {:.1f} MB".format(X.nbytes() / 2**20), file=sys.stderr)
+
+        if cache_path:
+            arrays = X.arrays()
+            arrays["tasks"] = np.array([self.tasks_ids.index(t) for t in task_labels], dtype=np.int32)
+            save_corpus_cache(cache_path, arrays, {"files": list_folders_name, "tasks_ids": self.tasks_ids,
+                                                   "w2i": w2i, "c2i": c2i, "task2tag2idx": task2tag2idx})
+        return X, X.tags, task_labels, w2i, c2i, task2tag2idx  #sequence of features, sequence of labels, necessary mappings
 
     def save_embeds(self, out_filename):
         """
@@ -0,0 +1,68 @@
+import io
+import json
+
+import numpy as np
+import pytest
+
+from lib.mio import PredictionWriter, PREDICTION_FORMATS, _write_embeddings_cache, _read_embeddings_cache
+
+TAGS = ["NOUN", "VERB", "DET"]
+WORDS = ["the", "dog", "barks"]
+PREDICTED = np.array([[2, 0, 1], [2, 0, 0]]) # a head and the average
+CONFIDENCES = np.array([[0.9, 0.8, 0.7], [0.6, 0.5, 0.4]], dtype=np.float32)
+
+
+def write(output_format, gold, raw, probs=True, heads=True):
+    out = io.StringIO()
+    writer = PredictionWriter(out, TAGS, ["0", "avg"], output_format=output_format, probs=probs, heads=heads, raw=raw)
+    writer.write(WORDS, gold, PREDICTED, CONFIDENCES)
+    writer.close()
+    return out.getvalue()
+
+
+@pytest.mark.parametrize("output_format", PREDICTION_FORMATS)
+@pytest.mark.parametrize("raw", [True, False])
+def test_raw_input_has_no_gold(output_format, raw):
+    # raw input (tag_raw_stream, lib.mnumpy) has no gold tags
+    text = write(output_format, None, raw)
+    assert "the" in text and "DET" in text
+    assert "DUMMY" not in text and "Gold=" not in text and '"gold"' not in text
+
+
+@pytest.mark.parametrize("output_format", PREDICTION_FORMATS)
+def test_raw_ignores_gold(output_format):
+    assert write(output_format, ["DUMMY"] * 3, True) == write(output_format, None, True)
+
+
+def test_legacy():
+    assert write("legacy", ["DET", "NOUN", "VERB"], False, probs=False) == \
+        "the\tDET\tDET\ndog\tNOUN\tNOUN\nbarks\tVERB\tVERB\n\nthe\tDET\tDET\ndog\tNOUN\tNOUN\nbarks\tVERB\tNOUN\n\n"
+    assert write("legacy", None, True).splitlines()[:3] == ["the\tDET", "dog\tNOUN", "barks\tVERB"]
+
+
+def test_tsv_and_jsonl():
+    gold = ["DET", "NOUN", "VERB"]
+    assert write("tsv", gold, False, heads=False).splitlines()[2] == "barks\tVERB\tNOUN\t0.4000"
+    sentence = json.loads(write("jsonl", gold, False))
+    assert sentence["gold"] == gold and sentence["tags"] == ["DET", "NOUN", "NOUN"]
+    assert sentence["heads"]["0"] == ["DET", "NOUN", "VERB"]
+
+
+def test_embeddings_cache_leaves_no_temporary_files(tmp_path):
+    matrix_file, vocab_file = str(tmp_path / "emb.npy"), str(tmp_path / "emb.vocab")
+    emb = {"the": [0.5, 1.0], "dog": [2.0, -1.0]}
+    for _ in range(2): # an existing cache is replaced
+        _write_embeddings_cache(emb, 2, matrix_file, vocab_file)
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["emb.npy", "emb.vocab"]
+    cached = _read_embeddings_cache(matrix_file, vocab_file)
+    assert len(cached) == 2 and list(cached["dog"]) == [2.0, -1.0]
+
+
+@pytest.mark.parametrize("emb", [{"a\rb": [1.0, 2.0], "c\nd": [3.0, 4.0], "e": [5.0, 6.0]}, {}])
+def test_embeddings_cache_round_trip(tmp_path, emb):
+    matrix_file, vocab_file = str(tmp_path / "emb.npy"), str(tmp_path / "emb.vocab")
+    _write_embeddings_cache(emb, 2, matrix_file, vocab_file)
+    cached = _read_embeddings_cache(matrix_file, vocab_file)
+    assert list(cached) == list(emb) and cached.matrix.shape == (len(emb), 2)
+    for word, vector in emb.items():
+        assert list(cached[word]) == vector
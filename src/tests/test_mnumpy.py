@@ -0,0 +1,93 @@
+import sys
+
+import numpy as np
+import pytest
+
+from lib.mbundle import save_bundle, encode_vocabulary
+from lib.mnumpy import run_rnn, RNN_PARAMETER_NAMES, NUMPY_FORMAT, NumpyTagger, main
+
+
+def _logistic(x):
+    return 1 / (1 + np.exp(-x))
+
+
+def test_gru_first_step():
+    # from the zero state: h_1 = (1 - z) * h_0 + z * h_tilde = z * h_tilde
+    rng = np.random.RandomState(0)
+    params = {name: rng.randn(3, 4) if name.startswith("x2") else rng.randn(3, 3) if name.startswith("h2") else rng.randn(3)
+              for name in RNN_PARAMETER_NAMES["gru"]}
+    x = rng.randn(1, 1, 4)
+    z = _logistic(x[0] @ params["x2z"].T + params["bz"])
+    h_tilde = np.tanh(x[0] @ params["x2h"].T + params["bh"])
+    np.testing.assert_allclose(run_rnn("gru", params, x)[0], z * h_tilde, rtol=1e-6)
+
+
+@pytest.mark.parametrize("builder", ["lstm", "lstmc", "gru", "rnn"])
+def test_dynet_parity(builder):
+    dynet = pytest.importorskip("dynet")
+    builders = {"lstm": dynet.VanillaLSTMBuilder, "lstmc": dynet.CoupledLSTMBuilder,
+                "gru": dynet.GRUBuilder, "rnn": dynet.SimpleRNNBuilder}
+    model = dynet.ParameterCollection()
+    rnn = builders[builder](1, 5, 4, model)
+    for param in rnn.get_parameters()[0]:
+        param.set_value(np.random.RandomState(1).uniform(-0.5, 0.5, param.shape()))
+    (layer_params,) = rnn.get_parameters()
+    params = {name: param.as_array() for name, param in zip(RNN_PARAMETER_NAMES[builder], layer_params)}
+
+    inputs = np.random.RandomState(2).randn(6, 3, 5).astype(np.float32) # time x batch x in_dim
+    actual = run_rnn(builder, params, inputs)
+    for b in range(inputs.shape[1]):
+        dynet.renew_cg()
+        expected = rnn.initial_state().transduce([dynet.inputTensor(x) for x in inputs[:, b]])
+        np.testing.assert_allclose(actual[:, b], np.array([e.npvalue() for e in expected]), atol=1e-5)
+
+
+def _write_model(path, **head_settings):
+    rng = np.random.RandomState(0)
+    w2i = {"_UNK": 0, "the": 1, "dog": 2}
+    meta = {"format": NUMPY_FORMAT, "builder": "rnn", "activation": "tanh", "c_in_dim": 0, "h_layers": 1,
+            "tasks_ids": ["task0"], "task2tag2idx": {"task0": {"DET": 0, "NOUN": 1}}, "task_expected_at": {"task0": 1},
+            "predict_on_layer": None, "head_subset": None, "head_weights": None,
+            "heads": {"task0": [{"mlp": 0, "mlp_activation": None}] * 2}}
+    meta.update(head_settings)
+    tensors = {"wembeds": rng.randn(3, 4).astype(np.float32)}
+    for name, mapping in (("w2i", w2i), ("c2i", {"_UNK": 0})):
+        tensors[name + ".strings"], tensors[name + ".offsets"], tensors[name + ".indices"] = encode_vocabulary(mapping)
+    for direction in "fb":
+        tensors["inner.0.{}.x2h".format(direction)] = rng.randn(3, 4).astype(np.float32)
+        tensors["inner.0.{}.h2h".format(direction)] = rng.randn(3, 3).astype(np.float32)
+        tensors["inner.0.{}.bh".format(direction)] = rng.randn(3).astype(np.float32)
+    for head in range(2):
+        tensors["task0.head{}.W".format(head)] = rng.randn(2, 6).astype(np.float32)
+        tensors["task0.head{}.b".format(head)] = rng.randn(2).astype(np.float32)
+    save_bundle(path, meta, tensors)
+
+
+@pytest.mark.parametrize("output_format", ["legacy", "tsv", "conllu", "jsonl"])
+def test_main_tags_raw_text(tmp_path, monkeypatch, capsys, output_format):
+    model = str(tmp_path / "model.numpy.qmtl")
+    _write_model(model)
+    text = tmp_path / "input.txt"
+    text.write_text("the dog\nthe cat barks\n", encoding="utf-8")
+    monkeypatch.setattr(sys, "argv", ["mnumpy", model, str(text), "--output-format", output_format])
+    main()
+    out = capsys.readouterr().out
+    assert "dog" in out and "barks" in out
+    if output_format == "legacy":
+        assert out.split("\n\n")[0].splitlines()[1].split("\t")[0] == "dog"
+
+
+def test_weighted_average(tmp_path):
+    model = str(tmp_path / "model.numpy.qmtl")
+    _write_model(model, head_subset=[0, 1], head_weights=[1, 3])
+    tagger = NumpyTagger.load(model)
+    layers = tagger.with_average(tagger.predict_distributions([[1, 2]], [], "task0"))
+    np.testing.assert_allclose(layers[2], 0.25 * layers[0] + 0.75 * layers[1], rtol=1e-5)
+
+
+def test_head_weights_must_match_the_heads(tmp_path):
+    model = str(tmp_path / "model.numpy.qmtl")
+    _write_model(model, head_subset=[1], head_weights=[1, 2])
+    tagger = NumpyTagger.load(model)
+    with pytest.raises(ValueError):
+        tagger.tag_sentences([["the", "dog"]])
@@ -0,0 +1,46 @@
+import numpy as np
+
+from lib.mpta import PTAEngine
+
+
+class Parameter(object):
+    def __init__(self, values):
+        self.values = np.array(values, dtype=np.float32)
+
+    def shape(self):
+        return self.values.shape
+
+    def as_array(self):
+        return self.values.copy()
+
+    def set_value(self, values):
+        self.values = np.array(values, dtype=np.float32)
+
+
+class Layer(object):
+    def __init__(self, value):
+        self.mlp = 0
+        self.W = Parameter(np.full((2, 3), value))
+        self.b = Parameter(np.full(2, value))
+
+
+def pta_params(**params):
+    return dict({"G": 0, "P": 0, "H": 0, "D": [0.1, 0.2, 0.3, 0.4], "D-Lower": 0.0, "D-Upper": 1.0}, **params)
+
+
+def test_copy_skips_excluded_heads():
+    layers = [Layer(i) for i in range(4)]
+    params = pta_params(G=1)
+    PTAEngine(params).update(layers, 1, excluded=[2])
+    assert [float(layer.W.values[0, 0]) for layer in layers] == [1, 1, 2, 1]
+    assert params["D"] == [0.2, 0.2, 0.3, 0.2]
+
+
+def test_perturb_and_jitter_skip_excluded_heads():
+    np.random.seed(0)
+    layers = [Layer(i) for i in range(4)]
+    params = pta_params(P=0.1, H=0.01)
+    PTAEngine(params).update(layers, 0, excluded=[1, 3])
+    assert np.all(layers[0].W.values == 0) and np.all(layers[1].W.values == 1) and np.all(layers[3].W.values == 3)
+    assert np.any(layers[2].W.values != 2)
+    assert params["D"][:2] == [0.1, 0.2] and params["D"][3] == 0.4 and params["D"][2] != 0.3